@@ -1,12 +1,33 @@
 # app.py
 # Run with: streamlit run app.py
 
+import copy
 import io
+import json
+import multiprocessing
 import os
+import re
+import hashlib
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
 import zipfile
+import zlib
 import xml.etree.ElementTree as ET
-from typing import Dict, List, Optional, Set, Tuple, Any
+from xml.parsers import expat
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Any, Union
 import base64
+import colorsys
 
 import streamlit as st
 
@@ -47,6 +68,10 @@ DOCX_AVAILABLE = False
 PPTX_AVAILABLE = False
 OPENPYXL_AVAILABLE = False
 PIL_AVAILABLE = False
+PDF_AVAILABLE = False
+PDFIUM_AVAILABLE = False
+NUMPY_AVAILABLE = False
+CAIROSVG_AVAILABLE = False
 
 try:
     from docx import Document as DocxDocument
@@ -63,6 +88,10 @@ try:
     from pptx.enum.shapes import MSO_SHAPE_TYPE
     from pptx.enum.dml import MSO_FILL, MSO_THEME_COLOR
     from pptx.oxml.ns import qn as pptx_qn
+    from pptx.opc.constants import RELATIONSHIP_TYPE as PPTX_RT
+    from pptx.opc.oxml import serialize_part_xml as pptx_serialize_part_xml
+    from pptx.opc.packuri import PackURI
+    from pptx.oxml import parse_xml as pptx_parse_xml
     PPTX_AVAILABLE = True
 except Exception:
     PPTX_AVAILABLE = False
@@ -70,17 +99,44 @@ except Exception:
 try:
     import openpyxl
     from openpyxl.styles import Font, PatternFill, Color, Border, Side
+    from openpyxl.styles.colors import COLOR_INDEX as XL_COLOR_INDEX
     from openpyxl.drawing.image import Image as XLImage
+    from openpyxl.writer.excel import ExcelWriter as XLExcelWriter
     OPENPYXL_AVAILABLE = True
 except Exception:
     OPENPYXL_AVAILABLE = False
 
 try:
-    from PIL import Image as PILImage
+    from PIL import Image as PILImage, ImageDraw as PILImageDraw, ImageFont as PILImageFont
     PIL_AVAILABLE = True
 except Exception:
     PIL_AVAILABLE = False
 
+try:
+    from pypdf import PdfReader
+    from pypdf.generic import ArrayObject, ContentStream, DictionaryObject, FloatObject, IndirectObject, NameObject, NumberObject
+    PDF_AVAILABLE = True
+except Exception:
+    PDF_AVAILABLE = False
+
+try:
+    import pypdfium2 as pdfium
+    PDFIUM_AVAILABLE = True
+except Exception:
+    PDFIUM_AVAILABLE = False
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except Exception:
+    NUMPY_AVAILABLE = False
+
+try:
+    import cairosvg
+    CAIROSVG_AVAILABLE = True
+except Exception:
+    CAIROSVG_AVAILABLE = False
+
 
 # Page configuration
 st.set_page_config(
@@ -118,11 +174,20 @@ st.markdown(f"""
 """, unsafe_allow_html=True)
 
 
+# Widgets inside a fragment rerun only that fragment; older Streamlit versions fall back to full reruns
+ui_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+# Fragments on a timer poll background work; without them the page waits for that work instead
+UI_TIMER_FRAGMENTS = hasattr(st, "fragment")
+ui_timer_fragment = (lambda seconds: st.fragment(run_every=seconds)) if UI_TIMER_FRAGMENTS else (lambda seconds: (lambda func: func))
+
+
 # Session state
 if "image_repls" not in st.session_state:
     st.session_state["image_repls"] = {}
 if "theme_image_repls" not in st.session_state:
     st.session_state["theme_image_repls"] = {}
+if "last_apply" not in st.session_state:
+    st.session_state["last_apply"] = None
 
 def get_persisted_image_replacements() -> Tuple[Dict[str, bytes], Dict[str, bytes]]:
     return dict(st.session_state["image_repls"]), dict(st.session_state["theme_image_repls"])
@@ -137,6 +202,27 @@ def clear_all_replacements():
     st.session_state["image_repls"].clear()
     st.session_state["theme_image_repls"].clear()
 
+def get_cached_extraction(file_hash: str) -> Optional[Dict[str, Any]]:
+    cached = st.session_state.get("extraction")
+    if cached and cached["file_hash"] == file_hash:
+        return cached["extracted"]
+    # Another session may already have parsed the same file
+    shared = shared_extraction_cache().get(file_hash)
+    if shared is not None:
+        st.session_state["extraction"] = {"file_hash": file_hash, "extracted": shared}
+    return shared
+
+def persist_extraction(file_hash: str, extracted: Dict[str, Any]):
+    summary = extraction_summary(extracted)
+    st.session_state["extraction"] = {"file_hash": file_hash, "extracted": summary}
+    shared_extraction_cache().put(file_hash, summary)
+
+def get_last_apply_state() -> Optional[Dict[str, Any]]:
+    return st.session_state["last_apply"]
+
+def persist_last_apply_state(state: Dict[str, Any]):
+    st.session_state["last_apply"] = state
+
 
 # General utils
 def infer_file_type(file_name: str) -> Optional[str]:
@@ -151,6 +237,59 @@ def infer_file_type(file_name: str) -> Optional[str]:
         return "pdf"
     return None
 
+# Color values
+# Colors are keyed everywhere as interned "#RRGGBB" strings. color_hex is the one parser for the raw forms the formats
+# store; it is memoized because the same handful of values recurs across every run, cell and border of a large file
+COLOR_CACHE_ENTRIES = 8192
+COLOR_HEX_RE = re.compile(r"[0-9A-Fa-f]{6}")
+# Excel indexes 64 and 65 are the system foreground and background, i.e. "automatic"
+XLSX_SYSTEM_COLOR_INDEXES = (64, 65)
+
+@lru_cache(maxsize=COLOR_CACHE_ENTRIES)
+def color_hex(raw: Any) -> Optional[str]:
+    """Canonical "#RRGGBB" for RRGGBB or #RRGGBB, short RGB and Excel ARGB values; None for auto, none and anything else"""
+    if not isinstance(raw, str):
+        return None
+    val = raw.strip().lstrip("#")
+    if len(val) == 3:
+        val = "".join(ch * 2 for ch in val)
+    elif len(val) == 8:
+        val = val[2:]
+    if not COLOR_HEX_RE.fullmatch(val):
+        return None
+    return sys.intern("#" + val.upper())
+
+@lru_cache(maxsize=COLOR_CACHE_ENTRIES)
+def color_rgb(raw: Any) -> Optional[Tuple[int, int, int]]:
+    hexv = color_hex(raw)
+    return tuple(int(hexv[i:i + 2], 16) for i in (1, 3, 5)) if hexv else None
+
+@lru_cache(maxsize=COLOR_CACHE_ENTRIES)
+def color_modified(rgb: Tuple[int, int, int], modifiers: Tuple[Tuple[str, int], ...]) -> Tuple[int, int, int, int]:
+    """RGBA of a scheme or literal DrawingML color after its lumMod/lumOff/shade/tint/alpha children, in document order"""
+    r, g, b = [c / 255.0 for c in rgb]
+    alpha = 1.0
+    for mod_tag, val in modifiers:
+        amount = val / 100000.0
+        if mod_tag in ("lumMod", "lumOff"):
+            h, l, sat = colorsys.rgb_to_hls(r, g, b)
+            l = min(1.0, max(0.0, l * amount if mod_tag == "lumMod" else l + amount))
+            r, g, b = colorsys.hls_to_rgb(h, l, sat)
+        elif mod_tag == "shade":
+            r, g, b = r * amount, g * amount, b * amount
+        elif mod_tag == "tint":
+            r, g, b = 1 - (1 - r) * amount, 1 - (1 - g) * amount, 1 - (1 - b) * amount
+        elif mod_tag == "alpha":
+            alpha = amount
+    return (int(r * 255), int(g * 255), int(b * 255), int(alpha * 255))
+
+@lru_cache(maxsize=128)
+def xlsx_indexed_hex(index: Any) -> Optional[str]:
+    """Excel's legacy indexed palette; workbooks that override it (rare) still resolve to the default entries"""
+    if not OPENPYXL_AVAILABLE or not isinstance(index, int) or index in XLSX_SYSTEM_COLOR_INDEXES or not 0 <= index < len(XL_COLOR_INDEX):
+        return None
+    return color_hex(XL_COLOR_INDEX[index])
+
 def hex_no_hash(hex_color: str) -> str:
     if not hex_color:
         return ""
@@ -162,14 +301,11 @@ def rgbcolor_to_hex(rgb_obj) -> Optional[str]:
             return None
         s = str(rgb_obj)
         if s and len(s) == 6:
-            return "#" + s.upper()
+            return color_hex(s)
         if hasattr(rgb_obj, "rgb"):
             val = getattr(rgb_obj, "rgb")
             if isinstance(val, int):
-                r = (val >> 16) & 0xFF
-                g = (val >> 8) & 0xFF
-                b = val & 0xFF
-                return "#{:02X}{:02X}{:02X}".format(r, g, b)
+                return color_hex("{:06X}".format(val & 0xFFFFFF))
     except Exception:
         return None
     return None
@@ -203,9 +339,7 @@ def extract_color_from_pptx_color_obj(color_obj) -> Optional[str]:
                 # Check for srgbClr (RGB color)
                 srgb = color_elem.find('.//{http://schemas.openxmlformats.org/drawingml/2006/main}srgbClr')
                 if srgb is not None:
-                    val = srgb.get('val')
-                    if val and len(val) == 6:
-                        return "#" + val.upper()
+                    return color_hex(srgb.get('val'))
         except Exception:
             pass
             
@@ -217,12 +351,11 @@ def openpyxl_color_to_hex(color_obj) -> Optional[str]:
     try:
         if color_obj is None:
             return None
-        if hasattr(color_obj, "rgb") and color_obj.rgb:
-            val = color_obj.rgb
-            if len(val) == 8:
-                return "#" + val[2:].upper()
-            if len(val) == 6:
-                return "#" + val.upper()
+        ctype = getattr(color_obj, "type", "rgb")
+        if ctype == "indexed":
+            return xlsx_indexed_hex(color_obj.indexed)
+        if ctype == "rgb":
+            return color_hex(color_obj.rgb)
     except Exception:
         return None
     return None
@@ -230,6 +363,9 @@ def openpyxl_color_to_hex(color_obj) -> Optional[str]:
 def safe_key(s: str) -> str:
     return "".join(ch if ch.isalnum() or ch in "._-:" else "_" for ch in str(s))
 
+def content_hash(data: bytes) -> str:
+    return hashlib.sha1(data or b"").hexdigest()
+
 def normalize_zip_path(base_dir: str, rel_target: str) -> str:
     parts = base_dir.strip("/").split("/")
     target_parts = rel_target.split("/")
@@ -261,6 +397,534 @@ def convert_image_bytes_to_ext(data: bytes, target_ext: str) -> bytes:
     except Exception:
         return data
 
+# ZIP compression policy
+# Media that is already compressed gains nothing from deflate, so by default it is stored; XML deflates at xml_level
+ZIP_STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".wdp", ".jxr", ".emz", ".wmz", ".mp3", ".m4a", ".mp4", ".m4v", ".mov", ".avi", ".wmv", ".zip", ".docx", ".pptx", ".xlsx"}
+ZIP_COMPRESS_WORKERS = min(4, os.cpu_count() or 1)
+ZIP_COMPRESS_BATCH_BYTES = 32 * 1024 * 1024
+COMPRESSION_PRESETS: Dict[str, Dict[str, Any]] = {
+    "Balanced": {"store_media": True, "xml_level": 6, "parallel": False, "repack": False},
+    "Fastest": {"store_media": True, "xml_level": 1, "parallel": True, "repack": False},
+    "Smallest": {"store_media": False, "xml_level": 9, "parallel": True, "repack": True},
+    "Repack (store media)": {"store_media": True, "xml_level": 6, "parallel": True, "repack": True},
+}
+DEFAULT_COMPRESSION_POLICY = COMPRESSION_PRESETS["Balanced"]
+# Members are dated the way Office writes them, so equal content always packs to equal bytes
+ZIP_FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def zip_member_compression(name: str, policy: Dict[str, Any]) -> Tuple[int, int]:
+    if policy["store_media"] and os.path.splitext(name)[1].lower() in ZIP_STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED, 0
+    return zipfile.ZIP_DEFLATED, policy["xml_level"]
+
+def zip_encode_member(data: bytes, compress_type: int, level: int) -> bytes:
+    if compress_type == zipfile.ZIP_STORED:
+        return data
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+def zip_write_raw(out_zip: zipfile.ZipFile, name: str, raw: bytes, compress_type: int, crc: int, file_size: int, external_attr: int = 0o600 << 16, flag_bits: int = 0) -> None:
+    """Append an already encoded member; the caller guarantees it is below the ZIP64 limits"""
+    out_info = zipfile.ZipInfo(name, date_time=ZIP_FIXED_DATE_TIME)
+    out_info.compress_type = compress_type
+    out_info.CRC = crc
+    out_info.compress_size = len(raw)
+    out_info.file_size = file_size
+    out_info.external_attr = external_attr
+    out_info.flag_bits = flag_bits & 0x800
+    out_info.header_offset = out_zip.fp.tell()
+    out_zip.fp.write(out_info.FileHeader(False))
+    out_zip.fp.write(raw)
+    out_zip.filelist.append(out_info)
+    out_zip.NameToInfo[out_info.filename] = out_info
+    out_zip.start_dir = out_zip.fp.tell()
+
+def zip_write_members(out_zip: zipfile.ZipFile, batch: List[Tuple[zipfile.ZipInfo, bytes]], policy: Dict[str, Any]) -> None:
+    """Encode and append members in order; with `parallel`, deflate runs on a thread pool (zlib releases the GIL)"""
+    plans = [zip_member_compression(info.filename, policy) for info, _ in batch]
+    jobs = [(data, compress_type, level) for (_, data), (compress_type, level) in zip(batch, plans)]
+    if policy["parallel"] and len(batch) > 1:
+        with ThreadPoolExecutor(max_workers=min(ZIP_COMPRESS_WORKERS, len(batch))) as pool:
+            encoded = list(pool.map(lambda job: zip_encode_member(*job), jobs))
+    else:
+        encoded = [zip_encode_member(*job) for job in jobs]
+    for (info, data), (compress_type, level), raw in zip(batch, plans, encoded):
+        if len(data) >= zipfile.ZIP64_LIMIT or len(raw) >= zipfile.ZIP64_LIMIT:
+            out_zip.writestr(zipfile.ZipInfo(info.filename, date_time=ZIP_FIXED_DATE_TIME), data, compress_type=compress_type, compresslevel=level)
+        else:
+            zip_write_raw(out_zip, info.filename, raw, compress_type, zlib.crc32(data), len(data), info.external_attr or 0o600 << 16, info.flag_bits)
+
+def zip_copy_member_raw(in_zip: zipfile.ZipFile, out_zip: zipfile.ZipFile, info: zipfile.ZipInfo) -> bool:
+    """Copy a member's compressed bytes as-is, skipping the inflate/deflate round trip"""
+    if info.flag_bits & 0x1 or info.file_size >= zipfile.ZIP64_LIMIT or info.compress_size >= zipfile.ZIP64_LIMIT:
+        return False
+    try:
+        in_zip.fp.seek(info.header_offset)
+        fields = struct.unpack("<IHHHHHIIIHH", in_zip.fp.read(30))
+        if fields[0] != 0x04034B50:
+            return False
+        in_zip.fp.seek(info.header_offset + 30 + fields[9] + fields[10])
+        raw = in_zip.fp.read(info.compress_size)
+    except Exception:
+        return False
+    zip_write_raw(out_zip, info.filename, raw, info.compress_type, info.CRC, info.file_size, info.external_attr, info.flag_bits)
+    return True
+
+def zip_write_unchanged(base: Union[bytes, str], sink) -> None:
+    if isinstance(base, str):
+        with open(base, "rb") as f:
+            shutil.copyfileobj(f, sink)
+    else:
+        sink.write(base)
+
+def zip_replace_media(base: Union[bytes, str], replacements: Dict[str, bytes], sink=None, policy: Optional[Dict[str, Any]] = None) -> Optional[bytes]:
+    """Rewrite a package with some members replaced; base is bytes or a file path, and with a sink the
+    package is written there (returning None) instead of being built in memory.
+    Replaced members are encoded under the compression policy; with `repack` every other member is too.
+    With `deterministic` the package is always rewritten, so the engine's timestamps are replaced by fixed ones.
+    A failed rewrite raises after clearing what it wrote: falling back to the original would drop the replacements
+    while the apply reported success, and the result cache would keep that output under the mapping's key."""
+    policy = policy or DEFAULT_COMPRESSION_POLICY
+    if not replacements and not policy["repack"] and not policy.get("deterministic"):
+        if sink is not None:
+            zip_write_unchanged(base, sink)
+            return None
+        if isinstance(base, str):
+            with open(base, "rb") as f:
+                return f.read()
+        return base
+    out_mem = io.BytesIO() if sink is None else sink
+    start = out_mem.tell()
+    try:
+        in_zip = zipfile.ZipFile(base if isinstance(base, str) else io.BytesIO(base), 'r')
+        out_zip = zipfile.ZipFile(out_mem, 'w', zipfile.ZIP_DEFLATED)
+        batch: List[Tuple[zipfile.ZipInfo, bytes]] = []
+        batch_bytes = 0
+        for info in in_zip.infolist():
+            name = info.filename
+            keep_raw = name not in replacements and (not policy["repack"] or (info.compress_type == zipfile.ZIP_STORED and zip_member_compression(name, policy)[0] == zipfile.ZIP_STORED))
+            if keep_raw:
+                # Member order is preserved: pending encodes are flushed before a raw copy
+                if batch:
+                    zip_write_members(out_zip, batch, policy)
+                    batch, batch_bytes = [], 0
+                if zip_copy_member_raw(in_zip, out_zip, info):
+                    continue
+            data = replacements[name] if name in replacements else in_zip.read(name)
+            batch.append((info, data))
+            batch_bytes += len(data)
+            if batch_bytes >= ZIP_COMPRESS_BATCH_BYTES:
+                zip_write_members(out_zip, batch, policy)
+                batch, batch_bytes = [], 0
+        if batch:
+            zip_write_members(out_zip, batch, policy)
+        in_zip.close()
+        out_zip.close()
+    except Exception:
+        out_mem.seek(start)
+        out_mem.truncate()
+        raise
+    return out_mem.getvalue() if sink is None else None
+
+def zip_benchmark_policies(base: Union[bytes, str], presets: Dict[str, Dict[str, Any]] = COMPRESSION_PRESETS) -> List[Dict[str, Any]]:
+    """Repack a package under each preset and report wall time against output size"""
+    rows = []
+    for label, policy in presets.items():
+        forced = dict(policy, repack=True)
+        started = time.perf_counter()
+        out = zip_replace_media(base, {}, policy=forced)
+        rows.append({"Preset": label, "Seconds": round(time.perf_counter() - started, 3), "Size (KB)": round(len(out or b"") / 1024, 1)})
+    return rows
+
+def zip_read_members(file_bytes: bytes, names: Set[str]) -> Dict[str, bytes]:
+    members: Dict[str, bytes] = {}
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes), 'r') as zf:
+            for name in names:
+                if name in zf.NameToInfo:
+                    members[name] = zf.read(name)
+    except Exception:
+        pass
+    return members
+
+def zip_member_names(file_bytes: bytes) -> List[str]:
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes), 'r') as zf:
+            return zf.namelist()
+    except Exception:
+        return []
+
+
+# Parallel parts
+# Slides and worksheets are independent parts: large packages can be split across forked workers that inherit the
+# parsed package copy-on-write, so nothing is re-parsed or pickled on the way in and only plain values come back.
+# Off by default: forking a threaded server (tornado, scheduler and watch threads) can deadlock on locks held by
+# other threads, and per-part work is usually cheaper than the fork. REBRAND_PART_WORKERS > 1 opts in, meant for
+# single-user deployments; that process count is shared by the scheduler's concurrent jobs
+PART_WORKERS = max(1, int(os.environ.get("REBRAND_PART_WORKERS", "1")))
+PART_FORK_AVAILABLE = "fork" in multiprocessing.get_all_start_methods()
+PPTX_PARALLEL_MIN_SLIDES = 64
+XLSX_PARALLEL_MIN_SHEETS = 8
+
+def part_workers_for(count: int, minimum: int) -> int:
+    if PART_WORKERS <= 1 or not PART_FORK_AVAILABLE or count < minimum:
+        return 1
+    return max(1, min(PART_WORKERS // JOB_MAX_WORKERS, count))
+
+def part_chunks(count: int, workers: int) -> List[List[int]]:
+    # Strided, so slides or sheets of very different cost are spread evenly
+    return [list(range(start, count, workers)) for start in range(min(workers, count))]
+
+def fork_worker(func, chunk: List[int], conn) -> None:
+    # The child counts into its own Telemetry and ships the snapshot back with the result
+    telemetry = Telemetry() if TELEMETRY.get() is not None else None
+    try:
+        with telemetry_scope(telemetry):
+            value = func(chunk)
+        conn.send((True, value, telemetry.snapshot() if telemetry is not None else None))
+    except Exception:
+        conn.send((False, None, None))
+    finally:
+        conn.close()
+
+def fork_map(func, chunks: List[List[int]]) -> Optional[List[Any]]:
+    """func(chunk) for each chunk in its own forked process; None if any worker fails, so the caller can run serially"""
+    ctx = multiprocessing.get_context("fork")
+    workers = []
+    try:
+        for chunk in chunks:
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=fork_worker, args=(func, chunk, send), daemon=True)
+            proc.start()
+            send.close()
+            workers.append((proc, recv))
+    except Exception:
+        for proc, recv in workers:
+            proc.terminate()
+            recv.close()
+        return None
+    results: List[Any] = []
+    snapshots: List[Optional[Dict[str, Any]]] = []
+    failed = False
+    for proc, recv in workers:
+        # Results are read before joining: a child blocks on a full pipe until its data is taken
+        try:
+            ok, value, snapshot = recv.recv()
+        except Exception:
+            ok, value, snapshot = False, None, None
+        recv.close()
+        proc.join()
+        failed = failed or not ok
+        results.append(value)
+        snapshots.append(snapshot)
+    if failed:
+        return None
+    # Merged only on success: after a failure the caller reruns the whole batch serially and counts it again
+    telemetry = TELEMETRY.get()
+    if telemetry is not None:
+        for snapshot in snapshots:
+            telemetry.merge(snapshot)
+    return results
+
+
+# Media records
+# Image records keep a handle on their ZIP member and read the bytes only when a thumbnail or replacement needs them
+class PackageSource:
+    """One uploaded package, opened once and shared by every media handle that points into it"""
+    __slots__ = ("data", "_zip", "_lock")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self._zip: Optional[zipfile.ZipFile] = None
+        self._lock = threading.Lock()
+
+    def _archive(self) -> zipfile.ZipFile:
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(io.BytesIO(self.data), 'r')
+        return self._zip
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return self._archive().namelist()
+
+    def handle(self, member: Optional[str]) -> Optional["MediaHandle"]:
+        if not member:
+            return None
+        try:
+            with self._lock:
+                info = self._archive().NameToInfo.get(member)
+        except Exception:
+            return None
+        if info is None:
+            return None
+        return MediaHandle(self, member, info.file_size, info.CRC)
+
+    def read(self, member: str) -> bytes:
+        with self._lock:
+            return self._archive().read(member)
+
+class MediaHandle:
+    __slots__ = ("source", "member", "size", "crc")
+
+    def __init__(self, source: PackageSource, member: str, size: int, crc: int):
+        self.source = source
+        self.member = member
+        self.size = size
+        self.crc = crc
+
+    @property
+    def prefilter_key(self) -> str:
+        """CRC and size from the central directory: equal content always matches, but a match is not proof of equality"""
+        return f"{self.crc:08x}-{self.size}"
+
+    def read(self) -> bytes:
+        return self.source.read(self.member)
+
+class ImageRecord:
+    """An extracted image: identity and grouping plus either a lazy media handle or small inline bytes (thumbnails)"""
+    __slots__ = ("uid", "name", "group", "kind", "media_path", "rel_id", "theme_path", "page", "handle", "_data", "_digest")
+
+    def __init__(self, uid: str, name: str, group: str, kind: str = "media", media_path: Optional[str] = None, rel_id: Optional[str] = None, theme_path: Optional[str] = None, page: Optional[int] = None, handle: Optional[MediaHandle] = None, data: Optional[bytes] = None):
+        self.uid = uid
+        self.name = name
+        self.group = group
+        self.kind = kind
+        self.media_path = media_path
+        self.rel_id = rel_id
+        self.theme_path = theme_path
+        self.page = page
+        self.handle = handle
+        self._data = data
+        self._digest: Optional[str] = None
+
+    @property
+    def data(self) -> Optional[bytes]:
+        if self._data is not None:
+            return self._data
+        if self.handle is not None:
+            try:
+                return self.handle.read()
+            except Exception:
+                return None
+        return None
+
+    @property
+    def size(self) -> int:
+        if self._data is not None:
+            return len(self._data)
+        return self.handle.size if self.handle is not None else 0
+
+    @property
+    def prefilter_key(self) -> Optional[str]:
+        """Cheap key that never splits equal images; candidates sharing it are confirmed with digest"""
+        if self.handle is not None:
+            return self.handle.prefilter_key
+        return self.digest
+
+    @property
+    def digest(self) -> Optional[str]:
+        """Content hash of the bytes, read once; safe to key caches that hand one image's result to another"""
+        if self._digest is None:
+            data = self.data
+            if data:
+                self._digest = content_hash(data)
+        return self._digest
+
+def bind_media_handles(images: List[ImageRecord], source: PackageSource) -> None:
+    for img in images:
+        if img.handle is None and img._data is None:
+            img.handle = source.handle(img.media_path)
+
+
+# Change reports
+# Update functions take an optional report: when given, matches are counted and nothing is changed (dry run)
+class ChangeReport:
+    __slots__ = ("counts", "seen")
+
+    def __init__(self):
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.seen: Set[Any] = set()
+
+    def record(self, scope: str, category: str, count: int = 1, key: Any = None) -> None:
+        # Some elements are reached through several paths (text frames, placeholders); key counts them once
+        if key is not None:
+            if key in self.seen:
+                return
+            self.seen.add(key)
+        bucket = self.counts.setdefault(scope, {})
+        bucket[category] = bucket.get(category, 0) + count
+
+    def total(self) -> int:
+        return sum(sum(bucket.values()) for bucket in self.counts.values())
+
+    def rows(self) -> List[Dict[str, Any]]:
+        categories = sorted({category for bucket in self.counts.values() for category in bucket})
+        return [dict({"Scope": scope}, **{category: bucket.get(category, 0) for category in categories}) for scope, bucket in self.counts.items()]
+
+def apply_change(report: Optional[ChangeReport], scope: str, category: str, key: Any = None) -> bool:
+    """Record a matched edit; True means the caller should make it (always False in a dry run)"""
+    if report is None:
+        return True
+    report.record(scope, category, key=key)
+    return False
+
+
+# Telemetry
+# The walkers swallow per-element errors so one odd shape never sinks a file; when a job runs under a Telemetry,
+# those skips are counted per function, branch and exception type (with a few sampled tracebacks) instead of vanishing
+TELEMETRY_SAMPLES_PER_SITE = 3
+TELEMETRY_TRACEBACK_FRAMES = 4
+TELEMETRY_EVENTS = ("visited", "matched", "rewritten")
+
+class Telemetry:
+    """Counters keyed by (function, branch, event); skips are events named skipped:<ExceptionType>"""
+    __slots__ = ("counts", "samples", "_lock")
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.samples: Dict[Tuple[str, str], List[str]] = {}
+        self._lock = threading.Lock()
+
+    def count(self, func: str, branch: str, event: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[(func, branch, event)] += n
+
+    def skip(self, func: str, branch: str, exc: BaseException) -> None:
+        key = (func, branch)
+        with self._lock:
+            self.counts[(func, branch, "skipped:" + type(exc).__name__)] += 1
+            samples = self.samples.setdefault(key, [])
+            if len(samples) >= TELEMETRY_SAMPLES_PER_SITE:
+                return
+        text = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__, limit=-TELEMETRY_TRACEBACK_FRAMES)).strip()
+        with self._lock:
+            if len(samples) < TELEMETRY_SAMPLES_PER_SITE:
+                samples.append(text)
+
+    def merge(self, snapshot: Optional[Dict[str, Any]]) -> None:
+        if not snapshot:
+            return
+        with self._lock:
+            for row in snapshot.get("counts", []):
+                self.counts[(row["function"], row["branch"], row["event"])] += row["count"]
+            for row in snapshot.get("samples", []):
+                samples = self.samples.setdefault((row["function"], row["branch"]), [])
+                samples.extend(row["tracebacks"][:TELEMETRY_SAMPLES_PER_SITE - len(samples)])
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Plain lists and dicts, safe for JSON manifests and for the pipe back from a forked worker"""
+        with self._lock:
+            return {
+                "counts": [{"function": f, "branch": b, "event": e, "count": n} for (f, b, e), n in sorted(self.counts.items())],
+                "samples": [{"function": f, "branch": b, "tracebacks": list(t)} for (f, b), t in sorted(self.samples.items()) if t],
+            }
+
+    def skipped(self) -> int:
+        with self._lock:
+            return sum(n for (_, _, e), n in self.counts.items() if e.startswith("skipped:"))
+
+def telemetry_summary(snapshot: Optional[Dict[str, Any]]) -> Dict[str, Dict[str, int]]:
+    """Per-function totals across branches, compact enough for a batch manifest entry"""
+    summary: Dict[str, Dict[str, int]] = {}
+    for row in (snapshot or {}).get("counts", []):
+        bucket = summary.setdefault(row["function"], {})
+        bucket[row["event"]] = bucket.get(row["event"], 0) + row["count"]
+    return summary
+
+def telemetry_rows(snapshot: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """One table row per function and branch: the fixed events, then skips grouped by exception type"""
+    sites: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for row in (snapshot or {}).get("counts", []):
+        site = sites.setdefault((row["function"], row["branch"]), dict({"Function": row["function"], "Branch": row["branch"]}, **{e: 0 for e in TELEMETRY_EVENTS}, skipped=0, exceptions={}))
+        event = row["event"]
+        if event.startswith("skipped:"):
+            site["skipped"] += row["count"]
+            site["exceptions"][event.split(":", 1)[1]] = row["count"]
+        else:
+            site[event] = site.get(event, 0) + row["count"]
+    rows = []
+    for site in sites.values():
+        site["exceptions"] = ", ".join(f"{name} ×{n}" for name, n in sorted(site["exceptions"].items(), key=lambda kv: -kv[1]))
+        rows.append(site)
+    return sorted(rows, key=lambda r: (-r["skipped"], r["Function"], r["Branch"]))
+
+TELEMETRY: ContextVar = ContextVar("rebrand_telemetry", default=None)
+
+@contextmanager
+def telemetry_scope(telemetry: Optional[Telemetry]):
+    token = TELEMETRY.set(telemetry)
+    try:
+        yield telemetry
+    finally:
+        TELEMETRY.reset(token)
+
+def telemetry_count(func: str, branch: str, event: str, n: int = 1) -> None:
+    telemetry = TELEMETRY.get()
+    if telemetry is not None:
+        telemetry.count(func, branch, event, n)
+
+def telemetry_skip(func: str, branch: str, exc: BaseException) -> None:
+    telemetry = TELEMETRY.get()
+    if telemetry is not None:
+        telemetry.skip(func, branch, exc)
+
+
+# Text replacement
+# Old names, taglines and URLs are found in a paragraph's joined run text, so a match split across runs still hits.
+# The replacement goes into the run where the match starts (keeping its formatting) and the rest is cut from the runs after it
+@lru_cache(maxsize=32)
+def text_pattern(items: Tuple[Tuple[str, str], ...]) -> Optional["re.Pattern"]:
+    """One alternation of every find string, longest first so "Acme Corp" wins over "Acme" at the same position"""
+    finds = sorted({find for find, _ in items if find}, key=lambda find: (-len(find), find))
+    return re.compile("|".join(re.escape(find) for find in finds)) if finds else None
+
+def text_matcher(text_map: Optional[Dict[str, str]]) -> Optional["re.Pattern"]:
+    return text_pattern(tuple(sorted(text_map.items()))) if text_map else None
+
+def text_splice(texts: List[str], matches: List[Tuple[int, int, str]]) -> List[str]:
+    """New run texts for non-overlapping (start, end, replacement) matches over the joined texts"""
+    out: List[str] = []
+    offset = 0
+    mi = 0
+    for text in texts:
+        start, end = offset, offset + len(text)
+        pieces = []
+        pos = start
+        while pos < end:
+            while mi < len(matches) and matches[mi][1] <= pos:
+                mi += 1
+            if mi < len(matches) and matches[mi][0] < end:
+                m_start, m_end, replacement = matches[mi]
+                if m_start > pos:
+                    pieces.append(text[pos - start:m_start - start])
+                    pos = m_start
+                if m_start == pos:
+                    pieces.append(replacement)
+                # Characters of the match in this run are dropped; later runs drop theirs the same way
+                pos = min(m_end, end)
+            else:
+                pieces.append(text[pos - start:])
+                pos = end
+        out.append("".join(pieces))
+        offset = end
+    return out
+
+def text_replace_runs(runs: List[Any], text_map: Dict[str, str], pattern: Optional["re.Pattern"], report: Optional[ChangeReport] = None, scope: str = "") -> int:
+    """Replace across runs whose .text can be read and set (python-docx and python-pptx runs); returns the match count"""
+    if pattern is None or not runs:
+        return 0
+    texts = [run.text for run in runs]
+    matches = [(m.start(), m.end(), text_map[m.group(0)]) for m in pattern.finditer("".join(texts))]
+    if not matches:
+        return 0
+    if report is not None:
+        report.record(scope, "text", len(matches))
+        return 0
+    for run, old, new in zip(runs, texts, text_splice(texts, matches)):
+        if new != old:
+            run.text = new
+    return len(matches)
+
 
 # DOCX functions
 def docx_extract_deep_formatting(element, text_colors: Set[str], shape_colors: Set[str], fonts: Set[str]):
@@ -280,24 +944,24 @@ def docx_extract_deep_formatting(element, text_colors: Set[str], shape_colors: S
             # Text colors
             color_elems = run.xpath('.//w:color', namespaces=run.nsmap if hasattr(run, 'nsmap') else {})
             for color_elem in color_elems:
-                color_val = color_elem.get(qn('w:val'))
-                if color_val and color_val != "auto" and len(color_val) >= 6:
-                    text_colors.add("#" + color_val[:6].upper())
+                hexv = color_hex(color_elem.get(qn('w:val')))
+                if hexv:
+                    text_colors.add(hexv)
         
         # Check shading and fills
         shd_elems = element.xpath('.//w:shd', namespaces=element.nsmap if hasattr(element, 'nsmap') else {})
         for shd in shd_elems:
-            fill_val = shd.get(qn('w:fill'))
-            if fill_val and fill_val != "auto" and len(fill_val) >= 6:
-                shape_colors.add("#" + fill_val[:6].upper())
+            hexv = color_hex(shd.get(qn('w:fill')))
+            if hexv:
+                shape_colors.add(hexv)
         
         # Check borders
         border_elems = element.xpath('.//w:*[contains(local-name(), "Border")]/*', 
                                    namespaces=element.nsmap if hasattr(element, 'nsmap') else {})
         for border in border_elems:
-            color_val = border.get(qn('w:color'))
-            if color_val and color_val.lower() not in ("auto", "none") and len(color_val) >= 6:
-                shape_colors.add("#" + color_val[:6].upper())
+            hexv = color_hex(border.get(qn('w:color')))
+            if hexv:
+                shape_colors.add(hexv)
                 
     except Exception:
         pass
@@ -342,114 +1006,147 @@ def docx_extract(file_bytes: bytes):
                         docx_extract_deep_formatting(paragraph._element, text_colors, shape_colors, fonts)
                     shd_elems = cell._tc.xpath('.//w:shd')
                     for shd in shd_elems:
-                        fill_val = shd.get(qn('w:fill'))
-                        if fill_val and fill_val != "auto":
-                            shape_colors.add("#" + fill_val.upper())
+                        hexv = color_hex(shd.get(qn('w:fill')))
+                        if hexv:
+                            shape_colors.add(hexv)
                     borders = cell._tc.xpath('.//w:tcBorders/*')
                     for b in borders:
-                        col = b.get(qn('w:color'))
-                        if col and col.lower() not in ("auto", "none"):
-                            if len(col) == 3:
-                                col = "".join([ch*2 for ch in col])
-                            if len(col) == 6:
-                                shape_colors.add("#" + col.upper())
+                        hexv = color_hex(b.get(qn('w:color')))
+                        if hexv:
+                            shape_colors.add(hexv)
     except Exception:
         pass
 
-    images: List[Dict] = []
+    images: List[ImageRecord] = []
     try:
-        zf = zipfile.ZipFile(io.BytesIO(file_bytes), 'r')
-        for name in zf.namelist():
+        source = PackageSource(file_bytes)
+        shape_colors |= svg_media_colors(source)
+        names = source.names()
+        for name in names:
             if name.startswith("word/media/"):
-                data = zf.read(name)
-                images.append({"name": name.split("/")[-1], "path": name, "media_path": name, "uid": name, "bytes": data, "group": "Document"})
-        for name in zf.namelist():
+                images.append(ImageRecord(name, name.split("/")[-1], "Document", media_path=name, handle=source.handle(name)))
+        for name in names:
             if "embeddings" in name or "oleObject" in name:
-                try:
-                    data = zf.read(name)
-                    images.append({"name": f"Embedded: {name.split('/')[-1]}", "path": name, "media_path": name, "uid": f"embed_{name}", "bytes": data, "group": "Embedded Objects"})
-                except Exception:
-                    pass
-        zf.close()
+                images.append(ImageRecord(f"embed_{name}", f"Embedded: {name.split('/')[-1]}", "Embedded Objects", kind="embedded", media_path=name, handle=source.handle(name)))
     except Exception:
         pass
 
     return {"document": doc, "text_colors": sorted(list(text_colors)), "shape_colors": sorted(list(shape_colors)), "background_colors": sorted(list(background_colors)), "fonts": sorted(list(fonts)), "images": images}
 
-def docx_apply_updates(extracted, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes]) -> bytes:
-    doc: DocxDocument = extracted["document"]
+def docx_update_body(doc: "DocxDocument", color_map: Dict[str, str], font_map: Dict[str, str], report: Optional[ChangeReport] = None, text_map: Optional[Dict[str, str]] = None) -> None:
+    pattern = text_matcher(text_map)
     for p in doc.paragraphs:
-        for r in p.runs:
+        runs = p.runs
+        telemetry_count("docx_update_body", "run", "visited", len(runs))
+        for r in runs:
             try:
                 current_font = r.font.name
-                if current_font and current_font in font_map and font_map[current_font]:
+                if current_font and current_font in font_map and font_map[current_font] and apply_change(report, "Body", "fonts"):
                     r.font.name = font_map[current_font]
-            except Exception:
-                pass
+                    telemetry_count("docx_update_body", "run_font", "rewritten")
+            except Exception as e:
+                telemetry_skip("docx_update_body", "run_font", e)
             try:
                 c = r.font.color.rgb
                 curr_hex = rgbcolor_to_hex(c)
-                if curr_hex and curr_hex in color_map and color_map[curr_hex]:
+                if curr_hex and curr_hex in color_map and color_map[curr_hex] and apply_change(report, "Body", "text colors"):
                     r.font.color.rgb = RGBColor.from_string(hex_no_hash(color_map[curr_hex]))
-            except Exception:
-                pass
+                    telemetry_count("docx_update_body", "run_color", "rewritten")
+            except Exception as e:
+                telemetry_skip("docx_update_body", "run_color", e)
+        docx_replace_paragraph_text(p, text_map, pattern, report, "Body")
 
     try:
+        seen_cells: Set[Any] = set()
         for table in doc.tables:
             for row in table.rows:
                 for cell in row.cells:
+                    telemetry_count("docx_update_body", "table_cell", "visited")
+                    # Merged cells come back once per grid position; their text must only be replaced once
+                    if pattern is not None and cell._tc not in seen_cells:
+                        seen_cells.add(cell._tc)
+                        for p in cell.paragraphs:
+                            docx_replace_paragraph_text(p, text_map, pattern, report, "Tables")
                     shd_elems = cell._tc.xpath('.//w:shd')
                     for shd in shd_elems:
-                        fill_val = shd.get(qn('w:fill'))
-                        if fill_val and fill_val != "auto":
-                            curr_hex = "#" + fill_val.upper()
-                            if curr_hex in color_map and color_map[curr_hex]:
-                                tcPr = cell._tc.get_or_add_tcPr()
-                                new_shd = OxmlElement('w:shd')
-                                new_shd.set(qn('w:fill'), hex_no_hash(color_map[curr_hex]))
-                                try:
-                                    for old in shd_elems:
-                                        tcPr.remove(old)
-                                except Exception:
-                                    pass
-                                tcPr.append(new_shd)
+                        curr_hex = color_hex(shd.get(qn('w:fill')))
+                        if curr_hex and curr_hex in color_map and color_map[curr_hex] and apply_change(report, "Tables", "fills", key=shd):
+                            tcPr = cell._tc.get_or_add_tcPr()
+                            new_shd = OxmlElement('w:shd')
+                            new_shd.set(qn('w:fill'), hex_no_hash(color_map[curr_hex]))
+                            try:
+                                for old in shd_elems:
+                                    tcPr.remove(old)
+                            except Exception as e:
+                                telemetry_skip("docx_update_body", "table_cell_shading", e)
+                            tcPr.append(new_shd)
+                            telemetry_count("docx_update_body", "table_cell_shading", "rewritten")
                     borders = cell._tc.xpath('.//w:tcBorders/*')
                     for b in borders:
-                        col = b.get(qn('w:color'))
-                        if col and col.lower() not in ("auto", "none"):
-                            if len(col) == 3:
-                                col_hex = "#" + "".join([ch*2 for ch in col]).upper()
-                            else:
-                                col_hex = "#" + col.upper()
-                            if col_hex in color_map and color_map[col_hex]:
-                                b.set(qn('w:color'), hex_no_hash(color_map[col_hex]))
-    except Exception:
-        pass
+                        col_hex = color_hex(b.get(qn('w:color')))
+                        if col_hex and col_hex in color_map and color_map[col_hex] and apply_change(report, "Tables", "borders", key=b):
+                            b.set(qn('w:color'), hex_no_hash(color_map[col_hex]))
+                            telemetry_count("docx_update_body", "table_cell_border", "rewritten")
+    except Exception as e:
+        telemetry_skip("docx_update_body", "tables", e)
+
+def docx_replace_paragraph_text(paragraph, text_map: Optional[Dict[str, str]], pattern: Optional["re.Pattern"], report: Optional[ChangeReport] = None, scope: str = "") -> None:
+    if pattern is None:
+        return
+    try:
+        replaced = text_replace_runs(paragraph.runs, text_map, pattern, report, scope)
+        if replaced:
+            telemetry_count("docx_update_body", "text", "rewritten", replaced)
+    except Exception as e:
+        telemetry_skip("docx_update_body", "text", e)
+
+def docx_media_replacements(image_replacements: Dict[str, bytes], only: Optional[Set[str]] = None) -> Dict[str, bytes]:
+    repls: Dict[str, bytes] = {}
+    for name, data in image_replacements.items():
+        if name.startswith("word/media/") and (only is None or name in only):
+            repls[name] = convert_image_bytes_to_ext(data, os.path.splitext(name)[1])
+    return repls
+
+def docx_apply_updates(extracted, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], sink=None, policy: Optional[Dict[str, Any]] = None, text_map: Optional[Dict[str, str]] = None) -> Optional[bytes]:
+    """With a sink the document is written there and None is returned"""
+    doc: DocxDocument = extracted["document"]
+    docx_update_body(doc, color_map, font_map, text_map=text_map)
 
+    media_repls = docx_media_replacements(image_replacements) if image_replacements else {}
+    if sink is not None and not media_repls:
+        doc.save(sink)
+        return None
     out_buf = io.BytesIO()
     doc.save(out_buf)
-    out_bytes = out_buf.getvalue()
+    return zip_replace_media(out_buf.getvalue(), media_repls, sink, policy)
 
-    if image_replacements:
-        try:
-            in_zip = zipfile.ZipFile(io.BytesIO(out_bytes), 'r')
-            out_mem = io.BytesIO()
-            out_zip = zipfile.ZipFile(out_mem, 'w', zipfile.ZIP_DEFLATED)
-            for name in in_zip.namelist():
-                data = in_zip.read(name)
-                if name in image_replacements and name.startswith("word/media/"):
-                    target_ext = os.path.splitext(name)[1]
-                    data = convert_image_bytes_to_ext(image_replacements[name], target_ext)
-                out_zip.writestr(name, data)
-            in_zip.close()
-            out_zip.close()
-            out_bytes = out_mem.getvalue()
-        except Exception:
-            pass
-    return out_bytes
+def docx_incremental_members(file_bytes: bytes, changed_keys: Set[str], changed_uids: Set[str], color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes]) -> Dict[str, bytes]:
+    """The body part and the media whose replacement changed; everything else is reused from the last output"""
+    members: Dict[str, bytes] = {}
+    if changed_keys:
+        doc = DocxDocument(io.BytesIO(file_bytes))
+        docx_update_body(doc, color_map, font_map)
+        members[str(doc.part.partname).lstrip("/")] = doc.part.blob
+
+    affected_media = {uid for uid in changed_uids if uid.startswith("word/media/")}
+    if affected_media:
+        members.update(docx_media_replacements(image_replacements, only=affected_media))
+        members.update(zip_read_members(file_bytes, affected_media - set(members)))
+    return members
 
 
 # PPTX helper functions
+def pptx_related_part(part, r_id: Optional[str]):
+    """Resolve a relationship target across python-pptx versions (1.0 dropped `related_parts`)"""
+    if part is None or not r_id:
+        return None
+    try:
+        if hasattr(part, "related_part"):
+            return part.related_part(r_id)
+        return part.related_parts[r_id]
+    except Exception:
+        return None
+
 def pptx_get_background_image(slide_or_layout_or_master):
     try:
         bg_elm = slide_or_layout_or_master.background._element
@@ -457,7 +1154,7 @@ def pptx_get_background_image(slide_or_layout_or_master):
         if blips:
             r_id = blips[0].get(pptx_qn('r:embed'))
             if r_id:
-                part = slide_or_layout_or_master.part.related_parts[r_id]
+                part = pptx_related_part(slide_or_layout_or_master.part, r_id)
                 return part.blob, r_id, part
     except Exception:
         pass
@@ -470,19 +1167,38 @@ def pptx_get_shape_fill_picture(shape):
             if blip is not None:
                 r_id = blip.get(pptx_qn('r:embed'))
                 if r_id:
-                    part = shape.part.related_parts[r_id]
+                    part = pptx_related_part(shape.part, r_id)
                     return part.blob, r_id, part
     except Exception:
         pass
     return None, None, None
 
+def pptx_own_background_fill(slide):
+    # python-pptx adds an empty <p:bg> on first access, which would stop the slide inheriting its layout background
+    try:
+        if slide._element.cSld.bg is None:
+            return None
+        return slide.background.fill
+    except Exception:
+        return None
+
+def pptx_has_own_line(shape) -> bool:
+    # Likewise shape.line adds an empty <a:ln/>; shapes without one have no line color of their own
+    try:
+        return bool(shape._element.xpath("./p:spPr/a:ln"))
+    except Exception:
+        return False
+
 def pptx_get_line_hex(shape) -> Optional[str]:
     try:
+        if not pptx_has_own_line(shape):
+            return None
         ln = shape.line
         if ln is None:
             return None
         try:
-            if ln.fill is None or ln.fill.type in (None, MSO_FILL.BACKGROUND):
+            # LineFormat.color would also turn a gradient outline solid
+            if ln.fill is None or ln.fill.type != MSO_FILL.SOLID:
                 return None
         except Exception:
             pass
@@ -509,7 +1225,7 @@ def pptx_set_line_hex(shape, new_hex: str):
         if ln is None:
             return
         try:
-            if ln.fill is None or ln.fill.type in (None, MSO_FILL.BACKGROUND):
+            if ln.fill is None or ln.fill.type != MSO_FILL.SOLID:
                 return
         except Exception:
             pass
@@ -530,6 +1246,21 @@ def pptx_set_line_hex(shape, new_hex: str):
     except Exception:
         pass
 
+def pptx_paragraph_font(paragraph):
+    # paragraph.font and run.font add empty <a:pPr><a:defRPr/> and <a:rPr/> elements when they are missing
+    pPr = paragraph._p.pPr
+    return paragraph.font if pPr is not None and pPr.defRPr is not None else None
+
+def pptx_run_font(run):
+    return run.font if run._r.rPr is not None else None
+
+def pptx_font_color(font):
+    # Font.color turns any other fill into an empty <a:solidFill/>; only solid fills carry a color to map
+    try:
+        return font.color if font.fill.type == MSO_FILL.SOLID else None
+    except Exception:
+        return None
+
 def pptx_extract_text_formatting(text_frame, text_colors: Set[str], fonts: Set[str]):
     """Extract all text formatting including default colors and fonts"""
     try:
@@ -537,76 +1268,97 @@ def pptx_extract_text_formatting(text_frame, text_colors: Set[str], fonts: Set[s
         for paragraph in text_frame.paragraphs:
             # Paragraph-level font
             try:
-                pf = paragraph.font
+                pf = pptx_paragraph_font(paragraph)
                 if pf:
                     if pf.name:
                         fonts.add(pf.name)
                     # Try to get color
-                    if pf.color:
+                    if pptx_font_color(pf):
                         hexv = extract_color_from_pptx_color_obj(pf.color)
                         if hexv:
                             text_colors.add(hexv)
-            except Exception:
-                pass
+            except Exception as e:
+                telemetry_skip("pptx_extract_text", "paragraph_font", e)
             
             # Run-level formatting
             for run in paragraph.runs:
                 try:
-                    rf = run.font
+                    rf = pptx_run_font(run)
                     if rf:
                         if rf.name:
                             fonts.add(rf.name)
                         # Try to get color
-                        if rf.color:
+                        if pptx_font_color(rf):
                             hexv = extract_color_from_pptx_color_obj(rf.color)
                             if hexv:
                                 text_colors.add(hexv)
-                except Exception:
-                    pass
+                except Exception as e:
+                    telemetry_skip("pptx_extract_text", "run_font", e)
                     
-    except Exception:
-        pass
+    except Exception as e:
+        telemetry_skip("pptx_extract_text", "text_frame", e)
 
-def pptx_update_text_formatting(text_frame, color_map: Dict[str, str], font_map: Dict[str, str]):
-    """Update all text formatting including paragraphs and runs"""
+def pptx_update_text_formatting(text_frame, color_map: Dict[str, str], font_map: Dict[str, str], report: Optional[ChangeReport] = None, scope: str = "", text_map: Optional[Dict[str, str]] = None):
+    """Update all text formatting including paragraphs and runs, then replace brand text when text_map is given"""
+    pattern = text_matcher(text_map)
     try:
         for paragraph in text_frame.paragraphs:
             # Update paragraph-level font
             try:
-                pf = paragraph.font
+                pf = pptx_paragraph_font(paragraph)
                 if pf:
-                    if pf.name and pf.name in font_map and font_map[pf.name]:
+                    if pf.name and pf.name in font_map and font_map[pf.name] and apply_change(report, scope, "fonts", key=(paragraph._p, "font")):
                         pf.name = font_map[pf.name]
-                    if pf.color:
+                    if pptx_font_color(pf):
                         curr_hex = extract_color_from_pptx_color_obj(pf.color)
-                        if curr_hex and curr_hex in color_map and color_map[curr_hex]:
+                        if curr_hex and curr_hex in color_map and color_map[curr_hex] and apply_change(report, scope, "text colors", key=(paragraph._p, "color")):
                             pf.color.rgb = PPTX_RGBColor.from_string(hex_no_hash(color_map[curr_hex]))
-            except Exception:
-                pass
+            except Exception as e:
+                telemetry_skip("pptx_update_text", "paragraph_font", e)
             
             # Update run-level formatting
             for run in paragraph.runs:
                 try:
-                    rf = run.font
+                    rf = pptx_run_font(run)
                     if rf:
-                        if rf.name and rf.name in font_map and font_map[rf.name]:
+                        if rf.name and rf.name in font_map and font_map[rf.name] and apply_change(report, scope, "fonts", key=(run._r, "font")):
                             rf.name = font_map[rf.name]
-                        if rf.color:
+                        if pptx_font_color(rf):
                             curr_hex = extract_color_from_pptx_color_obj(rf.color)
-                            if curr_hex and curr_hex in color_map and color_map[curr_hex]:
+                            if curr_hex and curr_hex in color_map and color_map[curr_hex] and apply_change(report, scope, "text colors", key=(run._r, "color")):
                                 rf.color.rgb = PPTX_RGBColor.from_string(hex_no_hash(color_map[curr_hex]))
-                except Exception:
-                    pass
-    except Exception:
-        pass
+                except Exception as e:
+                    telemetry_skip("pptx_update_text", "run_font", e)
+            if pattern is not None:
+                pptx_replace_paragraph_text(paragraph, text_map, pattern, report, scope)
+    except Exception as e:
+        telemetry_skip("pptx_update_text", "text_frame", e)
+
+def pptx_replace_paragraph_text(paragraph, text_map: Dict[str, str], pattern: "re.Pattern", report: Optional[ChangeReport] = None, scope: str = "") -> None:
+    # Line breaks and fields sit between runs, not inside one: text on either side of them is matched separately
+    neighbours = (pptx_qn("a:r"), pptx_qn("a:pPr"))
+    segments: List[List[Any]] = [[]]
+    for run in paragraph.runs:
+        previous = run._r.getprevious()
+        if previous is not None and previous.tag not in neighbours and segments[-1]:
+            segments.append([])
+        segments[-1].append(run)
+    for runs in segments:
+        try:
+            replaced = text_replace_runs(runs, text_map, pattern, report, scope)
+            if replaced:
+                telemetry_count("pptx_update_text", "text", "rewritten", replaced)
+        except Exception as e:
+            telemetry_skip("pptx_update_text", "text", e)
 
-def pptx_process_shape_recursive(shape, slide_idx: int, path: str, text_colors: Set[str], shape_colors: Set[str], fonts: Set[str], images: List[Dict], depth: int = 0) -> None:
+def pptx_process_shape_recursive(shape, slide_idx: int, path: str, text_colors: Set[str], shape_colors: Set[str], fonts: Set[str], images: List[ImageRecord], depth: int = 0) -> None:
     """Recursively process all shape types including nested groups"""
     if depth > 10:
         return
     
     try:
         shape_type = shape.shape_type
+        telemetry_count("pptx_process_shape", "shape", "visited")
         shape_name = getattr(shape, 'name', f'Shape_{path}')
         
         # CRITICAL: Process ALL shapes with text_frame, not just those with has_text_frame
@@ -614,24 +1366,24 @@ def pptx_process_shape_recursive(shape, slide_idx: int, path: str, text_colors:
         try:
             if hasattr(shape, "text_frame") and shape.text_frame is not None:
                 pptx_extract_text_formatting(shape.text_frame, text_colors, fonts)
-        except Exception:
-            pass
+        except Exception as e:
+            telemetry_skip("pptx_process_shape", "text_frame", e)
         
         # Also check the traditional way
         if hasattr(shape, "has_text_frame"):
             try:
                 if shape.has_text_frame and shape.text_frame is not None:
                     pptx_extract_text_formatting(shape.text_frame, text_colors, fonts)
-            except Exception:
-                pass
+            except Exception as e:
+                telemetry_skip("pptx_process_shape", "has_text_frame", e)
 
         # Process title and placeholders explicitly
         if hasattr(shape, "is_placeholder"):
             try:
                 if shape.is_placeholder and hasattr(shape, "text_frame") and shape.text_frame:
                     pptx_extract_text_formatting(shape.text_frame, text_colors, fonts)
-            except Exception:
-                pass
+            except Exception as e:
+                telemetry_skip("pptx_process_shape", "placeholder", e)
 
         # Tables
         if hasattr(shape, "has_table") and shape.has_table:
@@ -646,8 +1398,8 @@ def pptx_process_shape_recursive(shape, slide_idx: int, path: str, text_colors:
                             tf = cell.text_frame
                             if tf:
                                 pptx_extract_text_formatting(tf, text_colors, fonts)
-                        except Exception:
-                            pass
+                        except Exception as e:
+                            telemetry_skip("pptx_process_shape", "table_cell_text", e)
                         
                         try:
                             cell_fill = cell.fill
@@ -655,35 +1407,40 @@ def pptx_process_shape_recursive(shape, slide_idx: int, path: str, text_colors:
                                 hexv = extract_color_from_pptx_color_obj(cell_fill.fore_color)
                                 if hexv:
                                     shape_colors.add(hexv)
-                        except Exception:
-                            pass
+                                    telemetry_count("pptx_process_shape", "table_cell_fill", "matched")
+                        except Exception as e:
+                            telemetry_skip("pptx_process_shape", "table_cell_fill", e)
                         try:
                             if cell.fill and cell.fill.type == MSO_FILL.PICTURE:
                                 blip = cell.fill._fill.blipFill.blip
                                 if blip is not None:
                                     r_id = blip.get(pptx_qn('r:embed'))
                                     if r_id:
-                                        part = cell._tc.part.related_parts[r_id]
-                                        blob = part.blob
-                                        images.append({"name": f"Slide {slide_idx+1} Table Cell Picture ({cell_path})", "bytes": blob, "uid": f"pptx_fill_{slide_idx}_{cell_path}", "group": f"Slide {slide_idx+1}", "kind": "cell_fill", "rel_id": r_id, "media_path": str(part.partname).lstrip("/") if part else None})
-                        except Exception:
-                            pass
-            except Exception:
-                pass
+                                        part = pptx_related_part(cell.part, r_id)
+                                        if part is not None:
+                                            telemetry_count("pptx_process_shape", "table_cell_picture", "matched")
+                                            images.append(ImageRecord(f"pptx_fill_{slide_idx}_{cell_path}", f"Slide {slide_idx+1} Table Cell Picture ({cell_path})", f"Slide {slide_idx+1}", kind="cell_fill", rel_id=r_id, media_path=str(part.partname).lstrip("/")))
+                        except Exception as e:
+                            telemetry_skip("pptx_process_shape", "table_cell_picture", e)
+            except Exception as e:
+                telemetry_skip("pptx_process_shape", "table", e)
 
         # Fill colors
         if hasattr(shape, "fill"):
             try:
                 fill = shape.fill
                 if fill:
+                    telemetry_count("pptx_process_shape", "fill", "visited")
                     if fill.type == MSO_FILL.SOLID:
                         hexv = extract_color_from_pptx_color_obj(fill.fore_color)
                         if hexv:
                             shape_colors.add(hexv)
+                            telemetry_count("pptx_process_shape", "fill", "matched")
                     elif fill.type == MSO_FILL.PICTURE:
                         blob, r_id, part = pptx_get_shape_fill_picture(shape)
                         if blob:
-                            images.append({"name": f"Slide {slide_idx+1} Shape Fill Picture ({shape_name})", "bytes": blob, "uid": f"pptx_fill_{slide_idx}_{path}", "group": f"Slide {slide_idx+1}", "kind": "shape_fill", "rel_id": r_id, "media_path": str(part.partname).lstrip("/") if part else None})
+                            telemetry_count("pptx_process_shape", "fill_picture", "matched")
+                            images.append(ImageRecord(f"pptx_fill_{slide_idx}_{path}", f"Slide {slide_idx+1} Shape Fill Picture ({shape_name})", f"Slide {slide_idx+1}", kind="shape_fill", rel_id=r_id, media_path=str(part.partname).lstrip("/")))
                     elif fill.type == MSO_FILL.GRADIENT:
                         try:
                             gradient = fill.gradient_stops
@@ -691,8 +1448,8 @@ def pptx_process_shape_recursive(shape, slide_idx: int, path: str, text_colors:
                                 hexv = extract_color_from_pptx_color_obj(stop.color)
                                 if hexv:
                                     shape_colors.add(hexv)
-                        except Exception:
-                            pass
+                        except Exception as e:
+                            telemetry_skip("pptx_process_shape", "fill_gradient", e)
                     elif fill.type == MSO_FILL.PATTERNED:
                         try:
                             hexv = extract_color_from_pptx_color_obj(fill.fore_color)
@@ -701,30 +1458,31 @@ def pptx_process_shape_recursive(shape, slide_idx: int, path: str, text_colors:
                             hexv = extract_color_from_pptx_color_obj(fill.back_color)
                             if hexv:
                                 shape_colors.add(hexv)
-                        except Exception:
-                            pass
-            except Exception:
-                pass
+                        except Exception as e:
+                            telemetry_skip("pptx_process_shape", "fill_pattern", e)
+            except Exception as e:
+                telemetry_skip("pptx_process_shape", "fill", e)
 
         # Line colors
         try:
             line_hex = pptx_get_line_hex(shape)
             if line_hex:
                 shape_colors.add(line_hex)
-        except Exception:
-            pass
+                telemetry_count("pptx_process_shape", "line", "matched")
+        except Exception as e:
+            telemetry_skip("pptx_process_shape", "line", e)
 
         # Picture shapes
         if shape_type == MSO_SHAPE_TYPE.PICTURE:
             try:
-                blob = shape.image.blob
-                fname = getattr(shape.image, 'filename', 'image')
                 r_id = shape._element.blipFill.blip.get(pptx_qn('r:embed'))
-                part = shape.part.related_parts.get(r_id)
-                media_path = str(part.partname).lstrip("/") if part is not None else None
-                images.append({"name": f"Slide {slide_idx+1} Picture ({fname})", "bytes": blob, "uid": f"pptx_{slide_idx}_{path}", "group": f"Slide {slide_idx+1}", "kind": "shape_picture", "filename": fname, "media_path": media_path})
-            except Exception:
-                pass
+                part = pptx_related_part(shape.part, r_id)
+                if part is not None:
+                    telemetry_count("pptx_process_shape", "picture", "matched")
+                    fname = part.partname.filename
+                    images.append(ImageRecord(f"pptx_{slide_idx}_{path}", f"Slide {slide_idx+1} Picture ({fname})", f"Slide {slide_idx+1}", kind="shape_picture", rel_id=r_id, media_path=str(part.partname).lstrip("/")))
+            except Exception as e:
+                telemetry_skip("pptx_process_shape", "picture", e)
 
         # Recursive group processing
         if shape_type == MSO_SHAPE_TYPE.GROUP:
@@ -732,43 +1490,46 @@ def pptx_process_shape_recursive(shape, slide_idx: int, path: str, text_colors:
                 for sub_idx, sub_shape in enumerate(shape.shapes):
                     sub_path = f"{path}_g{sub_idx}"
                     pptx_process_shape_recursive(sub_shape, slide_idx, sub_path, text_colors, shape_colors, fonts, images, depth + 1)
-            except Exception:
-                pass
+            except Exception as e:
+                telemetry_skip("pptx_process_shape", "group", e)
                 
-    except Exception:
-        pass
+    except Exception as e:
+        telemetry_skip("pptx_process_shape", "shape", e)
 
-def pptx_update_shape_recursive(shape, slide_idx: int, path: str, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], depth: int = 0) -> None:
+def pptx_update_shape_recursive(shape, slide_idx: int, path: str, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], depth: int = 0, report: Optional[ChangeReport] = None, text_map: Optional[Dict[str, str]] = None) -> None:
     """Recursively update all shape types including nested groups"""
     if depth > 10:
         return
+    scope = f"Slide {slide_idx+1}"
     
     try:
         shape_type = shape.shape_type
+        telemetry_count("pptx_update_shape", "shape", "visited")
         
         # CRITICAL: Update ALL shapes with text_frame, not just those with has_text_frame
         # This catches text boxes, shapes with text, and all other text containers
         try:
             if hasattr(shape, "text_frame") and shape.text_frame is not None:
-                pptx_update_text_formatting(shape.text_frame, color_map, font_map)
-        except Exception:
-            pass
+                # Text is replaced here only: the branches below reach the same frame and would replace it again
+                pptx_update_text_formatting(shape.text_frame, color_map, font_map, report, scope, text_map)
+        except Exception as e:
+            telemetry_skip("pptx_update_shape", "text_frame", e)
         
         # Also check the traditional way
         if hasattr(shape, "has_text_frame"):
             try:
                 if shape.has_text_frame and shape.text_frame is not None:
-                    pptx_update_text_formatting(shape.text_frame, color_map, font_map)
-            except Exception:
-                pass
+                    pptx_update_text_formatting(shape.text_frame, color_map, font_map, report, scope)
+            except Exception as e:
+                telemetry_skip("pptx_update_shape", "has_text_frame", e)
 
         # Update title and placeholders explicitly
         if hasattr(shape, "is_placeholder"):
             try:
                 if shape.is_placeholder and hasattr(shape, "text_frame") and shape.text_frame:
-                    pptx_update_text_formatting(shape.text_frame, color_map, font_map)
-            except Exception:
-                pass
+                    pptx_update_text_formatting(shape.text_frame, color_map, font_map, report, scope)
+            except Exception as e:
+                telemetry_skip("pptx_update_shape", "placeholder", e)
 
         # Update tables
         if hasattr(shape, "has_table") and shape.has_table:
@@ -781,130 +1542,423 @@ def pptx_update_shape_recursive(shape, slide_idx: int, path: str, color_map: Dic
                         try:
                             tf = cell.text_frame
                             if tf:
-                                pptx_update_text_formatting(tf, color_map, font_map)
-                        except Exception:
-                            pass
+                                pptx_update_text_formatting(tf, color_map, font_map, report, scope, text_map)
+                        except Exception as e:
+                            telemetry_skip("pptx_update_shape", "table_cell_text", e)
                         
                         try:
                             cell_fill = cell.fill
                             if cell_fill and cell_fill.type == MSO_FILL.SOLID:
                                 curr_hex = extract_color_from_pptx_color_obj(cell_fill.fore_color)
-                                if curr_hex and curr_hex in color_map and color_map[curr_hex]:
+                                if curr_hex and curr_hex in color_map and color_map[curr_hex] and apply_change(report, scope, "fills"):
                                     cell_fill.solid()
                                     cell_fill.fore_color.rgb = PPTX_RGBColor.from_string(hex_no_hash(color_map[curr_hex]))
-                        except Exception:
-                            pass
+                                    telemetry_count("pptx_update_shape", "table_cell_fill", "rewritten")
+                        except Exception as e:
+                            telemetry_skip("pptx_update_shape", "table_cell_fill", e)
                         try:
                             uid_cell = f"pptx_fill_{slide_idx}_{cell_path}"
-                            if uid_cell in image_replacements and cell.fill and cell.fill.type == MSO_FILL.PICTURE:
+                            if uid_cell in image_replacements and cell.fill and cell.fill.type == MSO_FILL.PICTURE and apply_change(report, scope, "media"):
                                 blip = cell.fill._fill.blipFill.blip
                                 if blip is not None:
                                     r_id = blip.get(pptx_qn('r:embed'))
                                     if r_id:
-                                        part = cell._tc.part.related_parts[r_id]
+                                        part = pptx_related_part(cell.part, r_id)
                                         ext = os.path.splitext(str(part.partname))[-1] if hasattr(part, "partname") else ".png"
                                         part.blob = convert_image_bytes_to_ext(image_replacements[uid_cell], ext)
-                        except Exception:
-                            pass
-            except Exception:
-                pass
+                                        telemetry_count("pptx_update_shape", "table_cell_picture", "rewritten")
+                        except Exception as e:
+                            telemetry_skip("pptx_update_shape", "table_cell_picture", e)
+            except Exception as e:
+                telemetry_skip("pptx_update_shape", "table", e)
 
         # Update fills
         if hasattr(shape, "fill"):
             try:
                 fill = shape.fill
                 if fill and fill.type == MSO_FILL.SOLID:
+                    telemetry_count("pptx_update_shape", "fill", "visited")
                     curr_hex = extract_color_from_pptx_color_obj(fill.fore_color)
-                    if curr_hex and curr_hex in color_map and color_map[curr_hex]:
+                    if curr_hex and curr_hex in color_map and color_map[curr_hex] and apply_change(report, scope, "fills"):
                         fill.solid()
                         fill.fore_color.rgb = PPTX_RGBColor.from_string(hex_no_hash(color_map[curr_hex]))
-            except Exception:
-                pass
+                        telemetry_count("pptx_update_shape", "fill", "rewritten")
+            except Exception as e:
+                telemetry_skip("pptx_update_shape", "fill", e)
 
         # Update lines
         try:
             line_hex = pptx_get_line_hex(shape)
-            if line_hex and line_hex in color_map:
+            if line_hex and line_hex in color_map and apply_change(report, scope, "lines"):
                 pptx_set_line_hex(shape, color_map[line_hex])
-        except Exception:
-            pass
+                telemetry_count("pptx_update_shape", "line", "rewritten")
+        except Exception as e:
+            telemetry_skip("pptx_update_shape", "line", e)
 
         # Update pictures
         if shape_type == MSO_SHAPE_TYPE.PICTURE:
             try:
                 uid = f"pptx_{slide_idx}_{path}"
-                if uid in image_replacements:
+                if uid in image_replacements and apply_change(report, scope, "media"):
                     r_id = shape._element.blipFill.blip.get(pptx_qn('r:embed'))
-                    image_part = shape.part.related_parts[r_id]
+                    image_part = pptx_related_part(shape.part, r_id)
                     ext = os.path.splitext(getattr(shape.image, "filename", "image.png"))[-1] or ".png"
                     image_part.blob = convert_image_bytes_to_ext(image_replacements[uid], ext)
-            except Exception:
-                pass
+                    telemetry_count("pptx_update_shape", "picture", "rewritten")
+            except Exception as e:
+                telemetry_skip("pptx_update_shape", "picture", e)
 
         # Update picture fills
         try:
             uid_fill = f"pptx_fill_{slide_idx}_{path}"
-            if uid_fill in image_replacements and hasattr(shape, "fill") and shape.fill and shape.fill.type == MSO_FILL.PICTURE:
+            if uid_fill in image_replacements and hasattr(shape, "fill") and shape.fill and shape.fill.type == MSO_FILL.PICTURE and apply_change(report, scope, "media"):
                 blip = shape.fill._fill.blipFill.blip
                 if blip is not None:
                     r_id = blip.get(pptx_qn('r:embed'))
                     if r_id:
-                        part = shape.part.related_parts[r_id]
+                        part = pptx_related_part(shape.part, r_id)
                         ext = os.path.splitext(str(part.partname))[-1] if hasattr(part, "partname") else ".png"
                         part.blob = convert_image_bytes_to_ext(image_replacements[uid_fill], ext)
-        except Exception:
-            pass
+                        telemetry_count("pptx_update_shape", "picture_fill", "rewritten")
+        except Exception as e:
+            telemetry_skip("pptx_update_shape", "picture_fill", e)
 
         # Recursive group processing
         if shape_type == MSO_SHAPE_TYPE.GROUP:
             try:
                 for sub_idx, sub_shape in enumerate(shape.shapes):
                     sub_path = f"{path}_g{sub_idx}"
-                    pptx_update_shape_recursive(sub_shape, slide_idx, sub_path, color_map, font_map, image_replacements, depth + 1)
-            except Exception:
-                pass
+                    pptx_update_shape_recursive(sub_shape, slide_idx, sub_path, color_map, font_map, image_replacements, depth + 1, report, text_map)
+            except Exception as e:
+                telemetry_skip("pptx_update_shape", "group", e)
                 
+    except Exception as e:
+        telemetry_skip("pptx_update_shape", "shape", e)
+
+# Slide preview rendering
+# An approximation drawn from the XML: fills, outlines, pictures and text blocks. Rotation, effects and charts are ignored.
+PREVIEW_SCHEME_ALIASES = {"tx1": "dk1", "bg1": "lt1", "tx2": "dk2", "bg2": "lt2"}
+PREVIEW_TEXT_INSET_EMU = 91440
+PREVIEW_DEFAULT_FONT_PT = 18
+PREVIEW_TITLE_FONT_PT = 40
+PREVIEW_MIN_FONT_PX = 6
+EMU_PER_PT = 12700
+
+def pptx_theme_scheme(master) -> Dict[str, Tuple[int, int, int]]:
+    """The master's theme color scheme (dk1, lt1, accent1...) as RGB tuples"""
+    scheme: Dict[str, Tuple[int, int, int]] = {}
+    try:
+        root = ET.fromstring(master.part.part_related_by(PPTX_RT.THEME).blob)
+        clr_scheme = root.find(".//" + pptx_qn("a:clrScheme"))
+        for entry in list(clr_scheme):
+            name = entry.tag.split("}")[-1]
+            for color in entry:
+                rgb = color_rgb(color.get("val") if color.tag == pptx_qn("a:srgbClr") else color.get("lastClr"))
+                if rgb:
+                    scheme[name] = rgb
     except Exception:
         pass
+    return scheme
 
-def pptx_compose_slide_preview(prs: "Presentation", slide, width_px: int = 900) -> Optional[bytes]:
-    if not PIL_AVAILABLE:
+def preview_color(parent, scheme: Dict[str, Tuple[int, int, int]]) -> Optional[Tuple[int, int, int, int]]:
+    """RGBA of the first color child of a DrawingML element, with lumMod/lumOff/shade/tint/alpha applied"""
+    if parent is None:
         return None
-    try:
-        slide_w = int(prs.slide_width)
-        slide_h = int(prs.slide_height)
-        ratio = width_px / float(slide_w)
-        height_px = int(slide_h * ratio)
-        canvas = PILImage.new("RGBA", (width_px, height_px), (255, 255, 255, 255))
-
-        bg_blob, _, _ = pptx_get_background_image(slide)
-        if bg_blob:
-            bg_img = PILImage.open(io.BytesIO(bg_blob)).convert("RGBA")
-            bg_img = bg_img.resize((width_px, height_px))
-            canvas.paste(bg_img, (0, 0), bg_img if bg_img.mode == "RGBA" else None)
-
-        def paste_pictures(shape, offset_left_emu=0, offset_top_emu=0):
-            try:
-                if shape.shape_type == MSO_SHAPE_TYPE.PICTURE:
-                    blob = shape.image.blob
-                    pic = PILImage.open(io.BytesIO(blob)).convert("RGBA")
-                    left = int((int(shape.left) + offset_left_emu) * ratio)
-                    top = int((int(shape.top) + offset_top_emu) * ratio)
-                    w = max(1, int(int(shape.width) * ratio))
-                    h = max(1, int(int(shape.height) * ratio))
-                    pic = pic.resize((w, h))
-                    canvas.paste(pic, (left, top), pic)
-            except Exception:
-                pass
+    for color in parent:
+        tag = color.tag.split("}")[-1]
+        if tag == "srgbClr":
+            rgb = color_rgb(color.get("val"))
+        elif tag == "schemeClr":
+            name = color.get("val") or ""
+            rgb = scheme.get(PREVIEW_SCHEME_ALIASES.get(name, name))
+        elif tag == "sysClr":
+            rgb = color_rgb(color.get("lastClr"))
+        else:
+            continue
+        if rgb is None:
+            return None
+        modifiers = []
+        for mod in color:
             try:
-                if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
-                    for sub in shape.shapes:
-                        paste_pictures(sub, offset_left_emu + int(shape.left), offset_top_emu + int(shape.top))
+                modifiers.append((mod.tag.split("}")[-1], int(mod.get("val", "100000"))))
             except Exception:
-                pass
+                continue
+        return color_modified(rgb, tuple(modifiers))
+    return None
+
+def preview_fill(parent, scheme: Dict[str, Tuple[int, int, int]], style_ref=None):
+    """("solid", rgba), ("gradient", stops, angle) or None for an spPr/bgPr/tcPr; falls back to the style reference"""
+    if parent is not None:
+        if parent.find(pptx_qn("a:noFill")) is not None:
+            return None
+        solid = parent.find(pptx_qn("a:solidFill"))
+        if solid is not None:
+            color = preview_color(solid, scheme)
+            return ("solid", color) if color else None
+        grad = parent.find(pptx_qn("a:gradFill"))
+        if grad is not None:
+            stops = []
+            for gs in grad.iter(pptx_qn("a:gs")):
+                color = preview_color(gs, scheme)
+                if color:
+                    stops.append((int(gs.get("pos", "0")) / 100000.0, color))
+            lin = grad.find(pptx_qn("a:lin"))
+            angle = int(lin.get("ang", "0")) / 60000.0 if lin is not None else 90.0
+            return ("gradient", sorted(stops), angle) if stops else None
+        patt = parent.find(pptx_qn("a:pattFill"))
+        if patt is not None:
+            color = preview_color(patt.find(pptx_qn("a:fgClr")), scheme)
+            return ("solid", color) if color else None
+    if style_ref is not None and style_ref.get("idx", "0") != "0":
+        color = preview_color(style_ref, scheme)
+        return ("solid", color) if color else None
+    return None
+
+def preview_outline(sp_pr, scheme: Dict[str, Tuple[int, int, int]], style_ref, ratio: float) -> Optional[Tuple[Tuple[int, int, int, int], int]]:
+    ln = sp_pr.find(pptx_qn("a:ln")) if sp_pr is not None else None
+    if ln is not None and ln.find(pptx_qn("a:noFill")) is not None:
+        return None
+    fill = preview_fill(ln, scheme, style_ref)
+    if fill is None:
+        return None
+    color = fill[1] if fill[0] == "solid" else fill[1][0][1]
+    width_emu = int(ln.get("w", "12700")) if ln is not None else 12700
+    return color, max(1, int(width_emu * ratio))
+
+def preview_gradient(size: Tuple[int, int], stops, angle: float):
+    w, h = size
+    strip = PILImage.new("RGBA", (256, 1))
+    for x in range(256):
+        t = x / 255.0
+        lo = max((s for s in stops if s[0] <= t), default=stops[0], key=lambda s: s[0])
+        hi = min((s for s in stops if s[0] >= t), default=stops[-1], key=lambda s: s[0])
+        span = (hi[0] - lo[0]) or 1.0
+        k = min(1.0, max(0.0, (t - lo[0]) / span))
+        strip.putpixel((x, 0), tuple(int(a + (b - a) * k) for a, b in zip(lo[1], hi[1])))
+    # Only the dominant direction is kept: 0 degrees runs left to right, 90 top to bottom
+    angle = angle % 360
+    vertical = 45 <= angle < 135 or 225 <= angle < 315
+    if 135 <= angle < 315:
+        strip = strip.transpose(PILImage.FLIP_LEFT_RIGHT)
+    if vertical:
+        return strip.transpose(PILImage.ROTATE_270).resize((w, h))
+    return strip.resize((w, h))
+
+def preview_font(size_px: int, fonts: Dict[int, Any]):
+    size_px = max(PREVIEW_MIN_FONT_PX, size_px)
+    if size_px not in fonts:
+        try:
+            fonts[size_px] = PILImageFont.load_default(size=size_px)
+        except Exception:
+            fonts[size_px] = PILImageFont.load_default()
+    return fonts[size_px]
+
+def preview_draw_geometry(draw, prst: str, box: Tuple[int, int, int, int], fill=None, outline=None, width: int = 1) -> None:
+    x0, y0, x1, y1 = box
+    x1, y1 = max(x0 + 1, x1), max(y0 + 1, y1)
+    if prst == "ellipse":
+        draw.ellipse((x0, y0, x1, y1), fill=fill, outline=outline, width=width)
+    elif prst in ("roundRect", "snip1Rect", "round1Rect", "round2SameRect"):
+        draw.rounded_rectangle((x0, y0, x1, y1), radius=max(1, min(x1 - x0, y1 - y0) // 6), fill=fill, outline=outline, width=width)
+    else:
+        draw.rectangle((x0, y0, x1, y1), fill=fill, outline=outline, width=width)
+
+def preview_paint_fill(canvas, draw, fill, prst: str, box: Tuple[int, int, int, int]) -> None:
+    if fill is None:
+        return
+    if fill[0] == "solid":
+        preview_draw_geometry(draw, prst, box, fill=fill[1])
+        return
+    w, h = max(1, box[2] - box[0]), max(1, box[3] - box[1])
+    mask = PILImage.new("L", (w, h), 0)
+    preview_draw_geometry(PILImageDraw.Draw(mask), prst, (0, 0, w - 1, h - 1), fill=255)
+    canvas.paste(preview_gradient((w, h), fill[1], fill[2]), (box[0], box[1]), mask)
+
+def preview_draw_text(draw, tx_body, box: Tuple[int, int, int, int], ratio: float, scheme: Dict[str, Tuple[int, int, int]], default_color, default_pt: int, fonts: Dict[int, Any]) -> None:
+    """Wrap each paragraph into the box with its first run's size, color and alignment"""
+    if tx_body is None:
+        return
+    inset = int(PREVIEW_TEXT_INSET_EMU * ratio)
+    left, top, right, bottom = box[0] + inset, box[1] + inset // 2, box[2] - inset, box[3] - inset // 2
+    if right - left < 4:
+        return
+    body_pr = tx_body.find(pptx_qn("a:bodyPr"))
+    scale = 1.0
+    autofit = body_pr.find(pptx_qn("a:normAutofit")) if body_pr is not None else None
+    if autofit is not None and autofit.get("fontScale"):
+        scale = int(autofit.get("fontScale")) / 100000.0
+    lines = []
+    for p in tx_body.findall(pptx_qn("a:p")):
+        text = "".join(t.text or "" for t in p.iter(pptx_qn("a:t")))
+        r_pr = next(iter(p.iter(pptx_qn("a:rPr"))), None)
+        if r_pr is None:
+            r_pr = p.find(pptx_qn("a:endParaRPr"))
+        size_pt = int(r_pr.get("sz")) / 100.0 if r_pr is not None and r_pr.get("sz") else default_pt
+        color = preview_color(r_pr.find(pptx_qn("a:solidFill")), scheme) if r_pr is not None else None
+        p_pr = p.find(pptx_qn("a:pPr"))
+        align = p_pr.get("algn", "l") if p_pr is not None else "l"
+        font = preview_font(int(size_pt * scale * EMU_PER_PT * ratio), fonts)
+        line_h = int(font.size * 1.2) if hasattr(font, "size") else 12
+        words, current = text.split(), ""
+        if not words:
+            lines.append(("", font, color or default_color, align, line_h))
+            continue
+        for word in words:
+            candidate = f"{current} {word}".strip()
+            if current and draw.textlength(candidate, font=font) > right - left:
+                lines.append((current, font, color or default_color, align, line_h))
+                current = word
+            else:
+                current = candidate
+        lines.append((current, font, color or default_color, align, line_h))
+    total_h = sum(l[4] for l in lines)
+    anchor = body_pr.get("anchor", "t") if body_pr is not None else "t"
+    y = top + max(0, (bottom - top - total_h) // 2) if anchor == "ctr" else max(top, bottom - total_h) if anchor == "b" else top
+    for text, font, color, align, line_h in lines:
+        if y > bottom:
+            break
+        if text:
+            width = draw.textlength(text, font=font)
+            x = left + (right - left - width) / 2 if align == "ctr" else right - width if align == "r" else left
+            draw.text((x, y), text, font=font, fill=color)
+        y += line_h
+
+def preview_child_transform(grp, transform: Tuple[float, float, float, float]) -> Tuple[float, float, float, float]:
+    """Maps a group's child coordinate space onto the canvas"""
+    sx, sy, tx, ty = transform
+    xfrm = grp.find(pptx_qn("p:grpSpPr") + "/" + pptx_qn("a:xfrm"))
+    if xfrm is None:
+        return transform
+    vals = {}
+    for tag in ("off", "ext", "chOff", "chExt"):
+        el = xfrm.find(pptx_qn(f"a:{tag}"))
+        if el is None:
+            return transform
+        vals[tag] = [int(v) for v in (el.get("x", el.get("cx")), el.get("y", el.get("cy")))]
+    kx = vals["ext"][0] / float(vals["chExt"][0] or 1)
+    ky = vals["ext"][1] / float(vals["chExt"][1] or 1)
+    return (sx * kx, sy * ky, tx + sx * (vals["off"][0] - vals["chOff"][0] * kx), ty + sy * (vals["off"][1] - vals["chOff"][1] * ky))
+
+def preview_draw_shapes(canvas, shapes, transform: Tuple[float, float, float, float], scheme: Dict[str, Tuple[int, int, int]], fonts: Dict[int, Any], skip_placeholders: bool = False, depth: int = 0) -> None:
+    if depth > 10:
+        return
+    draw = PILImageDraw.Draw(canvas, "RGBA")
+    sx, sy, tx, ty = transform
+    ratio = min(sx, sy)
+    default_text = scheme.get("dk1", (0, 0, 0)) + (255,)
+    for shape in shapes:
+        try:
+            if skip_placeholders and shape.is_placeholder:
+                continue
+            elm = shape._element
+            if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
+                preview_draw_shapes(canvas, shape.shapes, preview_child_transform(elm, transform), scheme, fonts, skip_placeholders, depth + 1)
+                continue
+            x0, y0 = int(int(shape.left) * sx + tx), int(int(shape.top) * sy + ty)
+            x1, y1 = int((int(shape.left) + int(shape.width)) * sx + tx), int((int(shape.top) + int(shape.height)) * sy + ty)
+            box = (x0, y0, x1, y1)
+            if shape.shape_type == MSO_SHAPE_TYPE.PICTURE:
+                pic = PILImage.open(io.BytesIO(shape.image.blob)).convert("RGBA").resize((max(1, x1 - x0), max(1, y1 - y0)))
+                canvas.paste(pic, (x0, y0), pic)
+                continue
+            if getattr(shape, "has_table", False) and shape.has_table:
+                table = shape.table
+                col_x = [x0]
+                for col in table.columns:
+                    col_x.append(col_x[-1] + int(int(col.width) * sx))
+                row_y = y0
+                for row in table.rows:
+                    row_h = int(int(row.height) * sy)
+                    for c_idx, cell in enumerate(row.cells):
+                        if c_idx + 1 >= len(col_x):
+                            break
+                        cell_box = (col_x[c_idx], row_y, col_x[c_idx + 1], row_y + row_h)
+                        preview_paint_fill(canvas, draw, preview_fill(cell._tc.find(pptx_qn("a:tcPr")), scheme), "rect", cell_box)
+                        draw.rectangle(cell_box, outline=(191, 191, 191, 255))
+                        preview_draw_text(draw, cell._tc.find(pptx_qn("a:txBody")), cell_box, ratio, scheme, default_text, PREVIEW_DEFAULT_FONT_PT, fonts)
+                    row_y += row_h
+                continue
+            sp_pr = elm.find(pptx_qn("p:spPr"))
+            style = elm.find(pptx_qn("p:style"))
+            geom = sp_pr.find(pptx_qn("a:prstGeom")) if sp_pr is not None else None
+            prst = geom.get("prst", "rect") if geom is not None else "rect"
+            outline = preview_outline(sp_pr, scheme, style.find(pptx_qn("a:lnRef")) if style is not None else None, ratio)
+            if prst in ("line", "straightConnector1") or elm.tag == pptx_qn("p:cxnSp"):
+                if outline:
+                    xfrm = sp_pr.find(pptx_qn("a:xfrm")) if sp_pr is not None else None
+                    flip_h = xfrm is not None and xfrm.get("flipH") == "1"
+                    flip_v = xfrm is not None and xfrm.get("flipV") == "1"
+                    draw.line(((x1 if flip_h else x0, y1 if flip_v else y0), (x0 if flip_h else x1, y0 if flip_v else y1)), fill=outline[0], width=outline[1])
+                continue
+            fill_blob, _, _ = pptx_get_shape_fill_picture(shape)
+            if fill_blob:
+                w, h = max(1, x1 - x0), max(1, y1 - y0)
+                mask = PILImage.new("L", (w, h), 0)
+                preview_draw_geometry(PILImageDraw.Draw(mask), prst, (0, 0, w - 1, h - 1), fill=255)
+                canvas.paste(PILImage.open(io.BytesIO(fill_blob)).convert("RGBA").resize((w, h)), (x0, y0), mask)
+            else:
+                preview_paint_fill(canvas, draw, preview_fill(sp_pr, scheme, style.find(pptx_qn("a:fillRef")) if style is not None else None), prst, box)
+            if outline:
+                preview_draw_geometry(draw, prst, box, outline=outline[0], width=outline[1])
+            font_ref = style.find(pptx_qn("a:fontRef")) if style is not None else None
+            text_color = preview_color(font_ref, scheme) if font_ref is not None else None
+            ph_type = str(shape.placeholder_format.type) if shape.is_placeholder else ""
+            default_pt = PREVIEW_TITLE_FONT_PT if "TITLE" in ph_type.upper() else PREVIEW_DEFAULT_FONT_PT
+            preview_draw_text(draw, elm.find(pptx_qn("p:txBody")), box, ratio, scheme, text_color or default_text, default_pt, fonts)
+        except Exception:
+            pass
 
-        for shape in slide.shapes:
-            paste_pictures(shape)
+def preview_background(slide_like, size: Tuple[int, int], scheme: Dict[str, Tuple[int, int, int]]):
+    """The slide-like part's own background, or None when it inherits one"""
+    bg = slide_like._element.cSld.bg
+    if bg is None:
+        return None
+    canvas = PILImage.new("RGBA", size, (255, 255, 255, 255))
+    bg_blob, _, _ = pptx_get_background_image(slide_like)
+    if bg_blob:
+        try:
+            bg_img = PILImage.open(io.BytesIO(bg_blob)).convert("RGBA").resize(size)
+            canvas.paste(bg_img, (0, 0), bg_img)
+            return canvas
+        except Exception:
+            pass
+    bg_pr = bg.find(pptx_qn("p:bgPr"))
+    fill = preview_fill(bg_pr, scheme) if bg_pr is not None else preview_fill(None, scheme, bg.find(pptx_qn("p:bgRef")))
+    preview_paint_fill(canvas, PILImageDraw.Draw(canvas, "RGBA"), fill, "rect", (0, 0, size[0] - 1, size[1] - 1))
+    return canvas
+
+def pptx_base_layers(prs: "Presentation", layout, width_px: int, layers: Dict[Any, Any]):
+    """Background and master/layout decoration layers of a layout, rendered once per layout and width"""
+    key = (str(layout.part.partname), width_px)
+    if key not in layers:
+        master = layout.slide_master
+        master_key = ("scheme", str(master.part.partname))
+        if master_key not in layers:
+            layers[master_key] = pptx_theme_scheme(master)
+        scheme = layers[master_key]
+        ratio = width_px / float(int(prs.slide_width))
+        size = (width_px, int(int(prs.slide_height) * ratio))
+        background = preview_background(layout, size, scheme) or preview_background(master, size, scheme) or PILImage.new("RGBA", size, (255, 255, 255, 255))
+        decorations = PILImage.new("RGBA", size, (0, 0, 0, 0))
+        fonts = layers.setdefault(("fonts",), {})
+        if layout._element.get("showMasterSp") != "0":
+            preview_draw_shapes(decorations, master.shapes, (ratio, ratio, 0, 0), scheme, fonts, skip_placeholders=True)
+        preview_draw_shapes(decorations, layout.shapes, (ratio, ratio, 0, 0), scheme, fonts, skip_placeholders=True)
+        layers[key] = (background, decorations, scheme)
+    return layers[key]
+
+def pptx_compose_slide_preview(prs: "Presentation", slide, width_px: int = 900, layers: Optional[Dict[Any, Any]] = None) -> Optional[bytes]:
+    """Draw a slide over its layout's cached background and decoration layers; pass the same layers dict for every slide of a deck"""
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        layers = layers if layers is not None else {}
+        ratio = width_px / float(int(prs.slide_width))
+        background, decorations, scheme = pptx_base_layers(prs, slide.slide_layout, width_px, layers)
+        canvas = preview_background(slide, background.size, scheme) or background.copy()
+        if slide._element.get("showMasterSp") != "0":
+            canvas.alpha_composite(decorations)
+        preview_draw_shapes(canvas, slide.shapes, (ratio, ratio, 0, 0), scheme, layers.setdefault(("fonts",), {}))
 
         out = io.BytesIO()
         canvas.convert("RGB").save(out, format="JPEG", quality=85)
@@ -912,9 +1966,68 @@ def pptx_compose_slide_preview(prs: "Presentation", slide, width_px: int = 900)
     except Exception:
         return None
 
-def pptx_extract_theme_images(file_bytes: bytes):
+PKG_RELS_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+PPTX_PRESENTATION_PART = "ppt/presentation.xml"
+
+def xml_content_digest(raw: bytes) -> str:
+    # The XML declaration differs between PowerPoint and python-pptx; an untouched part must still hash the same
+    body = raw.split(b"?>", 1)[1] if raw.startswith(b"<?xml") else raw
+    return hashlib.sha1(body.strip()).hexdigest()
+
+def pptx_part_rels(zf: zipfile.ZipFile, part_name: str) -> List[Tuple[str, str, str]]:
+    """(rId, type, target member) of the internal relationships of a part"""
+    folder, base = part_name.rsplit("/", 1)
+    rels_path = f"{folder}/_rels/{base}.rels"
+    try:
+        root = ET.fromstring(zf.read(rels_path))
+    except Exception:
+        return []
+    rels = []
+    for rel in root.findall(f"{PKG_RELS_NS}Relationship"):
+        if rel.attrib.get("TargetMode") == "External":
+            continue
+        rels.append((rel.attrib.get("Id", ""), rel.attrib.get("Type", ""), normalize_zip_path(folder, rel.attrib.get("Target", ""))))
+    return rels
+
+def pptx_slide_hashes(source: Union[bytes, str]) -> List[str]:
+    """One content hash per slide, in presentation order, over the slide XML and every part it draws from.
+
+    Media is compared by the CRC and size in the central directory, so only XML parts are decompressed."""
+    hashes: List[str] = []
+    try:
+        with zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source) as zf:
+            infos = {info.filename: info for info in zf.infolist()}
+            memo: Dict[str, str] = {}
+
+            def part_digest(name: str) -> str:
+                if name not in memo:
+                    info = infos.get(name)
+                    if info is None:
+                        memo[name] = "-"
+                    elif name.endswith(".xml"):
+                        memo[name] = xml_content_digest(zf.read(name))
+                    else:
+                        memo[name] = f"{info.CRC:08x}-{info.file_size}"
+                return memo[name]
+
+            slide_targets = {r_id: target for r_id, _, target in pptx_part_rels(zf, PPTX_PRESENTATION_PART)}
+            pres = ET.fromstring(zf.read(PPTX_PRESENTATION_PART))
+            for sld_id in pres.iter(pptx_qn("p:sldId")):
+                slide_name = slide_targets.get(sld_id.get(pptx_qn("r:id")), "")
+                h = hashlib.sha1(part_digest(slide_name).encode())
+                # Notes are not drawn; part names are left out because python-pptx renumbers slides on save
+                for r_id, rel_type, target in sorted(pptx_part_rels(zf, slide_name)):
+                    if not rel_type.endswith("/notesSlide"):
+                        h.update(f"{r_id}={part_digest(target)}".encode())
+                hashes.append(h.hexdigest())
+    except Exception:
+        return []
+    return hashes
+
+def pptx_extract_theme_images(file_bytes: bytes, source: Optional[PackageSource] = None):
     themes = []
     try:
+        source = source or PackageSource(file_bytes)
         zf = zipfile.ZipFile(io.BytesIO(file_bytes), 'r')
         theme_paths = [n for n in zf.namelist() if n.startswith("ppt/theme/") and n.endswith(".xml")]
         for tpath in theme_paths:
@@ -930,9 +2043,8 @@ def pptx_extract_theme_images(file_bytes: bytes):
                         if "media/" in target:
                             media_path = normalize_zip_path("ppt/theme", target)
                             if media_path in zf.namelist():
-                                img_bytes = zf.read(media_path)
                                 uid = f"pptx_theme_img_{tpath.split('/')[-1]}_{rId}"
-                                images.append({"uid": uid, "media_path": media_path, "bytes": img_bytes, "rid": rId, "theme_path": tpath, "name": media_path.split("/")[-1], "group": f"Theme {tpath.split('/')[-1]}"})
+                                images.append(ImageRecord(uid, media_path.split("/")[-1], f"Theme {tpath.split('/')[-1]}", kind="theme_image", media_path=media_path, rel_id=rId, theme_path=tpath, handle=source.handle(media_path)))
                 except Exception:
                     pass
             if images:
@@ -942,23 +2054,109 @@ def pptx_extract_theme_images(file_bytes: bytes):
         pass
     return {"themes": themes}
 
-def pptx_list_all_media(file_bytes: bytes) -> List[Dict]:
+def pptx_list_all_media(file_bytes: bytes, source: Optional[PackageSource] = None) -> List[ImageRecord]:
     items = []
     try:
-        zf = zipfile.ZipFile(io.BytesIO(file_bytes), 'r')
-        for name in zf.namelist():
+        source = source or PackageSource(file_bytes)
+        for name in source.names():
             if name.startswith("ppt/media/"):
-                try:
-                    data = zf.read(name)
-                    items.append({"name": name.split("/")[-1], "uid": name, "media_path": name, "bytes": data, "group": "All Media"})
-                except Exception:
-                    continue
-        zf.close()
+                items.append(ImageRecord(name, name.split("/")[-1], "All Media", media_path=name, handle=source.handle(name)))
     except Exception:
         pass
     return items
 
-def pptx_extract(file_bytes: bytes):
+# Shared parts
+# Layouts, masters and themes are shared by many slides; they are visited once each and rewritten at the XML level
+PPTX_SHARED_FONT_TAGS = ("a:latin", "a:ea", "a:cs")
+
+def pptx_shared_parts(prs: "Presentation") -> List[Tuple[str, Any]]:
+    """(scope, part) for every layout, master, theme and notes master reachable from the slides, each exactly once"""
+    visited: Set[str] = set()
+    parts: List[Tuple[str, Any]] = []
+
+    def visit(part) -> bool:
+        name = str(part.partname)
+        if name in visited:
+            return False
+        visited.add(name)
+        parts.append((name.rsplit("/", 1)[-1], part))
+        return True
+
+    def visit_master(master_part) -> None:
+        if visit(master_part):
+            try:
+                visit(master_part.part_related_by(PPTX_RT.THEME))
+            except Exception:
+                pass
+
+    for slide in prs.slides:
+        layout_part = slide.slide_layout.part
+        if visit(layout_part):
+            visit_master(layout_part.slide_master.part)
+    # Layouts no slide uses yet still shape slides added later
+    for master in prs.slide_masters:
+        visit_master(master.part)
+        for layout in master.slide_layouts:
+            visit(layout.part)
+    try:
+        # prs.notes_master would create a notes master when the deck has none
+        visit_master(prs.part.part_related_by(PPTX_RT.NOTES_MASTER))
+    except Exception:
+        pass
+    return parts
+
+def pptx_part_root(part):
+    """The XML tree of a part; themes are plain blob parts in python-pptx and are parsed here"""
+    element = getattr(part, "_element", None)
+    return element if element is not None else pptx_parse_xml(part.blob)
+
+def pptx_shared_part_keys(root) -> Set[str]:
+    keys: Set[str] = set()
+    for clr in root.iter(pptx_qn("a:srgbClr")):
+        hexv = color_hex(clr.get("val"))
+        if hexv:
+            keys.add(hexv)
+    for tag in PPTX_SHARED_FONT_TAGS:
+        for font in root.iter(pptx_qn(tag)):
+            typeface = font.get("typeface")
+            # "+mj-lt" style values point at the theme fonts rather than naming a font
+            if typeface and not typeface.startswith("+"):
+                keys.add(typeface)
+    return keys
+
+def pptx_rewrite_shared_part(root, color_map: Dict[str, str], font_map: Dict[str, str], report: Optional[ChangeReport] = None, scope: str = "") -> bool:
+    changed = False
+    for clr in root.iter(pptx_qn("a:srgbClr")):
+        hexv = color_hex(clr.get("val"))
+        if hexv and color_map.get(hexv) and apply_change(report, scope, "colors"):
+            clr.set("val", hex_no_hash(color_map[hexv]).upper())
+            changed = True
+    for tag in PPTX_SHARED_FONT_TAGS:
+        for font in root.iter(pptx_qn(tag)):
+            typeface = font.get("typeface")
+            if typeface and font_map.get(typeface) and apply_change(report, scope, "fonts"):
+                font.set("typeface", font_map[typeface])
+                changed = True
+    return changed
+
+def pptx_update_shared_parts(prs: "Presentation", color_map: Dict[str, str], font_map: Dict[str, str], report: Optional[ChangeReport] = None, only: Optional[Set[str]] = None) -> List[Any]:
+    """Rewrite layouts, masters and themes once each; returns the parts that changed"""
+    updated = []
+    for scope, part in pptx_shared_parts(prs):
+        if only is not None and str(part.partname).lstrip("/") not in only:
+            continue
+        try:
+            root = pptx_part_root(part)
+            if pptx_rewrite_shared_part(root, color_map, font_map, report, scope):
+                if getattr(part, "_element", None) is None:
+                    part.blob = pptx_serialize_part_xml(root)
+                updated.append(part)
+        except Exception:
+            pass
+    return updated
+
+def pptx_extract(file_bytes: bytes, progress: Optional[Callable[[Dict[str, Set[str]]], None]] = None):
+    """progress, when given, receives each slide's palette and then that of the shared parts and SVG media"""
     if not PPTX_AVAILABLE:
         return None
 
@@ -969,7 +2167,7 @@ def pptx_extract(file_bytes: bytes):
     shape_colors: Set[str] = set()
     background_colors: Set[str] = set()
     fonts: Set[str] = set()
-    images: List[Dict] = []
+    images: List[ImageRecord] = []
     slide_previews: Dict[str, bytes] = {}
 
     # Master background
@@ -978,7 +2176,7 @@ def pptx_extract(file_bytes: bytes):
         if master is not None:
             blob, r_id, part = pptx_get_background_image(master)
             if blob:
-                images.append({"name": "Slide Master Background", "bytes": blob, "uid": f"pptx_master_bg_0", "group": "Master", "kind": "master_bg", "rel_id": r_id, "media_path": str(part.partname).lstrip("/") if part else None})
+                images.append(ImageRecord("pptx_master_bg_0", "Slide Master Background", "Master", kind="master_bg", rel_id=r_id, media_path=str(part.partname).lstrip("/")))
     except Exception:
         pass
 
@@ -986,115 +2184,429 @@ def pptx_extract(file_bytes: bytes):
     for layout_idx, layout in enumerate(prs.slide_layouts):
         blob, r_id, part = pptx_get_background_image(layout)
         if blob:
-            images.append({"name": f"Layout {layout_idx+1} Background", "bytes": blob, "uid": f"pptx_layout_bg_{layout_idx}", "group": f"Layout {layout_idx+1}", "kind": "layout_bg", "rel_id": r_id, "media_path": str(part.partname).lstrip("/") if part else None})
+            images.append(ImageRecord(f"pptx_layout_bg_{layout_idx}", f"Layout {layout_idx+1} Background", f"Layout {layout_idx+1}", kind="layout_bg", rel_id=r_id, media_path=str(part.partname).lstrip("/")))
 
     # Slides
-    for slide_idx, slide in enumerate(prs.slides):
+    slide_keys: Dict[int, Set[str]] = {}
+    slides = list(prs.slides)
+    workers = part_workers_for(len(slides), PPTX_PARALLEL_MIN_SLIDES)
+    chunks = fork_map(lambda chunk: list(pptx_extract_slides(prs, slides, chunk)), part_chunks(len(slides), workers)) if workers > 1 else None
+    slide_results = sorted((r for chunk in chunks for r in chunk), key=lambda r: r[0]) if chunks is not None else pptx_extract_slides(prs, slides, range(len(slides)))
+    for slide_idx, palette, slide_images, preview_bytes in slide_results:
+        images.extend(ImageRecord(*fields) for fields in slide_images)
+        # Remember which colors/fonts each slide uses so a re-apply can skip untouched slides
+        slide_keys[slide_idx] = set().union(*palette.values())
+        text_colors |= palette["text_colors"]
+        shape_colors |= palette["shape_colors"]
+        background_colors |= palette["background_colors"]
+        fonts |= palette["fonts"]
+        if progress is not None:
+            progress(palette)
+        if preview_bytes:
+            slide_previews[f"Slide {slide_idx+1}"] = preview_bytes
+
+    # Colors and fonts of layouts, masters and themes, read once per part
+    shared_keys: Dict[str, Set[str]] = {}
+    for _, part in pptx_shared_parts(prs):
+        try:
+            keys = pptx_shared_part_keys(pptx_part_root(part))
+        except Exception:
+            keys = set()
+        shared_keys[str(part.partname).lstrip("/")] = keys
+        shape_colors |= {k for k in keys if k.startswith("#")}
+        fonts |= {k for k in keys if not k.startswith("#")}
+
+    source = PackageSource(file_bytes)
+    bind_media_handles(images, source)
+    shape_colors |= svg_media_colors(source)
+    if progress is not None:
+        progress({"shape_colors": shape_colors, "fonts": fonts})
+    theme_images_info = pptx_extract_theme_images(file_bytes, source)
+    all_media = pptx_list_all_media(file_bytes, source)
+    images.extend(all_media)
+
+    return {"presentation": prs, "text_colors": sorted(list(text_colors)), "shape_colors": sorted(list(shape_colors)), "background_colors": sorted(list(background_colors)), "fonts": sorted(list(fonts)), "images": images, "slide_previews": slide_previews, "theme_images_info": theme_images_info, "slide_keys": slide_keys, "shared_keys": shared_keys, "slide_hashes": pptx_slide_hashes(file_bytes)}
+
+def pptx_extract_slides(prs: "Presentation", slides: List[Any], indices: Iterable[int]) -> Iterator[Tuple[int, Dict[str, Set[str]], List[Tuple], Optional[bytes]]]:
+    """(index, palette, image fields, preview) per slide; plain values only, so a forked worker can send them back"""
+    preview_layers: Dict[Any, Any] = {}
+    for slide_idx in indices:
+        slide = slides[slide_idx]
+        palette: Dict[str, Set[str]] = {"text_colors": set(), "shape_colors": set(), "background_colors": set(), "fonts": set()}
+        images: List[ImageRecord] = []
         try:
-            fill = slide.background.fill
+            fill = pptx_own_background_fill(slide)
             if fill and fill.type == MSO_FILL.SOLID:
                 hexv = extract_color_from_pptx_color_obj(fill.fore_color)
                 if hexv:
-                    background_colors.add(hexv)
+                    palette["background_colors"].add(hexv)
         except Exception:
             pass
 
         blob, r_id, part = pptx_get_background_image(slide)
         if blob:
-            images.append({"name": f"Slide {slide_idx+1} Background", "bytes": blob, "uid": f"pptx_slide_bg_{slide_idx}", "group": f"Slide {slide_idx+1}", "kind": "slide_bg", "rel_id": r_id, "media_path": str(part.partname).lstrip("/") if part else None})
+            images.append(ImageRecord(f"pptx_slide_bg_{slide_idx}", f"Slide {slide_idx+1} Background", f"Slide {slide_idx+1}", kind="slide_bg", rel_id=r_id, media_path=str(part.partname).lstrip("/")))
 
         for shape_idx, shape in enumerate(slide.shapes):
             path = str(shape_idx)
-            pptx_process_shape_recursive(shape, slide_idx, path, text_colors, shape_colors, fonts, images, depth=0)
+            pptx_process_shape_recursive(shape, slide_idx, path, palette["text_colors"], palette["shape_colors"], palette["fonts"], images, depth=0)
 
-        preview_bytes = pptx_compose_slide_preview(prs, slide, width_px=900) if PIL_AVAILABLE else None
-        if preview_bytes:
-            slide_previews[f"Slide {slide_idx+1}"] = preview_bytes
-
-    theme_images_info = pptx_extract_theme_images(file_bytes)
-    all_media = pptx_list_all_media(file_bytes)
-    images.extend(all_media)
+        preview_bytes = pptx_compose_slide_preview(prs, slide, SLIDE_PREVIEW_WIDTH, preview_layers) if PIL_AVAILABLE else None
+        yield slide_idx, palette, [(img.uid, img.name, img.group, img.kind, img.media_path, img.rel_id) for img in images], preview_bytes
 
-    return {"presentation": prs, "text_colors": sorted(list(text_colors)), "shape_colors": sorted(list(shape_colors)), "background_colors": sorted(list(background_colors)), "fonts": sorted(list(fonts)), "images": images, "slide_previews": slide_previews, "theme_images_info": theme_images_info}
+def pptx_update_slide(slide, slide_idx: int, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], report: Optional[ChangeReport] = None, text_map: Optional[Dict[str, str]] = None) -> None:
+    scope = f"Slide {slide_idx+1}"
+    try:
+        fill = pptx_own_background_fill(slide)
+        if fill and fill.type == MSO_FILL.SOLID:
+            curr_hex = extract_color_from_pptx_color_obj(fill.fore_color)
+            if curr_hex and curr_hex in color_map and color_map[curr_hex] and apply_change(report, scope, "fills"):
+                fill.solid()
+                fill.fore_color.rgb = PPTX_RGBColor.from_string(hex_no_hash(color_map[curr_hex]))
+    except Exception as e:
+        telemetry_skip("pptx_update_slide", "background_fill", e)
 
-def zip_replace_media(base_bytes: bytes, replacements: Dict[str, bytes]) -> bytes:
-    if not replacements:
-        return base_bytes
     try:
-        in_zip = zipfile.ZipFile(io.BytesIO(base_bytes), 'r')
-        out_mem = io.BytesIO()
-        out_zip = zipfile.ZipFile(out_mem, 'w', zipfile.ZIP_DEFLATED)
-        for name in in_zip.namelist():
-            data = in_zip.read(name)
-            if name in replacements:
-                data = replacements[name]
-            out_zip.writestr(name, data)
-        in_zip.close()
-        out_zip.close()
-        return out_mem.getvalue()
-    except Exception:
-        return base_bytes
-
-def pptx_apply_updates(extracted, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes]) -> bytes:
-    prs: Presentation = extracted["presentation"]
-
+        uid_bg = f"pptx_slide_bg_{slide_idx}"
+        if uid_bg in image_replacements and apply_change(report, scope, "media"):
+            bg_elm = slide.background._element
+            blips = bg_elm.xpath(".//a:blip")
+            if blips:
+                r_id = blips[0].get(pptx_qn('r:embed'))
+                if r_id:
+                    part = pptx_related_part(slide.part, r_id)
+                    ext = os.path.splitext(str(part.partname))[-1] if hasattr(part, "partname") else ".png"
+                    part.blob = convert_image_bytes_to_ext(image_replacements[uid_bg], ext)
+    except Exception as e:
+        telemetry_skip("pptx_update_slide", "background_picture", e)
+
+    for shape_idx, shape in enumerate(slide.shapes):
+        path = str(shape_idx)
+        pptx_update_shape_recursive(shape, slide_idx, path, color_map, font_map, image_replacements, depth=0, report=report, text_map=text_map)
+
+def pptx_update_slides(slides: List[Any], indices: List[int], color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], text_map: Optional[Dict[str, str]] = None) -> Dict[int, bytes]:
+    """Rebrand some slides and return their XML by index"""
+    updated: Dict[int, bytes] = {}
+    for slide_idx in indices:
+        pptx_update_slide(slides[slide_idx], slide_idx, color_map, font_map, image_replacements, text_map=text_map)
+        updated[slide_idx] = slides[slide_idx].part.blob
+    return updated
+
+def pptx_media_replacements(extracted, image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], only: Optional[Set[str]] = None) -> Dict[str, bytes]:
+    """Map ZIP media members to their converted replacement bytes (later sources win on shared media)"""
     uid_to_media: Dict[str, Optional[str]] = {}
     for img in extracted.get("images", []):
-        uid_to_media[img.get("uid")] = img.get("media_path")
+        uid_to_media[img.uid] = img.media_path
 
-    for slide_idx, slide in enumerate(prs.slides):
-        try:
-            fill = slide.background.fill
-            if fill and fill.type == MSO_FILL.SOLID:
-                curr_hex = extract_color_from_pptx_color_obj(fill.fore_color)
-                if curr_hex and curr_hex in color_map and color_map[curr_hex]:
-                    fill.solid()
-                    fill.fore_color.rgb = PPTX_RGBColor.from_string(hex_no_hash(color_map[curr_hex]))
-        except Exception:
-            pass
+    pending: Dict[str, Tuple[bytes, str]] = {}
+    for uid, media_path in uid_to_media.items():
+        if uid in image_replacements and media_path:
+            pending[media_path] = (image_replacements[uid], os.path.splitext(media_path)[1] or ".png")
+    for uid, data in image_replacements.items():
+        if uid.startswith("ppt/media/"):
+            pending[uid] = (data, os.path.splitext(uid)[1] or ".png")
+    for media_path, data in theme_image_replacements.items():
+        pending[media_path] = (data, os.path.splitext(media_path)[1] or ".png")
 
-        try:
-            uid_bg = f"pptx_slide_bg_{slide_idx}"
-            if uid_bg in image_replacements:
-                bg_elm = slide.background._element
-                blips = bg_elm.xpath(".//a:blip")
-                if blips:
-                    r_id = blips[0].get(pptx_qn('r:embed'))
-                    if r_id:
-                        part = slide.part.related_parts[r_id]
-                        ext = os.path.splitext(str(part.partname))[-1] if hasattr(part, "partname") else ".png"
-                        part.blob = convert_image_bytes_to_ext(image_replacements[uid_bg], ext)
-        except Exception:
-            pass
+    zip_media_repls: Dict[str, bytes] = {}
+    for media_path, (data, target_ext) in pending.items():
+        if only is None or media_path in only:
+            zip_media_repls[media_path] = convert_image_bytes_to_ext(data, target_ext)
+    return zip_media_repls
 
-        for shape_idx, shape in enumerate(slide.shapes):
-            path = str(shape_idx)
-            pptx_update_shape_recursive(shape, slide_idx, path, color_map, font_map, image_replacements, depth=0)
+def pptx_apply_updates(extracted, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], sink=None, policy: Optional[Dict[str, Any]] = None, text_map: Optional[Dict[str, str]] = None) -> Optional[bytes]:
+    """With a sink the presentation is written there and None is returned"""
+    prs: Presentation = extracted["presentation"]
 
+    slides = list(prs.slides)
+    workers = part_workers_for(len(slides), PPTX_PARALLEL_MIN_SLIDES)
+    chunks = fork_map(lambda chunk: pptx_update_slides(slides, chunk, color_map, font_map, image_replacements, text_map), part_chunks(len(slides), workers)) if workers > 1 else None
+    if chunks is not None:
+        # Workers send back slide XML; replaced media is written at the ZIP level below either way
+        for chunk in chunks:
+            for slide_idx, blob in chunk.items():
+                slides[slide_idx].part._element = pptx_parse_xml(blob)
+    else:
+        for slide_idx, slide in enumerate(slides):
+            pptx_update_slide(slide, slide_idx, color_map, font_map, image_replacements, text_map=text_map)
+    pptx_update_shared_parts(prs, color_map, font_map)
+
+    zip_media_repls = pptx_media_replacements(extracted, image_replacements, theme_image_replacements)
+    if sink is not None and not zip_media_repls:
+        prs.save(sink)
+        return None
     out_buf = io.BytesIO()
     prs.save(out_buf)
-    updated_pptx = out_buf .getvalue()
+    return zip_replace_media(out_buf.getvalue(), zip_media_repls, sink, policy)
 
-    zip_media_repls: Dict[str, bytes] = {}
-    for uid, media_path in uid_to_media.items():
-        if uid in image_replacements and media_path:
-            target_ext = os.path.splitext(media_path)[1] or ".png"
-            zip_media_repls[media_path] = convert_image_bytes_to_ext(image_replacements[uid], target_ext)
-    for uid, data in image_replacements.items():
-        if uid.startswith("ppt/media/"):
-            target_ext = os.path.splitext(uid)[1] or ".png"
-            zip_media_repls[uid] = convert_image_bytes_to_ext(data, target_ext)
-    for media_path, data in theme_image_replacements.items():
-        target_ext = os.path.splitext(media_path)[1] or ".png"
-        zip_media_repls[media_path] = convert_image_bytes_to_ext(data, target_ext)
+def pptx_incremental_members(file_bytes: bytes, extracted, changed_keys: Set[str], changed_uids: Set[str], changed_theme_media: Set[str], color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes]) -> Optional[Dict[str, bytes]]:
+    """The slides that use a changed color/font and the media whose replacement changed; None when a change can't be localized"""
+    uid_to_media: Dict[str, Optional[str]] = {}
+    for img in extracted.get("images", []):
+        uid_to_media[img.uid] = img.media_path
 
-    if zip_media_repls:
-        updated_pptx = zip_replace_media(updated_pptx, zip_media_repls)
+    affected_media: Set[str] = set(changed_theme_media)
+    for uid in changed_uids:
+        if uid.startswith("ppt/media/"):
+            affected_media.add(uid)
+        elif uid_to_media.get(uid):
+            affected_media.add(uid_to_media[uid])
+        else:
+            return None
 
-    return updated_pptx
+    slide_keys: Optional[Dict[int, Set[str]]] = extracted.get("slide_keys")
+    shared_keys: Optional[Dict[str, Set[str]]] = extracted.get("shared_keys")
+    if changed_keys and (slide_keys is None or shared_keys is None):
+        return None
+    affected_slides = sorted(idx for idx, keys in slide_keys.items() if keys & changed_keys) if changed_keys else []
+    affected_shared = {name for name, keys in shared_keys.items() if keys & changed_keys} if changed_keys else set()
+
+    members: Dict[str, bytes] = {}
+    if affected_slides or affected_shared:
+        prs = Presentation(io.BytesIO(file_bytes))
+        slides = list(prs.slides)
+        for slide_idx in affected_slides:
+            slide = slides[slide_idx]
+            pptx_update_slide(slide, slide_idx, color_map, font_map, image_replacements)
+            members[str(slide.part.partname).lstrip("/")] = slide.part.blob
+        if affected_shared:
+            pptx_update_shared_parts(prs, color_map, font_map, only=affected_shared)
+            # Parts whose mapping was reverted are rewritten too; the previous output still holds the old colors
+            for _, part in pptx_shared_parts(prs):
+                name = str(part.partname).lstrip("/")
+                if name in affected_shared:
+                    members[name] = part.blob
+
+    if affected_media:
+        members.update(pptx_media_replacements(extracted, image_replacements, theme_image_replacements, only=affected_media))
+        members.update(zip_read_members(file_bytes, affected_media - set(members)))
+    return members
+
+# Quick scan
+# The theme, masters, layouts and a spread of slides are read straight from the ZIP for a first palette;
+# the full extraction then runs in the background and its finds are merged in as they come
+PPTX_QUICK_SCAN_SLIDES = 8
+PPTX_TEXT_PROPERTY_TAGS = ("a:rPr", "a:defRPr", "a:endParaRPr")
+
+def pptx_quick_scan_sample(count: int, sample: int = PPTX_QUICK_SCAN_SLIDES) -> List[int]:
+    """Evenly spread slide indices, always including the first and the last"""
+    if count <= sample:
+        return list(range(count))
+    return sorted({round(i * (count - 1) / (sample - 1)) for i in range(sample)})
+
+def pptx_slide_palette(root) -> Dict[str, Set[str]]:
+    """Colors of a slide's XML split the way pptx_extract reports them; fonts as named in its runs"""
+    text_ids = {id(clr) for tag in PPTX_TEXT_PROPERTY_TAGS for props in root.iter(pptx_qn(tag)) for clr in props.iter(pptx_qn("a:srgbClr"))}
+    bg_ids = {id(clr) for bg in root.iter(pptx_qn("p:bg")) for clr in bg.iter(pptx_qn("a:srgbClr"))}
+    palette: Dict[str, Set[str]] = {"text_colors": set(), "shape_colors": set(), "background_colors": set(), "fonts": set()}
+    for clr in root.iter(pptx_qn("a:srgbClr")):
+        hexv = color_hex(clr.get("val"))
+        if not hexv:
+            continue
+        key = "text_colors" if id(clr) in text_ids else "background_colors" if id(clr) in bg_ids else "shape_colors"
+        palette[key].add(hexv)
+    palette["fonts"] = {k for k in pptx_shared_part_keys(root) if not k.startswith("#")}
+    return palette
+
+def pptx_quick_scan(file_bytes: bytes, sample: int = PPTX_QUICK_SCAN_SLIDES) -> Optional[Dict[str, Any]]:
+    """An approximate palette from the shared parts and a sample of slides; None when the deck is small enough
+    that sampling would read every slide anyway"""
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
+            slide_targets = {r_id: target for r_id, _, target in pptx_part_rels(zf, PPTX_PRESENTATION_PART)}
+            pres = ET.fromstring(zf.read(PPTX_PRESENTATION_PART))
+            slide_names = [slide_targets.get(sld_id.get(pptx_qn("r:id")), "") for sld_id in pres.iter(pptx_qn("p:sldId"))]
+            if len(slide_names) <= sample:
+                return None
+            palette: Dict[str, Set[str]] = {"text_colors": set(), "shape_colors": set(), "background_colors": set(), "fonts": set()}
+            for name in zf.namelist():
+                if name.endswith(".xml") and name.startswith(("ppt/theme/", "ppt/slideMasters/", "ppt/slideLayouts/")):
+                    keys = pptx_shared_part_keys(ET.fromstring(zf.read(name)))
+                    palette["shape_colors"] |= {k for k in keys if k.startswith("#")}
+                    palette["fonts"] |= {k for k in keys if not k.startswith("#")}
+            for slide_idx in pptx_quick_scan_sample(len(slide_names), sample):
+                for key, values in pptx_slide_palette(ET.fromstring(zf.read(slide_names[slide_idx]))).items():
+                    palette[key] |= values
+    except Exception:
+        return None
+    quick: Dict[str, Any] = {key: sorted(values) for key, values in palette.items()}
+    quick.update({"images": [], "slide_previews": {}, "theme_images_info": [], "partial": True, "slide_count": len(slide_names)})
+    return quick
+
+# Template swap
+# Decks on the old corporate template get the brand template's masters, layouts and theme wholesale;
+# each slide moves to the new layout whose placeholders look most like its old one
+PPTX_PLACEHOLDER_ALIASES = {"ctrTitle": "title", "obj": "body"}
+# Date, footer and slide number come from the master and say nothing about a layout's shape
+PPTX_PLACEHOLDER_IGNORED = {"dt", "ftr", "sldNum", "hdr"}
+PPTX_CONTENT_PLACEHOLDERS = {"body", "subTitle", "pic", "chart", "tbl", "dgm", "media", "clipArt"}
+PPTX_LAYOUT_NAME_BONUS = 0.25
+
+def pptx_placeholder_elements(shapes_owner) -> List[Any]:
+    """The <p:ph> elements of a slide or layout in document order"""
+    return shapes_owner.shapes._spTree.xpath("./*/*/p:nvPr/p:ph")
+
+def pptx_placeholder_type(ph) -> str:
+    ph_type = ph.get("type", "obj")
+    return PPTX_PLACEHOLDER_ALIASES.get(ph_type, ph_type)
+
+def pptx_layout_signature(layout) -> Counter:
+    return Counter(t for t in (pptx_placeholder_type(ph) for ph in pptx_placeholder_elements(layout)) if t not in PPTX_PLACEHOLDER_IGNORED)
+
+def pptx_layout_match_score(old_sig: Counter, old_name: str, new_sig: Counter, new_name: str) -> float:
+    """Weighted Jaccard of the placeholder counts, plus a bonus when the layout names agree"""
+    union = sum((old_sig | new_sig).values())
+    score = sum((old_sig & new_sig).values()) / union if union else 1.0
+    if old_name and old_name.strip().lower() == (new_name or "").strip().lower():
+        score += PPTX_LAYOUT_NAME_BONUS
+    return score
+
+def pptx_best_layout(layout, candidates: List[Tuple[Any, Counter]]) -> Tuple[Any, float]:
+    old_sig = pptx_layout_signature(layout)
+    best, best_score = None, -1.0
+    for candidate, sig in candidates:
+        score = pptx_layout_match_score(old_sig, layout.name, sig, candidate.name)
+        if score > best_score:
+            best, best_score = candidate, score
+    return best, best_score
+
+def pptx_remap_placeholders(slide, layout) -> None:
+    """Point the slide's placeholders at the new layout's, matching by type and then any free content placeholder"""
+    free = [ph for ph in pptx_placeholder_elements(layout) if pptx_placeholder_type(ph) not in PPTX_PLACEHOLDER_IGNORED]
+    for ph in pptx_placeholder_elements(slide):
+        ph_type = pptx_placeholder_type(ph)
+        if ph_type in PPTX_PLACEHOLDER_IGNORED:
+            continue
+        match = next((c for c in free if pptx_placeholder_type(c) == ph_type), None)
+        if match is None and ph_type in PPTX_CONTENT_PLACEHOLDERS:
+            match = next((c for c in free if pptx_placeholder_type(c) in PPTX_CONTENT_PLACEHOLDERS), None)
+        if match is None:
+            continue
+        free.remove(match)
+        if match.get("idx") is not None:
+            ph.set("idx", match.get("idx"))
+        elif ph.get("idx") is not None:
+            del ph.attrib["idx"]
+        if ph_type == "title":
+            ph.set("type", match.get("type", "title"))
+
+def pptx_rename_colliding_parts(parts: List[Any], taken: Set[str]) -> None:
+    """Give parts whose names are already used by the deck the next free number in their family"""
+    for part in parts:
+        name = str(part.partname)
+        if name not in taken:
+            taken.add(name)
+            continue
+        tmpl = re.sub(r"\d*(\.\w+)$", r"%d\1", name)
+        n = 1
+        while tmpl % n in taken:
+            n += 1
+        part.partname = PackURI(tmpl % n)
+        taken.add(tmpl % n)
+
+def pptx_template_swap(extracted, template_bytes: bytes, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], sink=None, policy: Optional[Dict[str, Any]] = None, text_map: Optional[Dict[str, str]] = None) -> Tuple[Optional[bytes], List[str]]:
+    """Rebrand by swapping in the template's masters, layouts and theme; slides keep their content and are only
+    recolored where colors are hard-coded. With a sink the presentation is written there and None is returned."""
+    prs: Presentation = extracted["presentation"]
+    template = Presentation(io.BytesIO(template_bytes))
+    notes: List[str] = []
+
+    # Template parts never reuse a name from the original package, so rewrites keyed by those names can't hit them
+    taken = {str(part.partname) for part in prs.part.package.iter_parts()}
+    pptx_rename_colliding_parts([part for part in template.part.package.iter_parts() if part is not template.part], taken)
+
+    candidates = [(layout, pptx_layout_signature(layout)) for master in template.slide_masters for layout in master.slide_layouts]
+    if not candidates:
+        raise ValueError("The template has no slide layouts")
+    remapped: Dict[str, str] = {}
+    weak = 0
+    for slide in prs.slides:
+        old_layout = slide.slide_layout
+        new_layout, score = pptx_best_layout(old_layout, candidates)
+        if score < 0.5:
+            weak += 1
+        remapped[old_layout.name] = new_layout.name
+        for r_id, rel in list(slide.part.rels.items()):
+            if rel.reltype == PPTX_RT.SLIDE_LAYOUT:
+                slide.part.rels.pop(r_id)
+        slide.part.relate_to(new_layout.part, PPTX_RT.SLIDE_LAYOUT)
+        pptx_remap_placeholders(slide, new_layout)
+
+    # The old masters drop out of the package with their relationships; the template keeps its master ids
+    pres_elm = prs.part._element
+    for r_id, rel in list(prs.part.rels.items()):
+        if rel.reltype in (PPTX_RT.SLIDE_MASTER, PPTX_RT.THEME):
+            prs.part.rels.pop(r_id)
+    id_lst = pres_elm.find(pptx_qn("p:sldMasterIdLst"))
+    for entry in list(id_lst):
+        id_lst.remove(entry)
+    for master, entry in zip(template.slide_masters, template.part._element.find(pptx_qn("p:sldMasterIdLst"))):
+        new_entry = copy.deepcopy(entry)
+        new_entry.set(pptx_qn("r:id"), prs.part.relate_to(master.part, PPTX_RT.SLIDE_MASTER))
+        id_lst.append(new_entry)
+    try:
+        prs.part.relate_to(template.part.part_related_by(PPTX_RT.THEME), PPTX_RT.THEME)
+    except Exception:
+        prs.part.relate_to(template.slide_masters[0].part.part_related_by(PPTX_RT.THEME), PPTX_RT.THEME)
 
+    # Hard-coded colors and fonts on the slides still carry the old brand
+    for slide_idx, slide in enumerate(prs.slides):
+        pptx_update_slide(slide, slide_idx, color_map, font_map, image_replacements, text_map=text_map)
+
+    notes.append(f"Swapped in the template's {len(template.slide_masters)} master(s) and {len(candidates)} layout(s); " + ", ".join(f"{old} → {new}" for old, new in remapped.items()))
+    if weak:
+        notes.append(f"{weak} slide(s) had no close layout match in the template; check their placeholders.")
+    if (prs.slide_width, prs.slide_height) != (template.slide_width, template.slide_height):
+        notes.append("The template's slide size differs from the deck's; the deck's size was kept.")
+
+    # Theme media of the old masters is gone, so only replacements of media the slides still use apply
+    slide_media = {str(rel.target_part.partname).lstrip("/") for slide in prs.slides for rel in slide.part.rels.values() if not rel.is_external}
+    zip_media_repls = pptx_media_replacements(extracted, image_replacements, {}, only=slide_media)
+    if sink is not None and not zip_media_repls:
+        prs.save(sink)
+        return None, notes
+    out_buf = io.BytesIO()
+    prs.save(out_buf)
+    return zip_replace_media(out_buf.getvalue(), zip_media_repls, sink, policy), notes
 
 # XLSX functions
+def xlsx_sheet_palette(ws) -> Dict[str, Set[str]]:
+    palette: Dict[str, Set[str]] = {"text_colors": set(), "shape_colors": set(), "background_colors": set(), "fonts": set()}
+    for row in ws.iter_rows():
+        for cell in row:
+            try:
+                if cell.font and cell.font.name:
+                    palette["fonts"].add(cell.font.name)
+            except Exception:
+                pass
+            try:
+                hexv = openpyxl_color_to_hex(cell.font.color)
+                if hexv:
+                    palette["text_colors"].add(hexv)
+            except Exception:
+                pass
+            try:
+                fill = cell.fill
+                if fill and fill.patternType == "solid":
+                    hexv = openpyxl_color_to_hex(fill.fgColor)
+                    if hexv:
+                        palette["shape_colors"].add(hexv)
+                        palette["background_colors"].add(hexv)
+            except Exception:
+                pass
+            try:
+                b = cell.border
+                if b:
+                    for side_name in ["left", "right", "top", "bottom"]:
+                        side = getattr(b, side_name)
+                        if side and side.color:
+                            hexv = openpyxl_color_to_hex(side.color)
+                            if hexv:
+                                palette["shape_colors"].add(hexv)
+            except Exception:
+                pass
+    return palette
+
 def xlsx_extract(file_bytes: bytes):
     if not OPENPYXL_AVAILABLE:
         return None
@@ -1106,69 +2618,64 @@ def xlsx_extract(file_bytes: bytes):
     shape_colors: Set[str] = set()
     background_colors: Set[str] = set()
     fonts: Set[str] = set()
-    images: List[Dict] = []
-
-    for ws in wb.worksheets:
-        for row in ws.iter_rows():
-            for cell in row:
-                try:
-                    if cell.font and cell.font.name:
-                        fonts.add(cell.font.name)
-                except Exception:
-                    pass
-                try:
-                    hexv = openpyxl_color_to_hex(cell.font.color)
-                    if hexv:
-                        text_colors.add(hexv)
-                except Exception:
-                    pass
-                try:
-                    fill = cell.fill
-                    if fill and fill.patternType == "solid":
-                        hexv = openpyxl_color_to_hex(fill.fgColor)
-                        if hexv:
-                            shape_colors.add(hexv)
-                            background_colors.add(hexv)
-                except Exception:
-                    pass
-                try:
-                    b = cell.border
-                    if b:
-                        for side_name in ["left", "right", "top", "bottom"]:
-                            side = getattr(b, side_name)
-                            if side and side.color:
-                                hexv = openpyxl_color_to_hex(side.color)
-                                if hexv:
-                                    shape_colors.add(hexv)
-                except Exception:
-                    pass
-
+    images: List[ImageRecord] = []
+
+    sheets = wb.worksheets
+    workers = part_workers_for(len(sheets), XLSX_PARALLEL_MIN_SHEETS)
+    chunks = fork_map(lambda chunk: [xlsx_sheet_palette(sheets[idx]) for idx in chunk], part_chunks(len(sheets), workers)) if workers > 1 else None
+    palettes = [palette for chunk in chunks for palette in chunk] if chunks is not None else [xlsx_sheet_palette(ws) for ws in sheets]
+    for palette in palettes:
+        text_colors |= palette["text_colors"]
+        shape_colors |= palette["shape_colors"]
+        background_colors |= palette["background_colors"]
+        fonts |= palette["fonts"]
+
+    for ws in sheets:
         try:
             ws_images = getattr(ws, "_images", [])
             for idx, img in enumerate(ws_images):
                 uid = f"xlsx_{ws.title}_{idx}"
                 preview_bytes = None
-                if PIL_AVAILABLE:
-                    try:
-                        pil_img = getattr(img, "_data", None)
-                        if pil_img is not None:
-                            out = io.BytesIO()
-                            pil_img.save(out, format="PNG")
-                            preview_bytes = out.getvalue()
-                    except Exception:
-                        preview_bytes = None
-                images.append({"name": f"{ws.title} Image {idx+1}", "bytes": preview_bytes, "uid": uid, "group": f"Sheet {ws.title}", "ws_title": ws.title, "index": idx})
+                try:
+                    preview_bytes = img._data()
+                except Exception:
+                    preview_bytes = None
+                images.append(ImageRecord(uid, f"{ws.title} Image {idx+1}", f"Sheet {ws.title}", kind="sheet_image", data=preview_bytes))
         except Exception:
             pass
 
     return {"workbook": wb, "text_colors": sorted(list(text_colors)), "shape_colors": sorted(list(shape_colors)), "background_colors": sorted(list(background_colors)), "fonts": sorted(list(fonts)), "images": images}
 
-def xlsx_apply_updates(extracted, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes]) -> bytes:
-    wb = extracted["workbook"]
+class XlsxCellText:
+    """A cell seen as a single run, so text replacement treats it like a DOCX or PPTX run"""
+    __slots__ = ("cell",)
+
+    def __init__(self, cell):
+        self.cell = cell
+
+    @property
+    def text(self) -> str:
+        return self.cell.value
 
+    @text.setter
+    def text(self, value: str) -> None:
+        self.cell.value = value
+
+def xlsx_update_cells(wb, color_map: Dict[str, str], font_map: Dict[str, str], report: Optional[ChangeReport] = None, text_map: Optional[Dict[str, str]] = None) -> None:
+    pattern = text_matcher(text_map)
     for ws in wb.worksheets:
+        scope = f"Sheet {ws.title}"
         for row in ws.iter_rows():
+            telemetry_count("xlsx_update_cells", "cell", "visited", len(row))
             for cell in row:
+                if pattern is not None and isinstance(cell.value, str) and cell.data_type != "f":
+                    try:
+                        # A cell holds one string; openpyxl rebuilds the shared strings table on save
+                        replaced = text_replace_runs([XlsxCellText(cell)], text_map, pattern, report, scope)
+                        if replaced:
+                            telemetry_count("xlsx_update_cells", "text", "rewritten", replaced)
+                    except Exception as e:
+                        telemetry_skip("xlsx_update_cells", "text", e)
                 try:
                     curr_font = cell.font
                     new_name = None
@@ -1178,42 +2685,60 @@ def xlsx_apply_updates(extracted, color_map: Dict[str, str], font_map: Dict[str,
                     new_color_hex = None
                     if curr_color_hex and curr_color_hex in color_map and color_map[curr_color_hex]:
                         new_color_hex = color_map[curr_color_hex]
-                    if new_name or new_color_hex:
+                    if report is not None:
+                        if new_name:
+                            report.record(scope, "fonts")
+                        if new_color_hex:
+                            report.record(scope, "text colors")
+                    elif new_name or new_color_hex:
                         kwargs = {}
                         if new_name:
                             kwargs["name"] = new_name
                         if new_color_hex:
                             kwargs["color"] = Color(rgb="FF" + hex_no_hash(new_color_hex))
                         cell.font = Font(name=kwargs.get("name", curr_font.name), size=curr_font.size, bold=curr_font.bold, italic=curr_font.italic, vertAlign=curr_font.vertAlign, underline=curr_font.underline, strike=curr_font.strike, color=kwargs.get("color", curr_font.color), shadow=curr_font.shadow, scheme=curr_font.scheme, charset=curr_font.charset, outline=curr_font.outline, condense=curr_font.condense, extend=curr_font.extend)
-                except Exception:
-                    pass
+                        telemetry_count("xlsx_update_cells", "font", "rewritten")
+                except Exception as e:
+                    telemetry_skip("xlsx_update_cells", "font", e)
 
                 try:
                     fill = cell.fill
                     if fill and fill.patternType == "solid":
                         curr_fill_hex = openpyxl_color_to_hex(fill.fgColor)
-                        if curr_fill_hex and curr_fill_hex in color_map and color_map[curr_fill_hex]:
+                        if curr_fill_hex and curr_fill_hex in color_map and color_map[curr_fill_hex] and apply_change(report, scope, "fills"):
                             new_hex = color_map[curr_fill_hex]
                             cell.fill = PatternFill(fill_type="solid", fgColor=Color(rgb="FF" + hex_no_hash(new_hex)))
-                except Exception:
-                    pass
+                            telemetry_count("xlsx_update_cells", "fill", "rewritten")
+                except Exception as e:
+                    telemetry_skip("xlsx_update_cells", "fill", e)
 
                 try:
                     b = cell.border
-                    if b:
+                    if b and report is not None:
+                        for side_name in ["left", "right", "top", "bottom"]:
+                            side = getattr(b, side_name)
+                            hexv = openpyxl_color_to_hex(side.color) if side and side.color else None
+                            if hexv and hexv in color_map and color_map[hexv]:
+                                report.record(scope, "borders")
+                    elif b:
                         sides = {}
                         for side_name in ["left", "right", "top", "bottom"]:
                             side = getattr(b, side_name)
                             if side:
                                 hexv = openpyxl_color_to_hex(side.color) if side.color else None
                                 if hexv and hexv in color_map and color_map[hexv]:
+                                    telemetry_count("xlsx_update_cells", "border", "rewritten")
                                     new_side = Side(style=side.style, color=Color(rgb="FF" + hex_no_hash(color_map[hexv])))
                                 else:
                                     new_side = side
                                 sides[side_name] = new_side
                         cell.border = Border(left=sides.get("left", b.left), right=sides.get("right", b.right), top=sides.get("top", b.top), bottom=sides.get("bottom", b.bottom), diagonal=b.diagonal, diagonalDown=b.diagonalDown, diagonalUp=b.diagonalUp, outline=b.outline, vertical=b.vertical, horizontal=b.horizontal)
-                except Exception:
-                    pass
+                except Exception as e:
+                    telemetry_skip("xlsx_update_cells", "border", e)
+
+def xlsx_apply_updates(extracted, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], sink=None, text_map: Optional[Dict[str, str]] = None) -> Optional[bytes]:
+    wb = extracted["workbook"]
+    xlsx_update_cells(wb, color_map, font_map, text_map=text_map)
 
     if image_replacements and PIL_AVAILABLE:
         try:
@@ -1231,26 +2756,1987 @@ def xlsx_apply_updates(extracted, color_map: Dict[str, str], font_map: Dict[str,
                         if anchor:
                             xl_img.anchor = anchor
                         new_images.append(xl_img)
+                        telemetry_count("xlsx_apply_updates", "image", "rewritten")
                     else:
                         new_images.append(img)
                 ws._images = new_images
+        except Exception as e:
+            telemetry_skip("xlsx_apply_updates", "images", e)
+
+    if sink is not None:
+        xlsx_save(wb, sink)
+        return None
+    out_buf = io.BytesIO()
+    xlsx_save(wb, out_buf)
+    return out_buf.getvalue()
+
+def xlsx_save(wb, target) -> None:
+    # Workbook.save stamps the current time into docProps/core.xml; the writer alone keeps the input's timestamp
+    XLExcelWriter(wb, zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED, allowZip64=True)).save()
+
+
+# Apply helpers
+def reparse_for_apply(file_type: str, file_bytes: bytes, extracted: Dict[str, Any]) -> Dict[str, Any]:
+    """Extraction results are kept across reruns, so every apply mutates a freshly parsed document instead"""
+    fresh = dict(extracted)
+    if file_type == "docx":
+        fresh["document"] = DocxDocument(io.BytesIO(file_bytes))
+    elif file_type == "pptx":
+        fresh["presentation"] = Presentation(io.BytesIO(file_bytes))
+    elif file_type == "xlsx":
+        # Formulas are kept: with data_only every formula cell would be saved back as its cached value
+        fresh["workbook"] = openpyxl.load_workbook(io.BytesIO(file_bytes))
+    return fresh
+
+
+# Raster recolor
+# Brand colors baked into bitmap media are shifted toward their mapped color; alpha is left untouched
+RASTER_RECOLOR_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff"}
+RASTER_RECOLOR_SPACES = ["Lab", "HSV"]
+# Lab tolerance is a CIE76 distance, HSV tolerance a hue difference in degrees
+RASTER_RECOLOR_DEFAULT_TOLERANCE = {"Lab": 20, "HSV": 12}
+RASTER_RECOLOR_MIN_SATURATION = 0.15
+RASTER_RECOLOR_MIN_VALUE = 0.1
+RASTER_RECOLOR_MAX_PIXELS = 40_000_000
+# Larger maps (family mode remaps every member) are left to the XML rewrite; distances are computed in blocks of this many cells
+RASTER_RECOLOR_MAX_PAIRS = 256
+RASTER_RECOLOR_CHUNK_CELLS = 1 << 20
+# Peak bytes per decoded pixel: RGBA array, packed keys, unique sort, inverse index, output and re-encode buffers
+RASTER_RECOLOR_BYTES_PER_PIXEL = 40
+RASTER_RECOLOR_CACHE_ENTRIES = 256
+LAB_WHITE = (0.95047, 1.0, 1.08883)
+
+def srgb_to_lab(rgb: "np.ndarray") -> "np.ndarray":
+    """(..., 3) sRGB in 0..1 to CIE Lab (D65)"""
+    lin = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = lin @ np.array([[0.4124, 0.2126, 0.0193], [0.3576, 0.7152, 0.1192], [0.1805, 0.0722, 0.9505]]) / np.array(LAB_WHITE)
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+def lab_to_srgb(lab: "np.ndarray") -> "np.ndarray":
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f > 6 / 29, f ** 3, 3 * (6 / 29) ** 2 * (f - 4 / 29)) * np.array(LAB_WHITE)
+    lin = xyz @ np.array([[3.2406, -0.9689, 0.0557], [-1.5372, 1.8758, -0.2040], [-0.4986, 0.0415, 1.0570]])
+    lin = np.clip(lin, 0.0, 1.0)
+    return np.where(lin <= 0.0031308, lin * 12.92, 1.055 * lin ** (1 / 2.4) - 0.055)
+
+def srgb_to_hsv(rgb: "np.ndarray") -> "np.ndarray":
+    """(..., 3) RGB in 0..1 to hue in degrees, saturation and value in 0..1"""
+    v = rgb.max(axis=-1)
+    chroma = v - rgb.min(axis=-1)
+    safe = np.where(chroma == 0, 1.0, chroma)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    h = np.where(v == r, (g - b) / safe % 6, np.where(v == g, (b - r) / safe + 2, (r - g) / safe + 4)) * 60.0
+    h = np.where(chroma == 0, 0.0, h)
+    s = np.where(v == 0, 0.0, chroma / np.where(v == 0, 1.0, v))
+    return np.stack([h, s, v], axis=-1)
+
+def hsv_to_srgb(hsv: "np.ndarray") -> "np.ndarray":
+    h, s, v = hsv[..., 0] % 360 / 60.0, hsv[..., 1], hsv[..., 2]
+    k = np.stack([(5 + h) % 6, (3 + h) % 6, (1 + h) % 6], axis=-1)
+    return v[..., None] - (v * s)[..., None] * np.clip(np.minimum(k, 4 - k), 0.0, 1.0)
+
+def raster_recolor_colors(colors: "np.ndarray", src_v: "np.ndarray", dst_v: "np.ndarray", tolerance: float, space: str) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Hit mask and recolored uint8 values for an (n, 3) uint8 block of distinct colors"""
+    values = colors.astype(np.float64) / 255.0
+    if space == "HSV":
+        values = srgb_to_hsv(values)
+        hue_diff = np.abs((values[:, None, 0] - src_v[None, :, 0] + 180) % 360 - 180)
+        distance = np.where((values[:, None, 1] >= RASTER_RECOLOR_MIN_SATURATION) & (values[:, None, 2] >= RASTER_RECOLOR_MIN_VALUE), hue_diff, np.inf)
+    else:
+        values = srgb_to_lab(values)
+        distance = np.sqrt(((values[:, None, :] - src_v[None, :, :]) ** 2).sum(axis=-1))
+    nearest = distance.argmin(axis=1)
+    weight = np.clip((tolerance - distance[np.arange(len(values)), nearest]) / (tolerance / 2.0), 0.0, 1.0)
+    del distance
+    hit = weight > 0
+    # Only matched colors go through the color space round trip, the rest keep their exact values
+    values, nearest, weight = values[hit], nearest[hit], weight[hit]
+    if space == "HSV":
+        ratio_s = dst_v[nearest, 1] / np.maximum(src_v[nearest, 1], 1e-6)
+        ratio_v = dst_v[nearest, 2] / np.maximum(src_v[nearest, 2], 1e-6)
+        shifted = np.stack([values[:, 0] + (dst_v[nearest, 0] - src_v[nearest, 0]) * weight, np.clip(values[:, 1] * (1 + (ratio_s - 1) * weight), 0, 1), np.clip(values[:, 2] * (1 + (ratio_v - 1) * weight), 0, 1)], axis=-1)
+        converted = hsv_to_srgb(shifted)
+    else:
+        converted = lab_to_srgb(values + (dst_v[nearest] - src_v[nearest]) * weight[:, None])
+    return hit, np.round(np.clip(converted, 0.0, 1.0) * 255).astype(np.uint8)
+
+def raster_recolor_pixels(rgb: "np.ndarray", pairs: List[Tuple[str, str]], tolerance: float, space: str = "Lab") -> Optional["np.ndarray"]:
+    """Shift pixels near each source color by the source-to-target offset, keeping shading and anti-aliasing.
+
+    Pixels within half the tolerance move fully and the shift fades out at the tolerance. Each distinct color is matched
+    once, in blocks of at most RASTER_RECOLOR_CHUNK_CELLS color-pair distances. Returns None when nothing matched."""
+    if not pairs or tolerance <= 0 or len(pairs) > RASTER_RECOLOR_MAX_PAIRS:
+        return None
+    src = np.array([[int(a[i:i + 2], 16) for i in (1, 3, 5)] for a, _ in pairs], dtype=np.float64) / 255.0
+    dst = np.array([[int(b[i:i + 2], 16) for i in (1, 3, 5)] for _, b in pairs], dtype=np.float64) / 255.0
+    to_space = srgb_to_hsv if space == "HSV" else srgb_to_lab
+    src_v, dst_v = to_space(src), to_space(dst)
+    flat = rgb.reshape(-1, 3)
+    keys = (flat[:, 0].astype(np.uint32) << 16) | (flat[:, 1].astype(np.uint32) << 8) | flat[:, 2]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    palette = np.stack([keys >> 16, (keys >> 8) & 255, keys & 255], axis=-1).astype(np.uint8)
+    del keys
+    changed = False
+    step = max(1, RASTER_RECOLOR_CHUNK_CELLS // len(pairs))
+    for start in range(0, len(palette), step):
+        block = palette[start:start + step]
+        hit, converted = raster_recolor_colors(block, src_v, dst_v, tolerance, space)
+        if hit.any():
+            block[hit] = converted
+            changed = True
+    if not changed:
+        return None
+    return palette[inverse.reshape(-1)].reshape(rgb.shape)
+
+def raster_recolor_image(data: bytes, ext: str, pairs: List[Tuple[str, str]], tolerance: float, space: str = "Lab") -> Optional[bytes]:
+    """Recolored image bytes in the original format, or None when no pixel is near a source color"""
+    if not (NUMPY_AVAILABLE and PIL_AVAILABLE) or ext.lower() not in RASTER_RECOLOR_EXTENSIONS:
+        return None
+    try:
+        img = PILImage.open(io.BytesIO(data))
+        if img.width * img.height > RASTER_RECOLOR_MAX_PIXELS:
+            return None
+        fmt = img.format or "PNG"
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        arr = np.asarray(img.convert("RGBA" if has_alpha else "RGB"))
+        recolored = raster_recolor_pixels(arr[..., :3], pairs, tolerance, space)
+        if recolored is None or np.array_equal(recolored, arr[..., :3]):
+            return None
+        if has_alpha:
+            recolored = np.dstack([recolored, arr[..., 3]])
+        out_img = PILImage.fromarray(recolored, "RGBA" if has_alpha else "RGB")
+        out = io.BytesIO()
+        if fmt == "JPEG":
+            out_img.save(out, format="JPEG", quality=95)
+        else:
+            out_img.save(out, format=fmt)
+        return out.getvalue()
+    except Exception:
+        return None
+
+def raster_recolor_candidates(extracted) -> List[ImageRecord]:
+    """Every package media part (docx and the pptx 'All Media' list) and worksheet image, once each"""
+    return [img for img in extracted.get("images", []) if img.uid.startswith(("word/media/", "ppt/media/")) or img.kind == "sheet_image"]
+
+def raster_recolor_pairs(color_map: Dict[str, str]) -> List[Tuple[str, str]]:
+    return sorted((a.upper(), b.upper()) for a, b in color_map.items() if a and b and a.upper() != b.upper())
+
+def raster_recolor_peak_bytes(images: Optional[List[ImageRecord]], color_map: Dict[str, str]) -> int:
+    """Peak memory of recoloring the largest candidate image; image headers are read without decoding.
+
+    Without image records (the watch folder extracts inside the job) the pixel cap is charged instead."""
+    pairs = len(raster_recolor_pairs(color_map))
+    if not pairs or pairs > RASTER_RECOLOR_MAX_PAIRS or not (NUMPY_AVAILABLE and PIL_AVAILABLE):
+        return 0
+    # Distance, difference and weight arrays of one block
+    block = RASTER_RECOLOR_CHUNK_CELLS * 8 * 6
+    if images is None:
+        return RASTER_RECOLOR_MAX_PIXELS * RASTER_RECOLOR_BYTES_PER_PIXEL + block
+    largest = 0
+    for img in images:
+        if os.path.splitext(img.media_path or "")[1].lower() not in RASTER_RECOLOR_EXTENSIONS and img.kind != "sheet_image":
+            continue
+        try:
+            with PILImage.open(io.BytesIO(img.data)) as probe:
+                pixels = probe.width * probe.height
+        except Exception:
+            continue
+        if pixels <= RASTER_RECOLOR_MAX_PIXELS:
+            largest = max(largest, pixels)
+    return largest * RASTER_RECOLOR_BYTES_PER_PIXEL + block if largest else 0
+
+def raster_recolor_replacements(extracted, color_map: Dict[str, str], tolerance: float, space: str = "Lab", skip: Optional[Set[str]] = None) -> Dict[str, bytes]:
+    """Replacement bytes keyed like user replacements (media path or sheet image uid) for every image that changed"""
+    pairs = raster_recolor_pairs(color_map)
+    if not pairs or len(pairs) > RASTER_RECOLOR_MAX_PAIRS:
+        return {}
+    cache = raster_recolor_cache()
+    settings = f"{space}-{tolerance}-" + ",".join(f"{a}>{b}" for a, b in pairs)
+    done: Dict[str, Optional[bytes]] = {}
+    repls: Dict[str, bytes] = {}
+    for img in raster_recolor_candidates(extracted):
+        if skip and img.uid in skip:
+            continue
+        digest = img.digest
+        if not digest:
+            continue
+        if digest not in done:
+            # Shared images are decoded once per call and once per process while cached
+            hit = cache.get(f"{digest}-{settings}")
+            if hit is None:
+                ext = os.path.splitext(img.media_path or "")[1] or ".png"
+                hit = {"data": raster_recolor_image(img.data, ext, pairs, tolerance, space)}
+                cache.put(f"{digest}-{settings}", hit)
+            done[digest] = hit["data"]
+        if done[digest]:
+            repls[img.uid] = done[digest]
+    return repls
+
+def with_recolored_media(file_type: str, extracted, image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], color_map: Dict[str, str], recolor: Optional[Dict[str, Any]]) -> Tuple[Dict[str, bytes], int]:
+    """User replacements plus recolored media; media the user already replaced is left to the user's image"""
+    if not recolor or file_type == "pdf":
+        return image_replacements, 0
+    skip = set(image_replacements) | set(theme_image_replacements)
+    for img in extracted.get("images", []):
+        if img.uid in image_replacements and img.media_path:
+            skip.add(img.media_path)
+    recolored = raster_recolor_replacements(extracted, color_map, recolor["tolerance"], recolor["space"], skip)
+    return {**recolored, **image_replacements}, len(recolored)
+
+
+# Palette clustering
+# Documents stitched together from many sources carry hundreds of near-identical colors. k-means in Lab groups them
+# into families with one picker each; remapping a family moves every member by the same Lab offset, keeping tints apart
+PALETTE_FAMILY_MIN_COLORS = 24
+PALETTE_FAMILY_DEFAULT_COUNT = 12
+PALETTE_FAMILY_MAX_COUNT = 40
+PALETTE_KMEANS_ITERATIONS = 50
+
+def hex_to_unit_rgb(colors: List[str]) -> "np.ndarray":
+    return np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] for c in colors], dtype=np.float64) / 255.0
+
+def unit_rgb_to_hex(rgb: "np.ndarray") -> List[str]:
+    values = np.round(np.clip(rgb, 0.0, 1.0) * 255).astype(int)
+    return ["#{:02X}{:02X}{:02X}".format(*row) for row in values]
+
+def palette_kmeans(lab: "np.ndarray", count: int) -> Tuple["np.ndarray", "np.ndarray"]:
+    """(labels, centers) for the rows of lab; farthest-point seeding keeps the result the same on every rerun"""
+    count = max(1, min(count, len(lab)))
+    seeds = [int(((lab - lab.mean(axis=0)) ** 2).sum(axis=1).argmin())]
+    nearest = ((lab - lab[seeds[0]]) ** 2).sum(axis=1)
+    for _ in range(1, count):
+        seeds.append(int(nearest.argmax()))
+        nearest = np.minimum(nearest, ((lab - lab[seeds[-1]]) ** 2).sum(axis=1))
+    centers = lab[seeds].copy()
+    labels = np.full(len(lab), -1)
+    for _ in range(PALETTE_KMEANS_ITERATIONS):
+        assigned = ((lab[:, None, :] - centers[None, :, :]) ** 2).sum(axis=-1).argmin(axis=1)
+        if (assigned == labels).all():
+            break
+        labels = assigned
+        for j in range(count):
+            members = lab[labels == j]
+            if len(members):
+                centers[j] = members.mean(axis=0)
+    return labels, centers
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def palette_families(colors: Tuple[str, ...], count: int) -> List[Dict[str, Any]]:
+    """Families of similar colors, largest first; each is named by the member nearest its center"""
+    if not colors:
+        return []
+    lab = srgb_to_lab(hex_to_unit_rgb(list(colors)))
+    labels, centers = palette_kmeans(lab, count)
+    families = []
+    for j in range(len(centers)):
+        idx = np.flatnonzero(labels == j)
+        if not len(idx):
+            continue
+        order = idx[((lab[idx] - centers[j]) ** 2).sum(axis=1).argsort()]
+        families.append({"color": colors[order[0]], "members": [colors[i] for i in order]})
+    return sorted(families, key=lambda family: (-len(family["members"]), family["color"]))
+
+def palette_family_color_map(families: List[Dict[str, Any]], targets: Dict[str, str]) -> Dict[str, str]:
+    """Member -> new color for every family whose color was changed to targets[family color]"""
+    color_map: Dict[str, str] = {}
+    for family in families:
+        target = targets.get(family["color"])
+        if not target or target.upper() == family["color"]:
+            continue
+        shift = srgb_to_lab(hex_to_unit_rgb([target.upper()]))[0] - srgb_to_lab(hex_to_unit_rgb([family["color"]]))[0]
+        moved = unit_rgb_to_hex(lab_to_srgb(srgb_to_lab(hex_to_unit_rgb(family["members"])) + shift))
+        color_map.update(zip(family["members"], moved))
+        # The family color itself lands exactly on the picked color, free of round-trip drift
+        color_map[family["color"]] = target.upper()
+    return {old: new for old, new in color_map.items() if old != new}
+
+
+# SVG media
+# SVG logos and icons are rewritten as text: an expat pass finds the color-bearing attributes and <style> blocks,
+# and only those byte ranges are edited, so the rest of the file is kept byte for byte
+# openpyxl drops workbook SVGs on save, so only documents and presentations are covered
+SVG_MEDIA_DIRS = ("word/media/", "ppt/media/")
+SVG_COLOR_ATTRIBUTES = ("fill", "stroke", "stop-color", "flood-color", "lighting-color", "color", "style")
+SVG_ATTRIBUTE_RE = re.compile(rb"""(\s(?:%s)\s*=\s*)(["'])(.*?)\2""" % b"|".join(a.encode() for a in SVG_COLOR_ATTRIBUTES), re.S)
+# Fragment references (url(#id), href="#id") and CSS id selectors (followed by "{" before any ";" or "}") look like hex colors
+SVG_COLOR_RE = re.compile(rb"""(?<!url\()(?<!url\(")(?<!url\(')(?<!href=")(?<!href=')#(?:[0-9A-Fa-f]{6}|[0-9A-Fa-f]{3})(?![0-9A-Fa-f])(?![^;{}]*\{)|rgb\(\s*\d{1,3}\s*,\s*\d{1,3}\s*,\s*\d{1,3}\s*\)""")
+# The fallback PNG is rendered from the same SVG, so only its anti-aliased edges stray from the exact colors
+SVG_FALLBACK_TOLERANCE = 12
+
+def svg_color_hex(token: bytes) -> Optional[str]:
+    if token.startswith(b"#"):
+        return color_hex(token.decode())
+    values = [int(v) for v in re.findall(rb"\d+", token)]
+    if any(v > 255 for v in values):
+        return None
+    return color_hex("".join(f"{v:02X}" for v in values))
+
+def svg_color_ranges(data: bytes) -> List[Tuple[int, int, bool]]:
+    """(start, end, is_tag) byte ranges that may hold colors: start tags with a color attribute and <style> contents"""
+    ranges: List[Tuple[int, int, bool]] = []
+    style_starts: List[int] = []
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+
+    def tag_end(start: int) -> int:
+        quote = None
+        for idx in range(start, len(data)):
+            ch = data[idx:idx + 1]
+            if quote:
+                if ch == quote:
+                    quote = None
+            elif ch in (b'"', b"'"):
+                quote = ch
+            elif ch == b">":
+                return idx + 1
+        return len(data)
+
+    def on_start(name, attrs):
+        start = parser.CurrentByteIndex
+        if any(attr in SVG_COLOR_ATTRIBUTES for attr in attrs):
+            ranges.append((start, tag_end(start), True))
+        if name.rsplit(":", 1)[-1] == "style":
+            style_starts.append(tag_end(start))
+
+    def on_end(name):
+        if name.rsplit(":", 1)[-1] == "style" and style_starts:
+            ranges.append((style_starts.pop(), parser.CurrentByteIndex, False))
+
+    parser.StartElementHandler = on_start
+    parser.EndElementHandler = on_end
+    parser.Parse(data, True)
+    return ranges
+
+def svg_rewrite_colors(data: bytes, color_map: Dict[str, str]) -> Tuple[Set[str], Optional[bytes]]:
+    """Colors found in an SVG and, when color_map changes any of them, the rewritten bytes"""
+    found: Set[str] = set()
+    targets = {k.upper(): v for k, v in (color_map or {}).items() if v}
+
+    def swap(match) -> bytes:
+        hexv = svg_color_hex(match.group(0))
+        if not hexv:
+            return match.group(0)
+        found.add(hexv)
+        new_hex = targets.get(hexv)
+        return new_hex.upper().encode() if new_hex and new_hex.upper() != hexv else match.group(0)
+
+    def swap_attribute(match) -> bytes:
+        return match.group(1) + match.group(2) + SVG_COLOR_RE.sub(swap, match.group(3)) + match.group(2)
+
+    out: List[bytes] = []
+    pos = 0
+    for start, end, is_tag in svg_color_ranges(data):
+        if start < pos:
+            continue
+        chunk = data[start:end]
+        out.append(data[pos:start])
+        out.append(SVG_ATTRIBUTE_RE.sub(swap_attribute, chunk) if is_tag else SVG_COLOR_RE.sub(swap, chunk))
+        pos = end
+    out.append(data[pos:])
+    rewritten = b"".join(out)
+    return found, (rewritten if rewritten != data else None)
+
+def svg_media_members(names: List[str]) -> List[str]:
+    return [n for n in names if n.startswith(SVG_MEDIA_DIRS) and n.lower().endswith(".svg")]
+
+def svg_media_colors(source: PackageSource) -> Set[str]:
+    """Every color used by the package's SVG media, for the palette"""
+    colors: Set[str] = set()
+    for name in svg_media_members(source.names()):
+        try:
+            colors |= svg_rewrite_colors(source.read(name), {})[0]
+        except Exception:
+            pass
+    return colors
+
+def svg_fallback_pairs(zf: zipfile.ZipFile) -> Dict[str, str]:
+    """SVG member -> the PNG fallback drawn in its place by older Office versions (a:blip next to asvg:svgBlip)"""
+    pairs: Dict[str, str] = {}
+    for name in zf.namelist():
+        if not name.endswith(".xml") or "_rels/" in name:
+            continue
+        try:
+            raw = zf.read(name)
+            if b"svgBlip" not in raw:
+                continue
+            targets = {r_id: target for r_id, _, target in pptx_part_rels(zf, name)}
+            for blip in ET.fromstring(raw).iter(pptx_qn("a:blip")):
+                png = targets.get(blip.get(pptx_qn("r:embed")))
+                for child in blip.iter():
+                    if child.tag.endswith("}svgBlip"):
+                        svg = targets.get(child.get(pptx_qn("r:embed")))
+                        if svg and png:
+                            pairs[svg] = png
+        except Exception:
+            pass
+    return pairs
+
+def svg_render_fallback(svg: bytes, fallback: bytes, color_map: Dict[str, str]) -> Optional[bytes]:
+    """Re-render the PNG fallback from the rewritten SVG at its current size, or recolor its pixels without cairosvg"""
+    if CAIROSVG_AVAILABLE and PIL_AVAILABLE:
+        try:
+            width, height = PILImage.open(io.BytesIO(fallback)).size
+            return cairosvg.svg2png(bytestring=svg, output_width=width, output_height=height)
         except Exception:
             pass
+    pairs = sorted((a.upper(), b.upper()) for a, b in color_map.items() if a and b and a.upper() != b.upper())
+    return raster_recolor_image(fallback, ".png", pairs, SVG_FALLBACK_TOLERANCE, "Lab")
+
+def svg_rebrand_members(file_bytes: bytes, color_map: Dict[str, str], include_unchanged: bool = False) -> Dict[str, bytes]:
+    """Rewritten SVG media and their regenerated PNG fallbacks; each distinct SVG is processed once.
+
+    With include_unchanged every SVG and fallback is returned, so a re-apply can restore parts a reverted mapping no longer touches."""
+    if not color_map and not include_unchanged:
+        return {}
+    members: Dict[str, bytes] = {}
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
+            infos = {info.filename: info for info in zf.infolist()}
+            svgs = svg_media_members(list(infos))
+            if not svgs:
+                return {}
+            fallbacks = svg_fallback_pairs(zf)
+            cache = raster_recolor_cache()
+            settings = "svg-" + ",".join(f"{a.upper()}>{b.upper()}" for a, b in sorted(color_map.items()) if b)
+            done: Dict[str, Dict[str, Optional[bytes]]] = {}
+            for name in svgs:
+                png = fallbacks.get(name)
+                # Keyed by content hashes: a CRC and size match could hand one image's rewrite to another
+                svg_data = zf.read(name)
+                png_data = zf.read(png) if png in infos else None
+                digest = f"{content_hash(svg_data)}-{content_hash(png_data) if png_data is not None else ''}"
+                if digest not in done:
+                    hit = cache.get(f"{digest}-{settings}")
+                    if hit is None:
+                        svg = svg_rewrite_colors(svg_data, color_map)[1]
+                        hit = {"svg": svg, "png": svg_render_fallback(svg, png_data, color_map) if svg and png_data is not None else None}
+                        cache.put(f"{digest}-{settings}", hit)
+                    done[digest] = hit
+                result = done[digest]
+                if result["svg"]:
+                    members[name] = result["svg"]
+                elif include_unchanged:
+                    members[name] = svg_data
+                if png_data is not None:
+                    if result["png"]:
+                        members[png] = result["png"]
+                    elif include_unchanged:
+                        members[png] = png_data
+    except Exception:
+        return members
+    return members
+
+def replaced_media_paths(file_type: str, extracted, image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes]) -> Set[str]:
+    """Media members the user replaced; derived rewrites such as SVG recoloring leave them alone"""
+    paths = {key for key in image_replacements if key.startswith(SVG_MEDIA_DIRS)} | set(theme_image_replacements)
+    if file_type == "pptx":
+        paths |= {img.media_path for img in extracted.get("images", []) if img.uid in image_replacements and img.media_path}
+    return paths
+
+
+# Embedded packages
+# Charts and objects embedded in a document are full OOXML packages; rebrand them with the parent's mappings
+EMBEDDED_PACKAGE_DIRS = ("word/embeddings/", "ppt/embeddings/", "xl/embeddings/")
+EMBEDDED_PACKAGE_TYPES = {".docx": "docx", ".pptx": "pptx", ".xlsx": "xlsx"}
+EMBEDDED_MAX_DEPTH = 3
+
+def embedded_package_members(file_bytes: bytes) -> Dict[str, str]:
+    """Embedded OOXML members mapped to the engine that rebrands them (legacy OLE .bin objects are skipped)"""
+    members: Dict[str, str] = {}
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes), 'r') as zf:
+            for name in zf.namelist():
+                file_type = EMBEDDED_PACKAGE_TYPES.get(os.path.splitext(name)[1].lower())
+                if file_type and name.startswith(EMBEDDED_PACKAGE_DIRS):
+                    members[name] = file_type
+    except Exception:
+        pass
+    available = {"docx": DOCX_AVAILABLE, "pptx": PPTX_AVAILABLE, "xlsx": OPENPYXL_AVAILABLE}
+    return {name: file_type for name, file_type in members.items() if available[file_type]}
+
+def rebrand_package(file_type: str, file_bytes: bytes, color_map: Dict[str, str], font_map: Dict[str, str], depth: int = 0) -> bytes:
+    """Apply color/font mappings to a whole package, including the packages embedded in it"""
+    parsed = reparse_for_apply(file_type, file_bytes, {"images": []})
+    if file_type == "docx":
+        out_bytes = docx_apply_updates(parsed, color_map, font_map, {})
+    elif file_type == "pptx":
+        out_bytes = pptx_apply_updates(parsed, color_map, font_map, {}, {})
+    elif file_type == "xlsx":
+        out_bytes = xlsx_apply_updates(parsed, color_map, font_map, {})
+    else:
+        return file_bytes
+    # The embedded output becomes part of the parent's bytes, so it is packed with fixed timestamps as well
+    return embedded_apply_updates(file_bytes, out_bytes, color_map, font_map, depth + 1, policy=dict(DEFAULT_COMPRESSION_POLICY, deterministic=True))[0]
+
+def embedded_rebrand_members(file_bytes: bytes, color_map: Dict[str, str], font_map: Dict[str, str], depth: int = 0) -> Dict[str, bytes]:
+    """Rebrand every embedded package of the original file, one after another.
+
+    The engines are pure-Python tree walks that hold the GIL, so threads bought nothing inside a scheduler job."""
+    if depth > EMBEDDED_MAX_DEPTH or not (color_map or font_map):
+        return {}
+    members = embedded_package_members(file_bytes)
+    sources = zip_read_members(file_bytes, set(members))
+    if not sources:
+        return {}
+
+    rebuilt: Dict[str, bytes] = {}
+    for name, data in sources.items():
+        try:
+            rebuilt[name] = rebrand_package(members[name], data, color_map, font_map, depth)
+        except Exception as e:
+            telemetry_skip("embedded_rebrand_members", "package", e)
+    return rebuilt
+
+def embedded_apply_updates(file_bytes: bytes, output: bytes, color_map: Dict[str, str], font_map: Dict[str, str], depth: int = 0, sink=None, policy: Optional[Dict[str, Any]] = None, skip: Optional[Set[str]] = None) -> Tuple[Optional[bytes], List[str]]:
+    """Write the rebranded embeddings and SVG media of file_bytes into output, which still carries the original ones"""
+    members = embedded_rebrand_members(file_bytes, color_map, font_map, depth)
+    members.update({name: data for name, data in svg_rebrand_members(file_bytes, color_map).items() if not skip or name not in skip})
+    return zip_replace_media(output, members, sink, policy), sorted(members)
+
+
+# Dry run
+def dry_run_report(file_type: str, file_bytes: bytes, extracted, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], text_map: Optional[Dict[str, str]] = None, recolor: Optional[Dict[str, Any]] = None, depth: int = 0) -> ChangeReport:
+    """Run the apply matching on a throwaway parse and count what would change; nothing is converted or serialized.
+
+    SVG media, embedded packages and (with recolor) raster media are counted too, as Apply rewrites them as well."""
+    report = ChangeReport()
+    if file_type == "pdf":
+        pdf_process_document(file_bytes, color_map, font_map, image_replacements, report=report)
+        return report
+    parsed = reparse_for_apply(file_type, file_bytes, extracted)
+    if file_type == "docx":
+        docx_update_body(parsed["document"], color_map, font_map, report, text_map)
+        for name in image_replacements:
+            if name.startswith("word/media/"):
+                report.record("Media", "media")
+    elif file_type == "pptx":
+        for slide_idx, slide in enumerate(parsed["presentation"].slides):
+            pptx_update_slide(slide, slide_idx, color_map, font_map, image_replacements, report, text_map)
+        pptx_update_shared_parts(parsed["presentation"], color_map, font_map, report)
+        for uid in image_replacements:
+            if uid.startswith("ppt/media/"):
+                report.record("All Media", "media")
+        for media_path in theme_image_replacements:
+            report.record("Themes", "media", key=media_path)
+    elif file_type == "xlsx":
+        xlsx_update_cells(parsed["workbook"], color_map, font_map, report, text_map)
+        for img in extracted.get("images", []):
+            if img.uid in image_replacements:
+                report.record(img.group, "media")
+    if recolor:
+        groups = {img.uid: img.group for img in extracted.get("images", [])}
+        # The recolored bytes land in the recolor cache, so the following Apply reuses them
+        merged, _ = with_recolored_media(file_type, extracted, image_replacements, theme_image_replacements, color_map, recolor)
+        for uid in merged:
+            if uid not in image_replacements:
+                report.record(groups.get(uid) or "Media", "recolored images")
+    if color_map and file_type != "xlsx":
+        dry_run_svg_media(file_bytes, color_map, report, replaced_media_paths(file_type, extracted, image_replacements, theme_image_replacements))
+    dry_run_embedded(file_bytes, color_map, font_map, report, depth)
+    return report
+
+def dry_run_svg_media(file_bytes: bytes, color_map: Dict[str, str], report: ChangeReport, skip: Set[str]) -> None:
+    """Count the SVG media whose colors change and the PNG fallbacks re-rendered with them"""
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
+            names = zf.namelist()
+            fallbacks = svg_fallback_pairs(zf) if svg_media_members(names) else {}
+            for name in svg_media_members(names):
+                if name in skip or not svg_rewrite_colors(zf.read(name), color_map)[1]:
+                    continue
+                report.record("SVG media", "SVG images")
+                if fallbacks.get(name) in names:
+                    report.record("SVG media", "PNG fallbacks")
+    except Exception as e:
+        telemetry_skip("dry_run_report", "svg", e)
+
+def dry_run_embedded(file_bytes: bytes, color_map: Dict[str, str], font_map: Dict[str, str], report: ChangeReport, depth: int = 0) -> None:
+    """Count the changes inside each embedded package, scoped by the embedding's file name"""
+    if depth > EMBEDDED_MAX_DEPTH or not (color_map or font_map):
+        return
+    members = embedded_package_members(file_bytes)
+    for name, data in zip_read_members(file_bytes, set(members)).items():
+        try:
+            inner = dry_run_report(members[name], data, {"images": []}, color_map, font_map, {}, {}, depth=depth + 1)
+        except Exception as e:
+            telemetry_skip("dry_run_report", "embedded", e)
+            continue
+        for scope, bucket in inner.counts.items():
+            for category, count in bucket.items():
+                report.record(f"{name.split('/')[-1]}: {scope}", category, count)
+
+
+# Incremental re-apply
+def replacement_digests(replacements: Dict[str, bytes]) -> Dict[str, str]:
+    return {key: content_hash(data) for key, data in replacements.items()}
+
+def changed_mapping_keys(old_map: Dict[str, str], new_map: Dict[str, str]) -> Set[str]:
+    return {k for k in set(old_map) | set(new_map) if old_map.get(k) != new_map.get(k)}
+
+def build_apply_state(file_hash: str, file_type: str, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], output_path: str, template_hash: Optional[str] = None, text_map: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return {"file_hash": file_hash, "file_type": file_type, "color_map": dict(color_map), "font_map": dict(font_map), "image_digests": replacement_digests(image_replacements), "theme_image_digests": replacement_digests(theme_image_replacements), "output_path": output_path, "template_hash": template_hash, "text_map": dict(text_map or {})}
+
+def incremental_apply_updates(file_type: str, file_bytes: bytes, file_hash: str, extracted, last_state: Optional[Dict[str, Any]], color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], sink=None, policy: Optional[Dict[str, Any]] = None) -> Optional[Tuple[Optional[bytes], List[str]]]:
+    """Apply only the delta since the last apply on top of its output file; None means a full apply is required"""
+    if not last_state or last_state.get("file_hash") != file_hash or last_state.get("file_type") != file_type:
+        return None
+    if last_state.get("template_hash") or last_state.get("text_map"):
+        # A template swap rewires the whole package and replaced text can't be put back; neither output is a base for a delta
+        return None
+    base_path = last_state.get("output_path")
+    if not base_path or not os.path.exists(base_path):
+        # Expired with the temp-file TTL
+        return None
+
+    changed_keys = changed_mapping_keys(last_state["color_map"], color_map) | changed_mapping_keys(last_state["font_map"], font_map)
+    changed_uids = changed_mapping_keys(last_state["image_digests"], replacement_digests(image_replacements))
+    changed_theme_media = changed_mapping_keys(last_state["theme_image_digests"], replacement_digests(theme_image_replacements))
 
+    if not changed_keys and not changed_uids and not changed_theme_media:
+        return zip_replace_media(base_path, {}, sink, policy), []
+    try:
+        members = None
+        if file_type == "pptx":
+            members = pptx_incremental_members(file_bytes, extracted, changed_keys, changed_uids, changed_theme_media, color_map, font_map, image_replacements, theme_image_replacements)
+        elif file_type == "docx":
+            members = docx_incremental_members(file_bytes, changed_keys, changed_uids, color_map, font_map, image_replacements)
+        if members is not None:
+            if changed_keys:
+                # Embeddings and SVGs in the previous output carry the old mapping, so they are rebuilt from the original
+                if color_map or font_map:
+                    members.update(embedded_rebrand_members(file_bytes, color_map, font_map))
+                else:
+                    members.update(zip_read_members(file_bytes, set(embedded_package_members(file_bytes))))
+                skip = replaced_media_paths(file_type, extracted, image_replacements, theme_image_replacements)
+                members.update({name: data for name, data in svg_rebrand_members(file_bytes, color_map, include_unchanged=True).items() if name not in skip})
+            return zip_replace_media(base_path, members, sink, policy), sorted(members)
+    except Exception:
+        return None
+    # openpyxl regenerates every part on save and PDFs are already written as an incremental update,
+    # so workbooks and PDFs always take the full path
+    return None
+
+
+# PDF
+PDF_FILL_COLOR_OPERATORS = {b"rg", b"k", b"sc", b"scn"}
+PDF_STROKE_COLOR_OPERATORS = {b"RG", b"K", b"SC", b"SCN"}
+PDF_TEXT_SHOW_OPERATORS = {b"Tj", b"TJ", b"'", b'"'}
+PDF_PATH_FILL_OPERATORS = {b"f", b"F", b"f*", b"B", b"B*", b"b", b"b*"}
+PDF_PATH_STROKE_OPERATORS = {b"S", b"s", b"B", b"B*", b"b", b"b*"}
+PDF_STREAM_FILTER_KEYS = ("/Length", "/Filter", "/DecodeParms", "/DL")
+PDF_THUMBNAIL_CACHE_ENTRIES = 512
+PDF_THUMBNAILS_PER_VIEW = 12
+PDF_THUMBNAIL_WIDTH = 180
+PDF_IMAGE_THUMBNAIL_MAX = 160
+
+def pdf_operands_to_hex(operands) -> Optional[str]:
+    try:
+        values = [float(v) for v in operands]
+    except Exception:
+        # Pattern names (scn /P0) and other non-numeric operands
+        return None
+    if len(values) == 3:
+        r, g, b = values
+    elif len(values) == 4:
+        c, m, y, k = values
+        r, g, b = (1 - c) * (1 - k), (1 - m) * (1 - k), (1 - y) * (1 - k)
+    else:
+        return None
+    return color_hex("{:02X}{:02X}{:02X}".format(*(max(0, min(255, int(round(v * 255)))) for v in (r, g, b))))
+
+def pdf_hex_to_operands(hex_color: str, count: int) -> List["FloatObject"]:
+    h = hex_no_hash(hex_color)
+    r, g, b = (int(h[i:i + 2], 16) / 255.0 for i in (0, 2, 4))
+    if count == 4:
+        k = 1 - max(r, g, b)
+        if k >= 1:
+            values = [0.0, 0.0, 0.0, 1.0]
+        else:
+            values = [(1 - r - k) / (1 - k), (1 - g - k) / (1 - k), (1 - b - k) / (1 - k), k]
+    else:
+        values = [r, g, b]
+    return [FloatObject(round(v, 4)) for v in values]
+
+def pdf_scan_operations(operations: List, text_colors: Set[str], shape_colors: Set[str], color_map: Optional[Dict[str, str]] = None) -> int:
+    """Collect colors actually painted by text/path operators; with color_map, rewrite matching color operators in place
+    and return how many were rewritten"""
+    fill_hex, stroke_hex = None, None
+    state_stack: List[Tuple[Optional[str], Optional[str]]] = []
+    changed = 0
+    for idx, (operands, operator) in enumerate(operations):
+        if operator in PDF_FILL_COLOR_OPERATORS or operator in PDF_STROKE_COLOR_OPERATORS:
+            hexv = pdf_operands_to_hex(operands)
+            if hexv and color_map and color_map.get(hexv):
+                # Keep the operator (and so the color space); only the component values change
+                operations[idx] = (pdf_hex_to_operands(color_map[hexv], len(operands)), operator)
+                changed += 1
+            if operator in PDF_FILL_COLOR_OPERATORS:
+                fill_hex = hexv
+            else:
+                stroke_hex = hexv
+        elif operator == b"q":
+            state_stack.append((fill_hex, stroke_hex))
+        elif operator == b"Q":
+            if state_stack:
+                fill_hex, stroke_hex = state_stack.pop()
+        elif operator in PDF_TEXT_SHOW_OPERATORS:
+            if fill_hex:
+                text_colors.add(fill_hex)
+        else:
+            if operator in PDF_PATH_FILL_OPERATORS and fill_hex:
+                shape_colors.add(fill_hex)
+            if operator in PDF_PATH_STROKE_OPERATORS and stroke_hex:
+                shape_colors.add(stroke_hex)
+    return changed
+
+def pdf_font_base_name(font) -> Optional[str]:
+    base = font.get("/BaseFont")
+    if base is None:
+        return None
+    name = str(base).lstrip("/")
+    # Subset fonts carry a six letter tag, e.g. ABCDEF+Arial
+    if len(name) > 7 and name[6] == "+" and name[:6].isupper():
+        name = name[7:]
+    return name
+
+def pdf_font_is_embedded(font) -> bool:
+    try:
+        candidates = [font]
+        descendants = font.get("/DescendantFonts")
+        if descendants is not None:
+            candidates.extend(d.get_object() for d in descendants.get_object())
+        for candidate in candidates:
+            descriptor = candidate.get("/FontDescriptor")
+            if descriptor is None:
+                continue
+            descriptor = descriptor.get_object()
+            if any(key in descriptor for key in ("/FontFile", "/FontFile2", "/FontFile3")):
+                return True
+    except Exception:
+        return True
+    return False
+
+def pdf_encode_replacement_image(data: bytes) -> Optional[Tuple[bytes, int, int]]:
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        img = PILImage.open(io.BytesIO(data))
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            flat = PILImage.new("RGB", img.size, (255, 255, 255))
+            flat.paste(img, mask=img.split()[-1])
+            img = flat
+        img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=90)
+        return out.getvalue(), img.width, img.height
+    except Exception:
+        return None
+
+def pdf_image_thumbnail(xobj) -> Optional[bytes]:
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        img = xobj.decode_as_image()
+        img.thumbnail((PDF_IMAGE_THUMBNAIL_MAX, PDF_IMAGE_THUMBNAIL_MAX))
+        out = io.BytesIO()
+        img.convert("RGB").save(out, format="JPEG", quality=80)
+        return out.getvalue()
+    except Exception:
+        return None
+
+def pdf_serialize(obj) -> bytes:
+    buf = io.BytesIO()
+    obj.write_to_stream(buf)
+    return buf.getvalue()
+
+def pdf_write_object(writer: Dict[str, Any], idnum: int, generation: int, body: bytes):
+    """Append one object to the incremental update section; it overrides the original object of the same number"""
+    chunk = b"%d %d obj\n" % (idnum, generation) + body + b"\nendobj\n"
+    writer["offsets"][idnum] = (writer["pos"], generation)
+    writer["out"].write(chunk)
+    writer["pos"] += len(chunk)
+
+def pdf_write_stream(writer: Dict[str, Any], ref, stream_dict, data: bytes):
+    d = DictionaryObject({k: v for k, v in stream_dict.items() if k not in PDF_STREAM_FILTER_KEYS})
+    compressed = zlib.compress(data)
+    d[NameObject("/Filter")] = NameObject("/FlateDecode")
+    d[NameObject("/Length")] = NumberObject(len(compressed))
+    pdf_write_object(writer, ref.idnum, ref.generation, pdf_serialize(d) + b"\nstream\n" + compressed + b"\nendstream")
+
+def pdf_process_content_stream(reader, ref, ctx: Dict[str, Any]):
+    try:
+        stream_obj = ref.get_object()
+        content = ContentStream(stream_obj, reader)
+        operations = content.operations
+        changed = pdf_scan_operations(operations, ctx["text_colors"], ctx["shape_colors"], ctx["color_map"])
+        if changed and ctx["report"] is not None:
+            ctx["report"].record(f"Page {ctx['page_index']+1}", "color operators", changed)
+        elif changed and ctx["writer"] is not None:
+            content.operations = operations
+            pdf_write_stream(ctx["writer"], ref, stream_obj, content.get_data())
+    except Exception:
+        pass
+
+def pdf_process_resources(reader, resources, ctx: Dict[str, Any], depth: int = 0):
+    """Fonts and XObjects of one resource dictionary; shared objects are handled once through ctx["visited"]"""
+    if resources is None or depth > 10:
+        return
+    visited: Set[int] = ctx["visited"]
+    try:
+        resources = resources.get_object()
+        font_dict = resources.get("/Font")
+        font_dict = font_dict.get_object() if font_dict is not None else {}
+        for font_ref in font_dict.values():
+            try:
+                if isinstance(font_ref, IndirectObject):
+                    if font_ref.idnum in visited:
+                        continue
+                    visited.add(font_ref.idnum)
+                font = font_ref.get_object()
+                name = pdf_font_base_name(font)
+                if not name:
+                    continue
+                ctx["fonts"].add(name)
+                new_name = (ctx["font_map"] or {}).get(name)
+                # Embedded programs cannot be swapped; only referenced (non-embedded) fonts are renamed
+                if new_name and isinstance(font_ref, IndirectObject) and not pdf_font_is_embedded(font) and apply_change(ctx["report"], f"Page {ctx['page_index']+1}", "fonts") and ctx["writer"] is not None:
+                    updated = DictionaryObject(dict(font.items()))
+                    updated[NameObject("/BaseFont")] = NameObject("/" + new_name.replace(" ", ""))
+                    pdf_write_object(ctx["writer"], font_ref.idnum, font_ref.generation, pdf_serialize(updated))
+            except Exception:
+                pass
+
+        xobjects = resources.get("/XObject")
+        xobjects = xobjects.get_object() if xobjects is not None else {}
+        for xobj_name, xobj_ref in xobjects.items():
+            try:
+                if not isinstance(xobj_ref, IndirectObject) or xobj_ref.idnum in visited:
+                    continue
+                visited.add(xobj_ref.idnum)
+                xobj = xobj_ref.get_object()
+                subtype = xobj.get("/Subtype")
+                if subtype == "/Image":
+                    raw = getattr(xobj, "_data", None) or xobj.get_data()
+                    uid = f"pdf_img_{content_hash(raw)}"
+                    if uid not in ctx["image_uids"]:
+                        ctx["image_uids"].add(uid)
+                        thumb = pdf_image_thumbnail(xobj) if ctx["writer"] is None and ctx["report"] is None else None
+                        ctx["images"].append(ImageRecord(uid, f"Page {ctx['page_index']+1} Image {str(xobj_name).lstrip('/')} ({xobj.get('/Width')}x{xobj.get('/Height')})", "Document", kind="pdf_image", page=ctx["page_index"], data=thumb))
+                    replacement = (ctx["image_replacements"] or {}).get(uid)
+                    if replacement and apply_change(ctx["report"], f"Page {ctx['page_index']+1}", "media") and ctx["writer"] is not None:
+                        encoded = pdf_encode_replacement_image(replacement)
+                        if encoded:
+                            data, width, height = encoded
+                            header = b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>" % (width, height, len(data))
+                            pdf_write_object(ctx["writer"], xobj_ref.idnum, xobj_ref.generation, header + b"\nstream\n" + data + b"\nendstream")
+                elif subtype == "/Form":
+                    pdf_process_resources(reader, xobj.get("/Resources") or resources, ctx, depth + 1)
+                    pdf_process_content_stream(reader, xobj_ref, ctx)
+            except Exception:
+                pass
+    except Exception:
+        pass
+
+def pdf_find_startxref(file_bytes: bytes) -> int:
+    pos = file_bytes.rfind(b"startxref")
+    if pos < 0:
+        return -1
+    try:
+        return int(file_bytes[pos + 9:pos + 40].split()[0])
+    except Exception:
+        return -1
+
+def pdf_finish_update(writer: Dict[str, Any], reader, file_bytes: bytes, prev_xref: int):
+    """Write the cross-reference section and trailer of the incremental update"""
+    offsets: Dict[int, Tuple[int, int]] = writer["offsets"]
+    trailer = reader.trailer
+    size = max(int(trailer.get("/Size", 0)), max(offsets) + 1)
+    extra = DictionaryObject()
+    for key in ("/Root", "/Info", "/ID"):
+        if key in trailer:
+            extra[NameObject(key)] = trailer.raw_get(key)
+    extra[NameObject("/Prev")] = NumberObject(prev_xref)
+
+    xref_pos = writer["pos"]
+    if file_bytes[prev_xref:prev_xref + 4] == b"xref":
+        rows = [b"xref\n"]
+        for idnum in sorted(offsets):
+            offset, generation = offsets[idnum]
+            rows.append(b"%d 1\n%010d %05d n\r\n" % (idnum, offset, generation))
+        extra[NameObject("/Size")] = NumberObject(size)
+        rows.append(b"trailer\n" + pdf_serialize(extra) + b"\n")
+        section = b"".join(rows)
+    else:
+        # The original uses a cross-reference stream, so the update does too
+        xref_id = size
+        offsets = dict(offsets)
+        offsets[xref_id] = (xref_pos, 0)
+        ids = sorted(offsets)
+        data = b"".join(struct.pack(">BIH", 1, offsets[i][0], offsets[i][1]) for i in ids)
+        extra[NameObject("/Type")] = NameObject("/XRef")
+        extra[NameObject("/Size")] = NumberObject(xref_id + 1)
+        extra[NameObject("/W")] = ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)])
+        extra[NameObject("/Index")] = ArrayObject([NumberObject(v) for i in ids for v in (i, 1)])
+        extra[NameObject("/Length")] = NumberObject(len(data))
+        section = b"%d 0 obj\n" % xref_id + pdf_serialize(extra) + b"\nstream\n" + data + b"\nendstream\nendobj\n"
+    writer["out"].write(section + b"startxref\n%d\n%%%%EOF\n" % xref_pos)
+
+def pdf_process_document(file_bytes: bytes, color_map: Optional[Dict[str, str]] = None, font_map: Optional[Dict[str, str]] = None, image_replacements: Optional[Dict[str, bytes]] = None, out=None, report: Optional[ChangeReport] = None) -> Dict[str, Any]:
+    """Walk the document page by page; with `out`, write the original followed by an incremental update holding only rewritten objects"""
+    reader = PdfReader(io.BytesIO(file_bytes))
+    if reader.is_encrypted:
+        raise ValueError("Encrypted PDFs are not supported")
+    writer = None
+    if out is not None:
+        out.write(file_bytes)
+        writer = {"out": out, "offsets": {}, "pos": len(file_bytes)}
+        if not file_bytes.endswith(b"\n"):
+            out.write(b"\n")
+            writer["pos"] += 1
+    ctx: Dict[str, Any] = {"writer": writer, "color_map": color_map, "font_map": font_map, "image_replacements": image_replacements, "visited": set(), "text_colors": set(), "shape_colors": set(), "fonts": set(), "images": [], "image_uids": set(), "page_index": 0, "report": report}
+
+    page_count = len(reader.pages)
+    for page_index in range(page_count):
+        ctx["page_index"] = page_index
+        page = reader.pages[page_index]
+        pdf_process_resources(reader, page.get("/Resources"), ctx)
+        contents = page.raw_get("/Contents") if "/Contents" in page else None
+        if isinstance(contents, IndirectObject) and isinstance(contents.get_object(), ArrayObject):
+            contents = contents.get_object()
+        refs = list(contents) if isinstance(contents, ArrayObject) else [contents] if contents is not None else []
+        for ref in refs:
+            if isinstance(ref, IndirectObject) and ref.idnum not in ctx["visited"]:
+                ctx["visited"].add(ref.idnum)
+                pdf_process_content_stream(reader, ref, ctx)
+        # Drop parsed objects of this page so the working set stays one page wide
+        reader.resolved_objects.clear()
+
+    if writer is not None and writer["offsets"]:
+        prev_xref = pdf_find_startxref(file_bytes)
+        if prev_xref < 0:
+            raise ValueError("Could not locate the cross-reference table")
+        pdf_finish_update(writer, reader, file_bytes, prev_xref)
+    return {"text_colors": sorted(ctx["text_colors"]), "shape_colors": sorted(ctx["shape_colors"]), "background_colors": [], "fonts": sorted(ctx["fonts"]), "images": ctx["images"], "page_count": page_count, "updated_objects": len(writer["offsets"]) if writer else 0}
+
+def pdf_extract(file_bytes: bytes):
+    if not PDF_AVAILABLE:
+        return None
+    return pdf_process_document(file_bytes)
+
+def pdf_apply_updates(file_bytes: bytes, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], sink=None) -> Optional[bytes]:
+    """With a sink the updated PDF is written there and None is returned"""
+    if sink is not None:
+        pdf_process_document(file_bytes, color_map, font_map, image_replacements, out=sink)
+        return None
     out_buf = io.BytesIO()
-    wb.save(out_buf)
+    pdf_process_document(file_bytes, color_map, font_map, image_replacements, out=out_buf)
     return out_buf.getvalue()
 
+def pdf_rasterizer_available() -> bool:
+    return PDFIUM_AVAILABLE or shutil.which("pdftoppm") is not None
 
-# PDF
-def pdf_preview(file_bytes: bytes):
-    st.warning("PDF preview and in-place full rebranding are limited in this tool. You can download and review the uploaded PDF below.")
+@st.cache_resource
+def pdfium_lock() -> threading.Lock:
+    # pdfium is not thread-safe and every session renders from its own script thread
+    return threading.Lock()
+
+def pdf_local_copy(doc_hash: str, _file_bytes: bytes) -> str:
+    """One copy per document for command-line rasterizers, instead of one per rendered page. Copies live in the
+    output folder and go with its TTL sweep; each use refreshes the mtime so a copy being previewed is kept."""
+    path = os.path.join(OUTPUT_DIR, f"preview-{doc_hash}.pdf")
+    try:
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    cleanup_output_files()
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # Written under a temp name and moved into place, so another session never rasterizes a partial file
+    fd, tmp_path = tempfile.mkstemp(prefix="preview-", suffix=".tmp", dir=OUTPUT_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_file_bytes)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def pdf_page_count(doc_hash: str, _file_bytes: bytes) -> int:
+    try:
+        return len(PdfReader(io.BytesIO(_file_bytes)).pages)
+    except Exception:
+        return 0
+
+@st.cache_data(max_entries=PDF_THUMBNAIL_CACHE_ENTRIES, show_spinner=False)
+def pdf_render_page_thumbnail(doc_hash: str, page_index: int, width_px: int, _file_bytes: bytes) -> Optional[bytes]:
+    """Rasterize a single page; cached by (document hash, page, width) with LRU eviction"""
+    try:
+        if PDFIUM_AVAILABLE:
+            with pdfium_lock():
+                pdf = pdfium.PdfDocument(_file_bytes)
+                try:
+                    page = pdf[page_index]
+                    img = page.render(scale=width_px / float(page.get_width())).to_pil()
+                finally:
+                    pdf.close()
+            out = io.BytesIO()
+            img.convert("RGB").save(out, format="JPEG", quality=80)
+            return out.getvalue()
+        exe = shutil.which("pdftoppm")
+        if exe:
+            src = pdf_local_copy(doc_hash, _file_bytes)
+            page_no = str(page_index + 1)
+            with tempfile.TemporaryDirectory() as tmp:
+                out_root = os.path.join(tmp, "page")
+                subprocess.run([exe, "-f", page_no, "-l", page_no, "-scale-to-x", str(width_px), "-scale-to-y", "-1", "-jpeg", "-singlefile", src, out_root], check=True, capture_output=True, timeout=60)
+                with open(out_root + ".jpg", "rb") as f:
+                    return f.read()
+    except Exception:
+        return None
+    return None
+
+def pdf_preview(file_bytes: bytes, doc_hash: str):
+    st.info("PDF colors, fonts and images are rebranded page by page. Embedded fonts cannot be substituted; only fonts referenced by name are renamed.")
+    page_count = pdf_page_count(doc_hash, file_bytes)
+    st.write(f"Pages: {page_count}")
+    if not pdf_rasterizer_available():
+        st.caption("Install pypdfium2 (pip install pypdfium2) or poppler's pdftoppm to see page thumbnails.")
+    elif page_count:
+        # Only the visible window of pages is rasterized; each page is rendered once and then served from cache
+        view_count = (page_count + PDF_THUMBNAILS_PER_VIEW - 1) // PDF_THUMBNAILS_PER_VIEW
+        view = 1
+        if view_count > 1:
+            view = st.slider("Page range", min_value=1, max_value=view_count, value=1, format=f"Pages view %d of {view_count}", key="pdf_thumb_view")
+        start = (view - 1) * PDF_THUMBNAILS_PER_VIEW
+        cols = st.columns(4)
+        for pos, page_index in enumerate(range(start, min(start + PDF_THUMBNAILS_PER_VIEW, page_count))):
+            with cols[pos % 4]:
+                thumb = pdf_render_page_thumbnail(doc_hash, page_index, PDF_THUMBNAIL_WIDTH, file_bytes)
+                if thumb:
+                    st.image(thumb, caption=f"Page {page_index+1}", use_container_width=True)
+                else:
+                    st.write(f"Page {page_index+1}: (Preview unavailable)")
+        with st.expander("Open a page", expanded=False):
+            page_no = st.number_input("Page", min_value=1, max_value=page_count, value=start + 1, key="pdf_open_page")
+            page_img = pdf_render_page_thumbnail(doc_hash, int(page_no) - 1, 900, file_bytes)
+            if page_img:
+                st.image(page_img, use_container_width=True)
     st.download_button("Download uploaded PDF", data=file_bytes, file_name="uploaded.pdf")
 
 
+# Job scheduling
+# One scheduler per server process: applies from every session share a bounded pool and a memory budget
+JOB_MAX_WORKERS = max(1, int(os.environ.get("REBRAND_MAX_WORKERS", "2")))
+JOB_MEMORY_BUDGET_MB = int(os.environ.get("REBRAND_MEMORY_BUDGET_MB", "4096"))
+JOB_MAX_INPUT_MB = int(os.environ.get("REBRAND_MAX_INPUT_MB", "500"))
+# Rough peak memory of an apply as a multiple of the input size (parsed tree, output buffer, media copies)
+JOB_MEMORY_FACTORS = {"docx": 8, "pptx": 8, "xlsx": 12, "pdf": 4}
+JOB_POLL_SECONDS = 0.5
+EXTRACTION_CACHE_ENTRIES = 16
+QUICK_SCAN_POLL_SECONDS = 1.0
+
+class JobRejected(Exception):
+    pass
+
+class Job:
+    __slots__ = ("func", "args", "estimate", "future")
+
+    def __init__(self, func, args: Tuple, estimate: int):
+        self.func = func
+        self.args = args
+        self.estimate = estimate
+        self.future: Future = Future()
+
+class JobScheduler:
+    """FIFO queue in front of a bounded pool; a job starts once a worker and enough memory budget are free"""
+
+    def __init__(self, max_workers: int, memory_budget: int, max_input: int):
+        self.max_workers = max_workers
+        self.memory_budget = memory_budget
+        self.max_input = max_input
+        self._lock = threading.Lock()
+        self._waiting: List[Job] = []
+        self._running = 0
+        self._reserved = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rebrand-job")
+
+    def submit(self, func, *args, input_size: int, estimate: int) -> Job:
+        if input_size > self.max_input:
+            raise JobRejected(f"The document is {input_size / 1048576:.0f} MB; this server accepts up to {self.max_input / 1048576:.0f} MB.")
+        if estimate > self.memory_budget:
+            raise JobRejected(f"Rebranding this document needs about {estimate / 1048576:.0f} MB, more than this server's {self.memory_budget / 1048576:.0f} MB budget.")
+        job = Job(func, args, estimate)
+        with self._lock:
+            self._waiting.append(job)
+            self._dispatch()
+        return job
+
+    def position(self, job: Job) -> int:
+        """1-based place in the queue, 0 once the job has started"""
+        with self._lock:
+            return self._waiting.index(job) + 1 if job in self._waiting else 0
+
+    def cancel(self, job: Job) -> None:
+        with self._lock:
+            if job in self._waiting:
+                self._waiting.remove(job)
+                job.future.cancel()
+
+    def _dispatch(self) -> None:
+        # Strict FIFO: the head waits for budget instead of being overtaken by smaller jobs
+        while self._waiting and self._running < self.max_workers and (self._running == 0 or self._reserved + self._waiting[0].estimate <= self.memory_budget):
+            job = self._waiting.pop(0)
+            self._running += 1
+            self._reserved += job.estimate
+            self._pool.submit(self._run, job)
+
+    def _run(self, job: Job) -> None:
+        try:
+            if job.future.set_running_or_notify_cancel():
+                job.future.set_result(job.func(*job.args))
+        except BaseException as e:
+            job.future.set_exception(e)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._reserved -= job.estimate
+                self._dispatch()
+
+@st.cache_resource
+def job_scheduler() -> JobScheduler:
+    return JobScheduler(JOB_MAX_WORKERS, JOB_MEMORY_BUDGET_MB * 1024 * 1024, JOB_MAX_INPUT_MB * 1024 * 1024)
+
+def job_memory_estimate(file_type: str, input_size: int, recolor_bytes: int = 0) -> int:
+    """Input size times the format factor, plus the raster recolor peak when recoloring is on (images are recolored one at a time).
+
+    Opted-in part workers touch the inherited parse tree, so each extra fork is charged another copy of it."""
+    forks = max(0, PART_WORKERS // JOB_MAX_WORKERS - 1) if file_type in ("pptx", "xlsx") and PART_FORK_AVAILABLE else 0
+    return input_size * JOB_MEMORY_FACTORS.get(file_type, 8) * (1 + forks) + recolor_bytes
+
+class ExtractionCache:
+    """Small LRU of extraction summaries keyed by content hash, shared by every session of the process"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+
+    def get(self, file_hash: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.pop(file_hash, None)
+            if entry is not None:
+                self._entries[file_hash] = entry
+            return entry
+
+    def put(self, file_hash: str, extracted: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries.pop(file_hash, None)
+            self._entries[file_hash] = extracted
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+
+@st.cache_resource
+def shared_extraction_cache() -> ExtractionCache:
+    return ExtractionCache(EXTRACTION_CACHE_ENTRIES)
+
+def extraction_summary(extracted: Dict[str, Any]) -> Dict[str, Any]:
+    # The parsed package holds every media blob; apply re-parses anyway, so only the summary is kept
+    return {key: value for key, value in extracted.items() if key not in ("document", "presentation", "workbook")}
+
+class BackgroundScan:
+    """A full extraction running on the scheduler, with the palette it has found so far"""
+
+    def __init__(self, quick: Dict[str, Any]):
+        self._lock = threading.Lock()
+        self.palette: Dict[str, Set[str]] = {key: set(quick.get(key, [])) for key in ("text_colors", "shape_colors", "background_colors", "fonts")}
+        self.base = {key: value for key, value in quick.items() if key not in self.palette}
+        self.slide_count = quick.get("slide_count", 0)
+        self.slides_done = 0
+        self.job: Optional[Job] = None
+
+    def merge(self, found: Dict[str, Set[str]]) -> None:
+        with self._lock:
+            for key, values in found.items():
+                self.palette[key] |= values
+            if "text_colors" in found:
+                self.slides_done += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The quick-scan result with everything found since merged in"""
+        with self._lock:
+            return dict(self.base, **{key: sorted(values) for key, values in self.palette.items()})
+
+    def palette_size(self) -> int:
+        with self._lock:
+            return sum(len(values) for values in self.palette.values())
+
+    def done(self) -> bool:
+        return self.job is not None and self.job.future.done()
+
+class ScanRegistry(ExtractionCache):
+    """Background scans by content hash, so sessions uploading the same deck share one"""
+
+    def start(self, file_hash: str, file_bytes: bytes, quick: Dict[str, Any], scheduler: JobScheduler, cache: ExtractionCache) -> BackgroundScan:
+        entry = self.get(file_hash)
+        if entry is not None:
+            return entry["scan"]
+        scan = BackgroundScan(quick)
+        scan.job = scheduler.submit(run_extract_job, file_hash, file_bytes, scan, cache, input_size=len(file_bytes), estimate=job_memory_estimate("pptx", len(file_bytes)))
+        self.put(file_hash, {"scan": scan})
+        return scan
+
+@st.cache_resource
+def background_scans() -> ScanRegistry:
+    return ScanRegistry(EXTRACTION_CACHE_ENTRIES)
+
+def run_extract_job(file_hash: str, file_bytes: bytes, scan: BackgroundScan, cache: ExtractionCache) -> None:
+    """Runs on a scheduler worker; the summary lands in the shared cache where every session looks first"""
+    telemetry = Telemetry()
+    with telemetry_scope(telemetry):
+        extracted = pptx_extract(file_bytes, progress=scan.merge)
+    if extracted is not None:
+        extracted["telemetry"] = telemetry.snapshot()
+        cache.put(file_hash, extraction_summary(extracted))
+
+class RecolorCache(ExtractionCache):
+    """LRU of recolored media keyed by content digest and recolor settings; {"data": None} marks images left as they are"""
+
+@st.cache_resource
+def raster_recolor_cache() -> RecolorCache:
+    return RecolorCache(RASTER_RECOLOR_CACHE_ENTRIES)
+
+def run_apply_job(file_type: str, file_bytes: bytes, file_hash: str, extracted, last_state: Optional[Dict[str, Any]], color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], output_path: str, policy: Optional[Dict[str, Any]] = None, recolor: Optional[Dict[str, Any]] = None, template: Optional[bytes] = None, telemetry: Optional[Telemetry] = None, text_map: Optional[Dict[str, str]] = None) -> List[str]:
+    """Runs on a scheduler worker and streams the result into output_path; returns notes instead of calling Streamlit"""
+    with telemetry_scope(telemetry):
+        return run_cached_apply(file_type, file_bytes, file_hash, extracted, last_state, color_map, font_map, image_replacements, theme_image_replacements, output_path, policy or DEFAULT_COMPRESSION_POLICY, recolor, template, text_map)
+
+def run_cached_apply(file_type: str, file_bytes: bytes, file_hash: str, extracted, last_state: Optional[Dict[str, Any]], color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], output_path: str, policy: Dict[str, Any], recolor: Optional[Dict[str, Any]] = None, template: Optional[bytes] = None, text_map: Optional[Dict[str, str]] = None) -> List[str]:
+    cache = result_cache() if RESULT_CACHE_MAX_MB > 0 else None
+    if cache is None:
+        return run_apply_engine(file_type, file_bytes, file_hash, extracted, last_state, color_map, font_map, image_replacements, theme_image_replacements, output_path, policy, recolor, template, text_map)
+    key = result_cache_key(file_type, file_hash, color_map, font_map, image_replacements, theme_image_replacements, policy, recolor, template, text_map)
+    cached_notes = cache.get(key, output_path)
+    if cached_notes is not None:
+        return cached_notes + ["Served from the result cache: this document was rebranded with the same mappings before."]
+    notes = run_apply_engine(file_type, file_bytes, file_hash, extracted, last_state, color_map, font_map, image_replacements, theme_image_replacements, output_path, dict(policy, deterministic=True), recolor, template, text_map)
+    cache.put(key, output_path, notes)
+    return notes
+
+def run_apply_engine(file_type: str, file_bytes: bytes, file_hash: str, extracted, last_state: Optional[Dict[str, Any]], color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], output_path: str, policy: Dict[str, Any], recolor: Optional[Dict[str, Any]] = None, template: Optional[bytes] = None, text_map: Optional[Dict[str, str]] = None) -> List[str]:
+    notes: List[str] = []
+    image_replacements, recolored = with_recolored_media(file_type, extracted, image_replacements, theme_image_replacements, color_map, recolor)
+    if recolored:
+        notes.append(f"Recolored brand colors inside {recolored} image(s).")
+    elif recolor and len(raster_recolor_pairs(color_map)) > RASTER_RECOLOR_MAX_PAIRS:
+        notes.append(f"Image recoloring was skipped: it supports up to {RASTER_RECOLOR_MAX_PAIRS} color mappings.")
+    with open(output_path, "wb") as sink:
+        try:
+            # Replaced text can't be localized to the parts a mapping touches, so it always takes a full apply
+            incremental = None if template or text_map else incremental_apply_updates(file_type, file_bytes, file_hash, extracted, last_state, color_map, font_map, image_replacements, theme_image_replacements, sink=sink, policy=policy)
+        except Exception:
+            incremental = None
+        if incremental is not None:
+            notes.append(f"Re-applied incrementally: {len(incremental[1])} part(s) rewritten, the rest reused from the previous output.")
+            return notes
+        sink.seek(0)
+        sink.truncate()
+
+        if file_type == "pdf":
+            pdf_apply_updates(file_bytes, color_map, font_map, image_replacements, sink=sink)
+            if text_map:
+                notes.append("Text replacements are not applied to PDFs.")
+            return notes
+
+        # Embedded packages, SVG media and repacking need one more rewrite, so only then is the engine output built in memory first
+        embedded = embedded_package_members(file_bytes) if color_map or font_map else {}
+        svgs = svg_media_members(zip_member_names(file_bytes)) if color_map and file_type != "xlsx" else []
+        engine_sink = None if embedded or svgs or policy["repack"] or policy.get("deterministic") else sink
+        output = None
+        if file_type == "docx":
+            output = docx_apply_updates(reparse_for_apply(file_type, file_bytes, extracted), color_map, font_map, image_replacements, sink=engine_sink, policy=policy, text_map=text_map)
+        elif file_type == "pptx" and template:
+            output, swap_notes = pptx_template_swap(reparse_for_apply(file_type, file_bytes, extracted), template, color_map, font_map, image_replacements, sink=engine_sink, policy=policy, text_map=text_map)
+            notes.extend(swap_notes)
+        elif file_type == "pptx":
+            output = pptx_apply_updates(reparse_for_apply(file_type, file_bytes, extracted), color_map, font_map, image_replacements, theme_image_replacements, sink=engine_sink, policy=policy, text_map=text_map)
+        elif file_type == "xlsx":
+            output = xlsx_apply_updates(reparse_for_apply(file_type, file_bytes, extracted), color_map, font_map, image_replacements, sink=engine_sink, text_map=text_map)
+        if output is not None:
+            _, rewritten = embedded_apply_updates(file_bytes, output, color_map, font_map, sink=sink, policy=policy, skip=replaced_media_paths(file_type, extracted, image_replacements, theme_image_replacements))
+            embedded_parts = [p for p in rewritten if p in embedded]
+            if embedded_parts:
+                notes.append(f"Rebranded {len(embedded_parts)} embedded package(s): " + ", ".join(p.split("/")[-1] for p in embedded_parts))
+            svg_parts = [p for p in rewritten if p in svgs]
+            if svg_parts:
+                notes.append(f"Recolored {len(svg_parts)} SVG image(s) and their PNG fallbacks.")
+    return notes
+
+
+# Output files
+# Results are streamed to temp files and served from disk; files older than the TTL are removed on the next apply
+# or PDF preview copy
+OUTPUT_DIR = os.path.join(tempfile.gettempdir(), "rebranding-outputs")
+OUTPUT_TTL_SECONDS = int(os.environ.get("REBRAND_OUTPUT_TTL_SECONDS", "3600"))
+
+def new_output_path(file_type: str) -> str:
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="rebranded-", suffix=f".{file_type}", dir=OUTPUT_DIR)
+    os.close(fd)
+    return path
+
+def cleanup_output_files(ttl_seconds: int = OUTPUT_TTL_SECONDS) -> None:
+    cutoff = time.time() - ttl_seconds
+    try:
+        for entry in os.scandir(OUTPUT_DIR):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except Exception:
+                pass
+    except Exception:
+        pass
+
+def read_output_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def render_output_download(path: str, file_name: str):
+    try:
+        # Deferred data: the file is read only when the user clicks, not held in session memory
+        st.download_button("Download rebranded document", data=lambda: read_output_file(path), file_name=file_name, on_click="ignore")
+    except Exception:
+        # Streamlit versions without deferred download data hold the whole file in memory for the button
+        size_mb = os.path.getsize(path) / 1048576
+        st.caption(f"This Streamlit version can't stream downloads from disk, so the {size_mb:.1f} MB result is held in server memory for this session. Streamlit 1.66 serves it from disk.")
+        with open(path, "rb") as f:
+            st.download_button("Download rebranded document", data=f, file_name=file_name)
+
+# Result cache
+# Outputs are kept on local disk under a key over everything that shapes them, so repeat rebrands of the same
+# document with the same mappings are copied instead of rebuilt; least recently used entries go past the size cap
+RESULT_CACHE_DIR = os.environ.get("REBRAND_RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "rebranding-results"))
+RESULT_CACHE_MAX_MB = int(os.environ.get("REBRAND_RESULT_CACHE_MB", "2048"))
+# Bump when a change alters the output produced for the same inputs
+# 2: XLSX applies keep formulas instead of saving their cached values; indexed Excel colors and DOCX table
+#    shading/border values in any hex form are matched and rewritten
+RESULT_CACHE_VERSION = 2
+
+def result_cache_key(file_type: str, file_hash: str, color_map: Dict[str, str], font_map: Dict[str, str], image_replacements: Dict[str, bytes], theme_image_replacements: Dict[str, bytes], policy: Dict[str, Any], recolor: Optional[Dict[str, Any]], template: Optional[bytes], text_map: Optional[Dict[str, str]] = None) -> str:
+    # Identity and empty mappings change nothing, and hex case is not significant
+    colors = {k.upper(): v.upper() for k, v in color_map.items() if v and v.upper() != k.upper()}
+    fonts = {k: v for k, v in font_map.items() if v and v != k}
+    profile = [RESULT_CACHE_VERSION, file_type, file_hash, colors, fonts, replacement_digests(image_replacements), replacement_digests(theme_image_replacements), policy, recolor, content_hash(template) if template else None]
+    texts = {k: v for k, v in (text_map or {}).items() if k and v != k}
+    if texts:
+        # Appended only when present, so entries written before text replacement existed stay valid
+        profile.append(texts)
+    return hashlib.sha256(json.dumps(profile, sort_keys=True).encode()).hexdigest()
+
+class ResultCache:
+    """Output files by key in one directory; an entry's mtime is its last use. Shared by every session of the process,
+    and safe to share between processes: entries are written under a temp name and moved into place."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return base + ".out", base + ".json"
+
+    def get(self, key: str, dest_path: str) -> Optional[List[str]]:
+        """Copy a cached output to dest_path and return its notes; None on a miss"""
+        out_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                notes = json.load(f)["notes"]
+            shutil.copyfile(out_path, dest_path)
+            os.utime(out_path)
+        except Exception:
+            return None
+        return notes
+
+    def put(self, key: str, src_path: str, notes: List[str]) -> None:
+        out_path, meta_path = self._paths(key)
+        tmp_path = None
+        try:
+            if not os.path.getsize(src_path):
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            # The output goes in first; the metadata file is what marks an entry complete
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f, open(src_path, "rb") as src:
+                shutil.copyfileobj(src, f)
+            os.replace(tmp_path, out_path)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"notes": notes}, f)
+            os.replace(tmp_path, meta_path)
+        except Exception:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        with self._lock:
+            entries = []
+            try:
+                for name in os.listdir(self.directory):
+                    if name.endswith(".out"):
+                        path = os.path.join(self.directory, name)
+                        stat = os.stat(path)
+                        entries.append((stat.st_mtime, stat.st_size, path))
+            except Exception:
+                return
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for stale in (path[:-4] + ".json", path):
+                    try:
+                        os.remove(stale)
+                    except Exception:
+                        pass
+                total -= size
+
+@st.cache_resource
+def result_cache() -> ResultCache:
+    return ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+
+# Watch folders
+# Documents dropped into the watch folders are rebranded with a fixed brand profile into a mirror folder.
+# Folders are polled: a file is taken once its size and mtime hold still for one poll, queued by content hash,
+# and skipped when the manifest shows the same content was already rebranded with the same profile.
+WATCH_DIRS = [d for d in os.environ.get("REBRAND_WATCH_DIRS", "").split(os.pathsep) if d]
+WATCH_MIRROR_DIR = os.environ.get("REBRAND_WATCH_MIRROR", "")
+WATCH_PROFILE_PATH = os.environ.get("REBRAND_WATCH_PROFILE", "")
+WATCH_POLL_SECONDS = float(os.environ.get("REBRAND_WATCH_POLL_SECONDS", "5"))
+# Watch jobs share the scheduler with interactive applies; only this many are handed to it at a time
+WATCH_MAX_IN_FLIGHT = max(1, JOB_MAX_WORKERS - 1)
+WATCH_MANIFEST_NAME = ".rebrand-manifest.json"
+WATCH_METRICS_NAME = ".rebrand-metrics.json"
+WATCH_THROUGHPUT_WINDOW_SECONDS = 300
+
+def load_watch_profile(path: str) -> Dict[str, Any]:
+    """A brand profile file: {"color_map": {...}, "font_map": {...}, "text_map": {...}, "compression": preset name, "recolor": {...} or null}"""
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    return {"color_map": dict(raw.get("color_map") or {}), "font_map": dict(raw.get("font_map") or {}), "text_map": dict(raw.get("text_map") or {}), "compression": raw.get("compression") or "Balanced", "recolor": raw.get("recolor")}
+
+def run_watch_job(file_type: str, file_bytes: bytes, file_hash: str, profile: Dict[str, Any], output_path: str, telemetry: Optional[Telemetry] = None) -> List[str]:
+    # Only recoloring needs the image records; everything else works from the parsed package
+    extracted: Dict[str, Any] = {"images": []}
+    if profile["recolor"] and file_type != "pdf":
+        with telemetry_scope(telemetry):
+            extracted = {"docx": docx_extract, "pptx": pptx_extract, "xlsx": xlsx_extract}[file_type](file_bytes)
+    return run_apply_job(file_type, file_bytes, file_hash, extracted, None, profile["color_map"], profile["font_map"], {}, {}, output_path, COMPRESSION_PRESETS.get(profile["compression"], DEFAULT_COMPRESSION_POLICY), profile["recolor"], None, telemetry, profile["text_map"])
+
+class WatchFolderService:
+    """Polls the watch folders on a daemon thread and rebrands new or changed documents on the job scheduler"""
+
+    def __init__(self, roots: List[str], mirror: str, profile: Dict[str, Any], scheduler: JobScheduler, poll_seconds: float = WATCH_POLL_SECONDS):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.mirror = os.path.abspath(mirror)
+        self.profile = profile
+        self.profile_hash = content_hash(json.dumps(profile, sort_keys=True).encode())
+        self.scheduler = scheduler
+        self.poll_seconds = poll_seconds
+        # Each root mirrors into a folder named after it; equal names get a numeric suffix
+        self.mirror_names: Dict[str, str] = {}
+        for root in self.roots:
+            name = os.path.basename(root.rstrip(os.sep)) or "root"
+            while name in self.mirror_names.values():
+                name += "_"
+            self.mirror_names[root] = name
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observed: Dict[str, Tuple[int, int]] = {}
+        # A path is handled once its mirror copy is written; until then it is pending and failures drop it for a retry
+        self._handled: Dict[str, Tuple[int, int]] = {}
+        self._pending: Dict[str, Tuple[int, int]] = {}
+        # Content hash -> (file type, bytes, [(source, relative mirror path)]); equal files are rebranded once
+        self._queue: Dict[str, Tuple[str, bytes, List[Tuple[str, str]]]] = {}
+        self._in_flight: Dict[str, Tuple[Job, str, List[Tuple[str, str]], Telemetry]] = {}
+        self._completed: List[float] = []
+        self.counts = {"rebranded": 0, "skipped": 0, "failed": 0}
+        self.bytes_in = 0
+        self.elements_skipped = 0
+        self.last_error = ""
+        self.manifest: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(os.path.join(self.mirror, WATCH_MANIFEST_NAME), "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        except Exception:
+            pass
+        self._thread = threading.Thread(target=self._run, name="rebrand-watch", daemon=True)
+
+    def start(self) -> None:
+        os.makedirs(self.mirror, exist_ok=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.last_error = str(e)
+            self._stop.wait(self.poll_seconds)
+
+    def poll(self) -> None:
+        self._collect()
+        self._scan()
+        self._dispatch()
+        self._publish()
+
+    def _scan(self) -> None:
+        for root in self.roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != self.mirror]
+                for name in filenames:
+                    file_type = infer_file_type(name)
+                    # "~$" files are Office lock files next to open documents
+                    if file_type is None or name.startswith("~$"):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    signature = (stat.st_size, stat.st_mtime_ns)
+                    if self._observed.get(path) != signature:
+                        # Still being written, or seen for the first time: wait for one quiet poll
+                        self._observed[path] = signature
+                        continue
+                    if self._handled.get(path) == signature or self._pending.get(path) == signature:
+                        continue
+                    self._enqueue(root, path, file_type, signature)
+
+    def _enqueue(self, root: str, path: str, file_type: str, signature: Tuple[int, int]) -> None:
+        rel = os.path.join(self.mirror_names[root], os.path.relpath(path, root))
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            self.last_error = str(e)
+            return
+        file_hash = content_hash(data)
+        entry = self.manifest.get(rel)
+        if entry and entry.get("hash") == file_hash and entry.get("profile") == self.profile_hash and os.path.exists(os.path.join(self.mirror, rel)):
+            self._handled[path] = signature
+            with self._lock:
+                self.counts["skipped"] += 1
+            return
+        self._pending[path] = signature
+        with self._lock:
+            if file_hash in self._in_flight:
+                targets = self._in_flight[file_hash][2]
+            elif file_hash in self._queue:
+                targets = self._queue[file_hash][2]
+            else:
+                self._queue[file_hash] = (file_type, data, [(path, rel)])
+                return
+            if (path, rel) not in targets:
+                targets.append((path, rel))
+
+    def _dispatch(self) -> None:
+        with self._lock:
+            while self._queue and len(self._in_flight) < WATCH_MAX_IN_FLIGHT:
+                file_hash = next(iter(self._queue))
+                file_type, data, targets = self._queue.pop(file_hash)
+                fd, output_path = tempfile.mkstemp(prefix="rebranding-", suffix=f".{file_type}", dir=self.mirror)
+                os.close(fd)
+                telemetry = Telemetry()
+                try:
+                    job = self.scheduler.submit(run_watch_job, file_type, data, file_hash, self.profile, output_path, telemetry, input_size=len(data), estimate=job_memory_estimate(file_type, len(data), raster_recolor_peak_bytes(None, self.profile["color_map"]) if self.profile["recolor"] and file_type != "pdf" else 0))
+                except JobRejected as e:
+                    os.remove(output_path)
+                    self.counts["failed"] += len(targets)
+                    self.last_error = str(e)
+                    for path, _ in targets:
+                        self._pending.pop(path, None)
+                    continue
+                self.bytes_in += len(data)
+                self._in_flight[file_hash] = (job, output_path, targets, telemetry)
+
+    def _collect(self) -> None:
+        with self._lock:
+            finished = [(h, entry) for h, entry in self._in_flight.items() if entry[0].future.done()]
+            for file_hash, _ in finished:
+                del self._in_flight[file_hash]
+        changed = False
+        for file_hash, (job, output_path, targets, telemetry) in finished:
+            try:
+                job.future.result()
+                summary = telemetry_summary(telemetry.snapshot())
+                for source, rel in targets:
+                    target = os.path.join(self.mirror, rel)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    tmp_path = target + ".tmp"
+                    shutil.copyfile(output_path, tmp_path)
+                    os.replace(tmp_path, target)
+                    self.manifest[rel] = {"hash": file_hash, "profile": self.profile_hash, "telemetry": summary}
+                    # A newer version may have been queued meanwhile; the newest observed signature is what was handled
+                    signature = self._pending.pop(source, None)
+                    if signature:
+                        self._handled[source] = signature
+                changed = True
+                with self._lock:
+                    self.counts["rebranded"] += len(targets)
+                    self.elements_skipped += telemetry.skipped()
+                    self._completed.extend([time.time()] * len(targets))
+            except Exception as e:
+                # Targets not yet mirrored stay unhandled, so the next poll takes them again
+                for source, _ in targets:
+                    self._pending.pop(source, None)
+                with self._lock:
+                    self.counts["failed"] += len(targets)
+                    self.last_error = f"{os.path.basename(targets[0][0])}: {e}"
+            finally:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+        if changed:
+            tmp_path = os.path.join(self.mirror, WATCH_MANIFEST_NAME + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, os.path.join(self.mirror, WATCH_MANIFEST_NAME))
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            cutoff = time.time() - WATCH_THROUGHPUT_WINDOW_SECONDS
+            self._completed = [t for t in self._completed if t >= cutoff]
+            return {
+                "backlog": sum(len(targets) for _, _, targets in self._queue.values()) + sum(len(entry[2]) for entry in self._in_flight.values()),
+                "in_flight": len(self._in_flight),
+                "rebranded": self.counts["rebranded"],
+                "skipped": self.counts["skipped"],
+                "failed": self.counts["failed"],
+                "elements_skipped": self.elements_skipped,
+                "files_per_minute": round(len(self._completed) * 60 / WATCH_THROUGHPUT_WINDOW_SECONDS, 2),
+                "mb_read": round(self.bytes_in / 1048576, 2),
+                "last_error": self.last_error,
+                "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+
+    def _publish(self) -> None:
+        # Monitoring reads the metrics file; the app shows the same numbers
+        tmp_path = os.path.join(self.mirror, WATCH_METRICS_NAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.metrics(), f, indent=1)
+        os.replace(tmp_path, os.path.join(self.mirror, WATCH_METRICS_NAME))
+
+@st.cache_resource
+def watch_folder_service() -> Optional[WatchFolderService]:
+    """Started with the server's first page load when REBRAND_WATCH_DIRS, REBRAND_WATCH_MIRROR and REBRAND_WATCH_PROFILE are set"""
+    if not WATCH_DIRS or not WATCH_MIRROR_DIR or not WATCH_PROFILE_PATH:
+        return None
+    service = WatchFolderService(WATCH_DIRS, WATCH_MIRROR_DIR, load_watch_profile(WATCH_PROFILE_PATH), job_scheduler())
+    service.start()
+    return service
+
+
+# Slide previews
+# After an apply only the slides whose content hash moved are rendered again; renders are cached by that hash
+SLIDE_PREVIEW_WIDTH = 900
+SLIDE_PREVIEW_CACHE_ENTRIES = 256
+
+class PreviewCache(ExtractionCache):
+    """LRU of rendered slide previews keyed by slide content hash and width"""
+
+@st.cache_resource
+def slide_preview_cache() -> PreviewCache:
+    return PreviewCache(SLIDE_PREVIEW_CACHE_ENTRIES)
+
+def pptx_changed_slides(before_hashes: List[str], output_path: str) -> Tuple[List[int], List[str]]:
+    """Indexes of the slides whose hash differs from the original, and the output's hashes"""
+    after_hashes = pptx_slide_hashes(output_path)
+    if len(after_hashes) != len(before_hashes):
+        return list(range(len(after_hashes))), after_hashes
+    return [idx for idx, (before, after) in enumerate(zip(before_hashes, after_hashes)) if before != after], after_hashes
+
+def pptx_after_previews(output_path: str, changed: List[int], after_hashes: List[str], width_px: int = SLIDE_PREVIEW_WIDTH) -> Dict[int, Optional[bytes]]:
+    """Previews of the changed slides of an output; the output is only opened when one of them is not cached yet"""
+    cache = slide_preview_cache()
+    previews: Dict[int, Optional[bytes]] = {}
+    missing: List[int] = []
+    for idx in changed:
+        hit = cache.get(f"{after_hashes[idx]}-{width_px}")
+        if hit is not None:
+            previews[idx] = hit["jpeg"]
+        else:
+            missing.append(idx)
+    if missing and PPTX_AVAILABLE and PIL_AVAILABLE:
+        try:
+            prs = Presentation(output_path)
+            slides = list(prs.slides)
+            layers: Dict[Any, Any] = {}
+            for idx in missing:
+                preview = pptx_compose_slide_preview(prs, slides[idx], width_px, layers)
+                previews[idx] = preview
+                if preview:
+                    cache.put(f"{after_hashes[idx]}-{width_px}", {"jpeg": preview})
+        except Exception:
+            pass
+    return previews
+
+
+# UI fragments
+IMAGE_REVIEW_PAGE_SIZES = [12, 24, 48]
+
+def render_image_uploader(uid: str, img: ImageRecord, thumb_width: int):
+    # Only records on the visible page are rendered, so this is where media bytes are actually read
+    data = img.data
+    if data:
+        try:
+            st.image(data, width=thumb_width)
+        except Exception:
+            st.write("(Preview unavailable)")
+    else:
+        st.write("(Preview unavailable)")
+    if img.kind == "theme_image":
+        rep = st.file_uploader("Replace theme image (optional)", type=["png", "jpg", "jpeg", "gif"], key=f"replace_theme_{safe_key(uid)}")
+        if rep is not None:
+            persist_theme_image_replacement(img.media_path, rep.read())
+        return
+    label = "Replace media (optional)" if img.group == "All Media" else "Replace image (optional)"
+    rep = st.file_uploader(label, type=["png", "jpg", "jpeg", "gif"], key=f"replace_{safe_key(uid)}")
+    if rep is not None:
+        persist_image_replacement(uid, rep.read())
+
+@ui_fragment
+def render_slide_group(grp_name: str, grp_imgs: List[ImageRecord], preview: Optional[bytes], thumb_width: int):
+    with st.expander(f"{grp_name}", expanded=False):
+        left, right = st.columns([2, 3])
+        with left:
+            st.markdown("Before preview")
+            if preview:
+                st.image(preview, use_container_width=True)
+            else:
+                bg = next((i for i in grp_imgs if i.kind == "slide_bg" and i.size), None)
+                bg_data = bg.data if bg else None
+                if bg_data:
+                    st.image(bg_data, use_container_width=True)
+                else:
+                    st.info("No slide preview available.")
+            st.caption("Slide images (mini thumbnails):")
+            mini = [i for i in grp_imgs if i.kind in ("shape_picture", "shape_fill", "cell_fill") and i.size]
+            if mini:
+                st.markdown('<div class="thumb-row">', unsafe_allow_html=True)
+                for m in mini:
+                    st.markdown('<div class="thumb-item">', unsafe_allow_html=True)
+                    try:
+                        st.image(m.data, width=100)
+                    except Exception:
+                        st.write("(Unavailable)")
+                    st.markdown('</div>', unsafe_allow_html=True)
+                st.markdown('</div>', unsafe_allow_html=True)
+            else:
+                st.write("No picture shapes detected.")
+        with right:
+            st.markdown("Image replacements")
+            for idx, img in enumerate(grp_imgs):
+                uid = img.uid or f"pptx_img_{grp_name}_{idx}"
+                st.write(img.name or "Unnamed")
+                render_image_uploader(uid, img, thumb_width)
+
+@ui_fragment
+def render_image_group(title: str, grp_imgs: List[ImageRecord], file_type: str, thumb_width: int):
+    with st.expander(title, expanded=False):
+        for idx, img in enumerate(grp_imgs):
+            uid = img.uid or f"{file_type}_img_{title}_{idx}"
+            if img.group == "All Media" or img.kind == "theme_image":
+                st.write(f"{img.name or 'media'} ({img.media_path})")
+            else:
+                st.write(img.name or "Unnamed")
+            render_image_uploader(uid, img, thumb_width)
+
+def image_review_items(extracted: Dict[str, Any]) -> List[ImageRecord]:
+    items = list(extracted["images"])
+    for theme in extracted.get("theme_images_info", {}).get("themes", []):
+        items.extend(theme["images"])
+    return items
+
+def image_kind(img: ImageRecord) -> str:
+    return img.kind or "media"
+
+def image_duplicate_ids(items: List[ImageRecord]) -> Set[int]:
+    """ids of records whose content appears more than once. ZIP-backed records are grouped by CRC and size first,
+    so only media sharing that key is read and hashed to confirm"""
+    groups: Dict[str, List[ImageRecord]] = {}
+    for img in items:
+        key = img.prefilter_key if img.size else None
+        if key:
+            groups.setdefault(key, []).append(img)
+    duplicates: Set[int] = set()
+    for candidates in groups.values():
+        if len(candidates) < 2:
+            continue
+        confirmed: Dict[str, List[ImageRecord]] = {}
+        for img in candidates:
+            if img.digest:
+                confirmed.setdefault(img.digest, []).append(img)
+        duplicates.update(id(img) for same in confirmed.values() if len(same) > 1 for img in same)
+    return duplicates
+
+def filter_image_items(items: List[ImageRecord], group: str, kind: str, min_kb: int, duplicates_only: bool) -> List[ImageRecord]:
+    filtered = [img for img in items if (group == "All" or (img.group or "Other") == group) and (kind == "All" or image_kind(img) == kind) and img.size >= min_kb * 1024]
+    if duplicates_only:
+        duplicates = image_duplicate_ids(items)
+        filtered = [img for img in filtered if id(img) in duplicates]
+    return filtered
+
+def image_group_title(grp_name: str) -> str:
+    return "All Media (ppt/media) - fallback" if grp_name == "All Media" else f"{grp_name} images"
+
+@ui_fragment
+def render_image_review(extracted: Dict[str, Any], file_type: str, thumb_width: int):
+    """Filter and page through image records; only the current page builds widgets"""
+    items = image_review_items(extracted)
+    if not items:
+        st.write("- No images detected")
+        return
+
+    f1, f2, f3, f4 = st.columns(4)
+    groups = list(dict.fromkeys(img.group or "Other" for img in items))
+    kinds = sorted({image_kind(img) for img in items})
+    group = f1.selectbox("Group", ["All"] + groups, key="img_filter_group")
+    kind = f2.selectbox("Kind", ["All"] + kinds, key="img_filter_kind")
+    min_kb = f3.number_input("Min size (KB)", min_value=0, value=0, step=10, key="img_filter_size")
+    duplicates_only = f4.checkbox("Duplicates only", key="img_filter_dups", help="Images whose content appears more than once")
+    filtered = filter_image_items(items, group, kind, int(min_kb), duplicates_only)
+
+    p1, p2, p3 = st.columns([1, 1, 2])
+    page_size = p1.selectbox("Images per page", IMAGE_REVIEW_PAGE_SIZES, key="img_page_size")
+    page_count = max(1, (len(filtered) + page_size - 1) // page_size)
+    if st.session_state.get("img_page", page_count + 1) > page_count:
+        st.session_state["img_page"] = 1
+    page = p2.number_input("Page", min_value=1, max_value=page_count, key="img_page")
+    start = (int(page) - 1) * page_size
+    visible = filtered[start:start + page_size]
+    p3.caption(f"Showing {start + 1 if visible else 0}-{start + len(visible)} of {len(filtered)} matching images ({len(items)} total), page {int(page)} of {page_count}")
+
+    by_group: Dict[str, List[ImageRecord]] = {}
+    for img in visible:
+        by_group.setdefault(img.group or "Other", []).append(img)
+    slide_previews = extracted.get("slide_previews", {})
+    for grp_name, grp_imgs in by_group.items():
+        if file_type == "pptx" and grp_name.startswith("Slide "):
+            render_slide_group(grp_name, grp_imgs, slide_previews.get(grp_name), thumb_width)
+        else:
+            render_image_group(image_group_title(grp_name), grp_imgs, file_type, thumb_width)
+
+@ui_fragment
+def render_slide_comparison(extracted: Dict[str, Any], output_path: str):
+    before_hashes = extracted.get("slide_hashes") or []
+    if not before_hashes:
+        st.info("No slide hashes for this file; upload it again to compare slides.")
+        return
+    changed, after_hashes = pptx_changed_slides(before_hashes, output_path)
+    st.caption(f"{len(changed)} of {len(after_hashes)} slide(s) changed; unchanged slides are not rendered again.")
+    if not changed:
+        return
+    after_previews = pptx_after_previews(output_path, changed, after_hashes)
+    before_previews = extracted.get("slide_previews", {})
+    for idx in changed:
+        st.markdown(f"Slide {idx+1}")
+        before_col, after_col = st.columns(2)
+        with before_col:
+            before = before_previews.get(f"Slide {idx+1}")
+            if before:
+                st.image(before, caption="Before", use_container_width=True)
+            else:
+                st.info("No preview of the original slide.")
+        with after_col:
+            after = after_previews.get(idx)
+            if after:
+                st.image(after, caption="After", use_container_width=True)
+            else:
+                st.info("No preview of the rebranded slide.")
+
+def render_telemetry(title: str, snapshot: Optional[Dict[str, Any]]):
+    rows = telemetry_rows(snapshot)
+    if not rows:
+        st.caption(f"{title}: no telemetry recorded (served from a cache, or a format without instrumented walkers).")
+        return
+    skipped = sum(row["skipped"] for row in rows)
+    st.markdown(f"**{title}**: {skipped} element(s) skipped")
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+    for sample in (snapshot or {}).get("samples", []):
+        with st.popover(f"{sample['function']} / {sample['branch']}: {len(sample['tracebacks'])} sampled traceback(s)"):
+            for text in sample["tracebacks"]:
+                st.code(text, language="text")
+
+@ui_timer_fragment(QUICK_SCAN_POLL_SECONDS)
+def render_scan_progress(scan: BackgroundScan, shown: int):
+    # New colors need new pickers in the palette form, so growth and completion rerun the whole page
+    if scan.done() or scan.palette_size() > shown:
+        st.rerun()
+    st.progress(scan.slides_done / max(1, scan.slide_count), text=f"Quick palette from a sample of slides; scanning slide {min(scan.slides_done + 1, scan.slide_count)} of {scan.slide_count}. New colors are added as they are found.")
+
+def current_palette_families(extracted: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """The color families when family mode is on for this palette, else None"""
+    colors = tuple(dict.fromkeys(c for key in ("text_colors", "shape_colors", "background_colors") for c in extracted[key] if re.fullmatch(r"#[0-9A-F]{6}", c)))
+    if not NUMPY_AVAILABLE or len(colors) < PALETTE_FAMILY_MIN_COLORS or not st.session_state.get("palette_families", True):
+        return None
+    return palette_families(colors, st.session_state.get("palette_family_count", PALETTE_FAMILY_DEFAULT_COUNT))
+
+def collect_palette_mappings(extracted: Dict[str, Any]) -> Tuple[Dict[str, str], Dict[str, str]]:
+    families = current_palette_families(extracted)
+    if families is not None:
+        targets = {family["color"]: st.session_state.get(f"family_color_{safe_key(family['color'])}", family["color"]) for family in families}
+        return palette_family_color_map(families, targets), collect_font_mappings(extracted)
+    color_map: Dict[str, str] = {}
+    for c in extracted["text_colors"]:
+        new_c = st.session_state.get(f"text_color_{safe_key(c)}", c)
+        if new_c and new_c != c:
+            color_map[c] = new_c
+    for c in extracted["shape_colors"]:
+        new_c = st.session_state.get(f"shape_color_{safe_key(c)}", c)
+        if new_c and new_c != c:
+            color_map[c] = new_c
+    for c in extracted["background_colors"]:
+        new_c = st.session_state.get(f"bg_color_{safe_key(c)}", c)
+        if new_c and new_c != c:
+            color_map[c] = new_c
+    return color_map, collect_font_mappings(extracted)
+
+def collect_text_mappings() -> Dict[str, str]:
+    text_map: Dict[str, str] = {}
+    for line in (st.session_state.get("text_replacements") or "").splitlines():
+        find, sep, replace = line.partition("=>")
+        find, replace = find.strip(), replace.strip()
+        if sep and find and replace != find:
+            text_map[find] = replace
+    return text_map
+
+def collect_font_mappings(extracted: Dict[str, Any]) -> Dict[str, str]:
+    font_map: Dict[str, str] = {}
+    for f in extracted["fonts"]:
+        new_f = st.session_state.get(f"font_map_{safe_key(f)}", f)
+        if new_f and new_f != f:
+            font_map[f] = new_f
+    return font_map
+
 # Main UI
 st.markdown('<div class="pwc-header"><h2>PwC Rebranding Tool</h2><div class="pwc-subtle">Upload a document and guide the rebranding of colors, fonts, and images.</div></div>', unsafe_allow_html=True)
 
+watch_service = watch_folder_service()
+if watch_service is not None:
+    with st.expander("Watch folders", expanded=False):
+        st.caption(f"Rebranding documents dropped into {', '.join(watch_service.roots)} into {watch_service.mirror}.")
+        st.table([watch_service.metrics()])
+
 uploaded = st.file_uploader("Upload your document", type=["docx", "pptx", "xlsx", "pdf"])
 
 if uploaded is None:
@@ -1259,6 +4745,7 @@ if uploaded is None:
 
 file_bytes = uploaded.read()
 file_type = infer_file_type(uploaded.name)
+file_hash = content_hash(file_bytes)
 
 if file_type is None:
     st.error("Unsupported file type. Please upload a .docx, .pptx, .xlsx, or .pdf file.")
@@ -1269,38 +4756,81 @@ st.write(f"File name: {uploaded.name}")
 st.write(f"Type: {file_type.upper()}")
 
 if file_type == "pdf":
-    pdf_preview(file_bytes)
+    pdf_preview(file_bytes, file_hash)
 else:
     st.markdown('<div class="pwc-hint">A full visual rendering is not always available, but a structured preview is provided below.</div>', unsafe_allow_html=True)
 
 st.markdown("</div>", unsafe_allow_html=True)
 
-# Extract metadata
-extracted = None
-if file_type == "docx":
-    if not DOCX_AVAILABLE:
-        st.error("python-docx not installed. Please install with: pip install python-docx")
-        st.stop()
-    extracted = docx_extract(file_bytes)
-elif file_type == "pptx":
-    if not PPTX_AVAILABLE:
-        st.error("python-pptx not installed. Please install with: pip install python-pptx")
-        st.stop()
-    extracted = pptx_extract(file_bytes)
-elif file_type == "xlsx":
-    if not OPENPYXL_AVAILABLE:
-        st.error("openpyxl not installed. Please install with: pip install openpyxl")
-        st.stop()
-    extracted = xlsx_extract(file_bytes)
-elif file_type == "pdf":
-    extracted = None
-
-if file_type != "pdf" and extracted is None:
+# Extract metadata once per uploaded file; reruns and other sessions with the same file reuse it
+extracted = get_cached_extraction(file_hash)
+scan = None
+if extracted is None and file_type == "pptx" and PPTX_AVAILABLE and UI_TIMER_FRAGMENTS:
+    # Long decks show a sampled palette at once while the full scan runs on the scheduler
+    scan_entry = background_scans().get(file_hash)
+    scan = scan_entry["scan"] if scan_entry else None
+    if scan is None:
+        quick = pptx_quick_scan(file_bytes)
+        if quick is not None:
+            try:
+                scan = background_scans().start(file_hash, file_bytes, quick, job_scheduler(), shared_extraction_cache())
+            except JobRejected:
+                scan = None
+    if scan is not None and not scan.done():
+        extracted = scan.snapshot()
+    else:
+        # A scan that finished since the cache was checked; if it failed or was evicted, extract here instead
+        scan = None
+        extracted = get_cached_extraction(file_hash)
+if extracted is None:
+    extract_telemetry = Telemetry()
+    with telemetry_scope(extract_telemetry):
+        if file_type == "docx":
+            if not DOCX_AVAILABLE:
+                st.error("python-docx not installed. Please install with: pip install python-docx")
+                st.stop()
+            extracted = docx_extract(file_bytes)
+        elif file_type == "pptx":
+            if not PPTX_AVAILABLE:
+                st.error("python-pptx not installed. Please install with: pip install python-pptx")
+                st.stop()
+            extracted = pptx_extract(file_bytes)
+        elif file_type == "xlsx":
+            if not OPENPYXL_AVAILABLE:
+                st.error("openpyxl not installed. Please install with: pip install openpyxl")
+                st.stop()
+            extracted = xlsx_extract(file_bytes)
+        elif file_type == "pdf":
+            if not PDF_AVAILABLE:
+                st.error("pypdf not installed. Please install with: pip install pypdf")
+                st.stop()
+            try:
+                extracted = pdf_extract(file_bytes)
+            except Exception as e:
+                st.error(f"Failed to read the PDF: {e}")
+                st.stop()
+    if extracted is not None:
+        extracted["telemetry"] = extract_telemetry.snapshot()
+        persist_extraction(file_hash, extracted)
+
+if extracted is None:
     st.error("Failed to parse the uploaded document.")
     st.stop()
 
+if scan is not None:
+    render_scan_progress(scan, scan.palette_size())
+
 # Step 1: Colors & Fonts
-if file_type != "pdf":
+# Palette edits are batched in a form: pickers don't rerun the script until the user submits
+palette_size = len(set(extracted["text_colors"]) | set(extracted["shape_colors"]) | set(extracted["background_colors"]))
+if NUMPY_AVAILABLE and palette_size >= PALETTE_FAMILY_MIN_COLORS:
+    # Outside the form: switching mode or family count changes which pickers exist
+    fam1, fam2 = st.columns([1, 2])
+    fam1.checkbox("Group similar colors into families", value=True, key="palette_families", help=f"{palette_size} distinct colors were found. Families are clustered in Lab space; changing a family's color moves every member by the same amount.")
+    fam2.slider("Color families", min_value=2, max_value=min(PALETTE_FAMILY_MAX_COUNT, palette_size), value=min(PALETTE_FAMILY_DEFAULT_COUNT, palette_size), key="palette_family_count", disabled=not st.session_state.get("palette_families", True))
+families = current_palette_families(extracted)
+
+with st.form("palette_form", border=False):
     col1, col2 = st.columns(2)
     with col1:
         st.markdown('<div class="pwc-card"><div class="pwc-section-title">Step 1: Colors</div>', unsafe_allow_html=True)
@@ -1308,26 +4838,32 @@ if file_type != "pdf":
         shp_colors = extracted["shape_colors"]
         bg_colors = extracted["background_colors"]
 
-        st.write("Text colors (includes all text in shapes, text boxes, titles, subtitles, bullets, and numbering):")
-        if txt_colors:
-            for c in txt_colors:
-                st.color_picker(f"Change text color {c}", value=c, key=f"text_color_{safe_key(c)}")
-        else:
-            st.write("- None detected")
-
-        st.write("Shapes/format colors (incl. borders):")
-        if shp_colors:
-            for c in shp_colors:
-                st.color_picker(f"Change shape/border color {c}", value=c, key=f"shape_color_{safe_key(c)}")
+        if families is not None:
+            st.write(f"Color families ({palette_size} colors in {len(families)} families; each member keeps its offset from the family color):")
+            for family in families:
+                members = family["members"]
+                st.color_picker(f"Change family of {len(members)} color(s) around {family['color']}", value=family["color"], key=f"family_color_{safe_key(family['color'])}", help="Members: " + ", ".join(members))
         else:
-            st.write("- None detected")
-
-        st.write("Background colors:")
-        if bg_colors:
-            for c in bg_colors:
-                st.color_picker(f"Change background color {c}", value=c, key=f"bg_color_{safe_key(c)}")
-        else:
-            st.write("- None detected or not supported for this file type")
+            st.write("Text colors (includes all text in shapes, text boxes, titles, subtitles, bullets, and numbering):")
+            if txt_colors:
+                for c in txt_colors:
+                    st.color_picker(f"Change text color {c}", value=c, key=f"text_color_{safe_key(c)}")
+            else:
+                st.write("- None detected")
+
+            st.write("Shapes/format colors (incl. borders):")
+            if shp_colors:
+                for c in shp_colors:
+                    st.color_picker(f"Change shape/border color {c}", value=c, key=f"shape_color_{safe_key(c)}")
+            else:
+                st.write("- None detected")
+
+            st.write("Background colors:")
+            if bg_colors:
+                for c in bg_colors:
+                    st.color_picker(f"Change background color {c}", value=c, key=f"bg_color_{safe_key(c)}")
+            else:
+                st.write("- None detected or not supported for this file type")
         st.markdown("</div>", unsafe_allow_html=True)
 
     with col2:
@@ -1338,7 +4874,10 @@ if file_type != "pdf":
                 st.text_input(f"Change font '{f}' to:", value=f, key=f"font_map_{safe_key(f)}")
         else:
             st.write("- None detected")
+        st.text_area("Replace text (one per line: old text => new text)", key="text_replacements", placeholder="Acme Corp => Globex Group\nacme.com => globex.com", help="Old names, taglines and URLs are replaced in DOCX and PPTX paragraphs, even when split across differently formatted runs, and in XLSX cells. The replacement takes the formatting of the text where the match starts.")
         st.markdown("</div>", unsafe_allow_html=True)
+    st.form_submit_button("Save palette changes")
+st.caption("Color, font and text edits take effect once saved with 'Save palette changes'.")
 
 # Step 2: Images
 st.markdown('<div class="pwc-card"><div class="pwc-section-title">Step 2: Images, Pictures, or Logos</div>', unsafe_allow_html=True)
@@ -1353,190 +4892,100 @@ with right_control:
 
 image_replacements_ss, theme_image_replacements_ss = get_persisted_image_replacements()
 
-if file_type == "pdf":
-    st.info("PDF image replacement is not supported in this version.")
+if skip_images:
+    st.info("Skipping image review and replacements.")
+elif scan is not None:
+    st.info("Image review opens once the full scan has finished.")
 else:
-    if skip_images:
-        st.info("Skipping image review and replacements.")
-    else:
-        images = extracted["images"]
-        if file_type == "pptx":
-            slide_previews = extracted.get("slide_previews", {})
-            slides: Dict[str, List[Dict]] = {}
-            others: Dict[str, List[Dict]] = {}
-            all_media_items: List[Dict] = []
-            for img in images:
-                grp = img.get("group") or "Other"
-                if grp.startswith("Slide "):
-                    slides.setdefault(grp, []).append(img)
-                elif grp == "All Media":
-                    all_media_items.append(img)
-                else:
-                    others.setdefault(grp, []).append(img)
-
-            st.caption("Preview shows the full slide BEFORE changes on the left; replace images on the right.")
-
-            for grp_name in sorted(slides.keys(), key=lambda x: int(x.split(" ")[1])):
-                grp_imgs = slides[grp_name]
-                with st.expander(f"{grp_name}", expanded=False):
-                    left, right = st.columns([2, 3])
-                    with left:
-                        st.markdown("Before preview")
-                        preview = slide_previews.get(grp_name)
-                        if preview:
-                            st.image(preview, use_container_width=True)
-                        else:
-                            bg = next((i for i in grp_imgs if i.get("kind") == "slide_bg" and i.get("bytes")), None)
-                            if bg:
-                                st.image(bg["bytes"], use_container_width=True)
-                            else:
-                                st.info("No slide preview available.")
-                        st.caption("Slide images (mini thumbnails):")
-                        mini = [i for i in grp_imgs if i.get("kind") in ("shape_picture", "shape_fill", "cell_fill") and i.get("bytes")]
-                        if mini:
-                            st.markdown('<div class="thumb-row">', unsafe_allow_html=True)
-                            for m in mini:
-                                st.markdown('<div class="thumb-item">', unsafe_allow_html=True)
-                                try:
-                                    st.image(m["bytes"], width=100)
-                                except Exception:
-                                    st.write("(Unavailable)")
-                                st.markdown('</div>', unsafe_allow_html=True)
-                            st.markdown('</div>', unsafe_allow_html=True)
-                        else:
-                            st.write("No picture shapes detected.")
-                    with right:
-                        st.markdown("Image replacements")
-                        for idx, img in enumerate(grp_imgs):
-                            uid = img.get("uid") or f"{file_type}_img_{grp_name}_{idx}"
-                            st.write(img.get("name", "Unnamed"))
-                            if img.get("bytes"):
-                                try:
-                                    st.image(img["bytes"], width=thumb_width)
-                                except Exception:
-                                    st.write("(Preview unavailable)")
-                            else:
-                                st.write("(Preview unavailable)")
-                            rep = st.file_uploader("Replace image (optional)", type=["png", "jpg", "jpeg", "gif"], key=f"replace_{safe_key(uid)}")
-                            if rep is not None:
-                                persist_image_replacement(uid, rep.read())
-
-            for grp_name, grp_imgs in others.items():
-                with st.expander(f"{grp_name} images", expanded=False):
-                    for idx, img in enumerate(grp_imgs):
-                        uid = img.get("uid") or f"{file_type}_img_{grp_name}_{idx}"
-                        st.write(img.get("name", "Unnamed"))
-                        if img.get("bytes"):
-                            try:
-                                st.image(img["bytes"], width=thumb_width)
-                            except Exception:
-                                st.write("(Preview unavailable)")
-                        else:
-                            st.write("(Preview unavailable)")
-                        rep = st.file_uploader("Replace image (optional)", type=["png", "jpg", "jpeg", "gif"], key=f"replace_{safe_key(uid)}")
-                        if rep is not None:
-                            persist_image_replacement(uid, rep.read())
-
-            theme_images_info = extracted.get("theme_images_info", {})
-            if theme_images_info.get("themes"):
-                with st.expander("Theme images (background assets)", expanded=False):
-                    for theme in theme_images_info["themes"]:
-                        for ti in theme["images"]:
-                            st.write(f"{ti['name']} ({ti['media_path']})")
-                            try:
-                                st.image(ti["bytes"], width=thumb_width)
-                            except Exception:
-                                st.write("(Preview unavailable)")
-                            rep = st.file_uploader("Replace theme image (optional)", type=["png", "jpg", "jpeg", "gif"], key=f"replace_theme_{safe_key(ti['uid'])}")
-                            if rep is not None:
-                                persist_theme_image_replacement(ti["media_path"], rep.read())
-
-            if all_media_items:
-                with st.expander("All Media (ppt/media) - fallback", expanded=False):
-                    for idx, img in enumerate(all_media_items):
-                        uid = img.get("media_path")
-                        st.write(f"{img.get('name', 'media')} ({uid})")
-                        if img.get("bytes"):
-                            try:
-                                st.image(img["bytes"], width=thumb_width)
-                            except Exception:
-                                st.write("(Preview unavailable)")
-                        rep = st.file_uploader("Replace media (optional)", type=["png", "jpg", "jpeg", "gif"], key=f"replace_{safe_key(uid)}")
-                        if rep is not None:
-                            persist_image_replacement(uid, rep.read())
-
-        else:
-            groups: Dict[str, List[Dict]] = {}
-            for img in images:
-                grp = img.get("group") or "Other"
-                groups.setdefault(grp, []).append(img)
-            for grp_name, grp_imgs in groups.items():
-                with st.expander(f"{grp_name} images", expanded=False):
-                    for idx, img in enumerate(grp_imgs):
-                        uid = img.get("uid") or f"{file_type}_img_{grp_name}_{idx}"
-                        st.write(img.get("name", "Unnamed"))
-                        if img.get("bytes"):
-                            try:
-                                st.image(img["bytes"], width=thumb_width)
-                            except Exception:
-                                st.write("(Preview unavailable)")
-                        else:
-                            st.write("(Preview unavailable)")
-                        rep = st.file_uploader("Replace image (optional)", type=["png", "jpg", "jpeg", "gif"], key=f"replace_{safe_key(uid)}")
-                        if rep is not None:
-                            persist_image_replacement(uid, rep.read())
+    if file_type == "pptx":
+        st.caption("Preview shows the full slide BEFORE changes on the left; replace images on the right.")
+    render_image_review(extracted, file_type, thumb_width)
 
 st.markdown("</div>", unsafe_allow_html=True)
 
 # Apply rebranding
 st.markdown('<div class="pwc-card"><div class="pwc-section-title">Apply Rebranding</div>', unsafe_allow_html=True)
-apply_btn = st.button("Apply color/font changes and image replacements")
+compression_preset = st.selectbox("Output compression", list(COMPRESSION_PRESETS), key="compression_preset", help="Balanced stores already-compressed media and deflates XML; Smallest and Repack re-encode every part of the output.")
+recolor = None
+if file_type != "pdf":
+    rc1, rc2, rc3 = st.columns([2, 1, 1])
+    recolor_on = rc1.checkbox("Recolor brand colors inside images", key="raster_recolor", disabled=not (NUMPY_AVAILABLE and PIL_AVAILABLE), help="Shifts pixels near a mapped color toward its new color in PNG, JPEG, GIF, BMP and TIFF media; transparency is kept. Requires numpy and Pillow.")
+    recolor_space = rc2.selectbox("Match colors in", RASTER_RECOLOR_SPACES, key="raster_recolor_space", disabled=not recolor_on)
+    recolor_tolerance = rc3.slider("Tolerance", min_value=1, max_value=60, value=RASTER_RECOLOR_DEFAULT_TOLERANCE[recolor_space], key=f"raster_recolor_tolerance_{recolor_space}", disabled=not recolor_on, help="Lab: color distance; HSV: hue difference in degrees")
+    if recolor_on:
+        recolor = {"space": recolor_space, "tolerance": recolor_tolerance}
+template_bytes = None
+if file_type == "pptx":
+    rebrand_mode = st.radio("Rebrand mode", ["Recolor shapes", "Swap in brand template"], key="rebrand_mode", horizontal=True, help="Template swap replaces the masters, layouts and theme with those of a brand template deck; colors and fonts mapped above are still applied to hard-coded slide content.")
+    if rebrand_mode == "Swap in brand template":
+        template_file = st.file_uploader("Brand template deck (.pptx)", type=["pptx"], key="brand_template")
+        if template_file is None:
+            st.info("Upload the brand template deck to swap in its masters and layouts.")
+        else:
+            template_bytes = template_file.getvalue()
+apply_col, dry_run_col = st.columns([3, 2])
+apply_btn = apply_col.button("Apply color/font changes and image replacements", disabled=scan is not None or (file_type == "pptx" and st.session_state.get("rebrand_mode") == "Swap in brand template" and template_bytes is None))
+dry_run_btn = dry_run_col.button("Preview changes (dry run)", disabled=scan is not None, help="Count what Apply would change without writing a file")
+if scan is not None:
+    st.caption("Apply is available once the full scan has finished.")
+
+if dry_run_btn:
+    color_map, font_map = collect_palette_mappings(extracted)
+    image_replacements, theme_image_replacements = get_persisted_image_replacements()
+    started = time.perf_counter()
+    try:
+        with st.spinner("Matching the current mappings..."):
+            report = dry_run_report(file_type, file_bytes, extracted, color_map, font_map, image_replacements, theme_image_replacements, collect_text_mappings(), recolor)
+        if report.total():
+            st.table(report.rows())
+            st.caption(f"{report.total()} change(s) found in {time.perf_counter() - started:.2f}s; nothing was written.")
+        else:
+            st.info("Nothing in the document matches the current mappings.")
+    except Exception as e:
+        st.error(f"Dry run failed: {e}")
 
-updated_bytes = None
+output_path = None
 updated_name = None
 
 if apply_btn:
-    if file_type == "pdf":
-        st.warning("Rebranding changes are not applied to PDF files in this version.")
-        updated_bytes = file_bytes
-        updated_name = uploaded.name
-    else:
-        color_map: Dict[str, str] = {}
-        for c in extracted["text_colors"]:
-            new_c = st.session_state.get(f"text_color_{safe_key(c)}", c)
-            if new_c and new_c != c:
-                color_map[c] = new_c
-        for c in extracted["shape_colors"]:
-            new_c = st.session_state.get(f"shape_color_{safe_key(c)}", c)
-            if new_c and new_c != c:
-                color_map[c] = new_c
-        for c in extracted["background_colors"]:
-            new_c = st.session_state.get(f"bg_color_{safe_key(c)}", c)
-            if new_c and new_c != c:
-                color_map[c] = new_c
-
-        font_map: Dict[str, str] = {}
-        for f in extracted["fonts"]:
-            new_f = st.session_state.get(f"font_map_{safe_key(f)}", f)
-            if new_f and new_f != f:
-                font_map[f] = new_f
-
-        image_replacements, theme_image_replacements = get_persisted_image_replacements()
+    color_map, font_map = collect_palette_mappings(extracted)
+    text_map = collect_text_mappings()
+    image_replacements, theme_image_replacements = get_persisted_image_replacements()
 
+    try:
+        cleanup_output_files()
+        scheduler = job_scheduler()
+        output_path = new_output_path(file_type)
+        apply_telemetry = Telemetry()
+        job = scheduler.submit(run_apply_job, file_type, file_bytes, file_hash, extracted, get_last_apply_state(), color_map, font_map, image_replacements, theme_image_replacements, output_path, COMPRESSION_PRESETS[compression_preset], recolor, template_bytes, apply_telemetry, text_map, input_size=len(file_bytes), estimate=job_memory_estimate(file_type, len(file_bytes), raster_recolor_peak_bytes(raster_recolor_candidates(extracted), color_map) if recolor and file_type != "pdf" else 0))
+        status = st.empty()
         try:
-            if file_type == "docx":
-                updated_bytes = docx_apply_updates(extracted, color_map, font_map, image_replacements)
-                updated_name = uploaded.name.replace(".docx", "_rebranded.docx")
-            elif file_type == "pptx":
-                updated_bytes = pptx_apply_updates(extracted, color_map, font_map, image_replacements, theme_image_replacements)
-                updated_name = uploaded.name.replace(".pptx", "_rebranded.pptx")
-            elif file_type == "xlsx":
-                updated_bytes = xlsx_apply_updates(extracted, color_map, font_map, image_replacements)
-                updated_name = uploaded.name.replace(".xlsx", "_rebranded.xlsx")
-        except Exception as e:
-            st.error(f"Failed to apply updates: {e}")
-
-    if updated_bytes:
+            while not job.future.done():
+                position = scheduler.position(job)
+                if position:
+                    status.info(f"Waiting for a free worker: position {position} in the queue.")
+                else:
+                    status.info("Rebranding in progress...")
+                wait([job.future], timeout=JOB_POLL_SECONDS)
+        finally:
+            # A rerun or closed tab interrupts the wait; drop the job if it has not started yet
+            scheduler.cancel(job)
+        status.empty()
+        for note in job.future.result():
+            st.caption(note)
+        st.session_state["apply_telemetry"] = {"file_hash": file_hash, "snapshot": apply_telemetry.snapshot()}
+        updated_name = uploaded.name.replace(f".{file_type}", f"_rebranded.{file_type}")
+        # Recolored media counts as a replacement so the next re-apply can tell what changed; the worker left it cached
+        applied_replacements, _ = with_recolored_media(file_type, extracted, image_replacements, theme_image_replacements, color_map, recolor)
+        persist_last_apply_state(build_apply_state(file_hash, file_type, color_map, font_map, applied_replacements, theme_image_replacements, output_path, content_hash(template_bytes) if template_bytes else None, text_map))
+    except JobRejected as e:
+        output_path = None
+        st.error(str(e))
+    except Exception as e:
+        output_path = None
+        st.error(f"Failed to apply updates: {e}")
+
+    if output_path and os.path.getsize(output_path):
         st.success("Rebranding applied successfully.")
         if file_type == "docx":
             st.markdown('<div class="pwc-hint">Please download and review the updated Word document.</div>', unsafe_allow_html=True)
@@ -1545,9 +4994,26 @@ if apply_btn:
         elif file_type == "xlsx":
             st.markdown('<div class="pwc-hint">Sheets updated. Download and review in Excel.</div>', unsafe_allow_html=True)
         elif file_type == "pdf":
-            st.markdown('<div class="pwc-hint">No changes applied to PDF; download the original.</div>', unsafe_allow_html=True)
-
-        st.download_button("Download rebranded document", data=updated_bytes, file_name=updated_name or uploaded.name)
+            st.markdown('<div class="pwc-hint">Pages updated. Download and review in a PDF viewer.</div>', unsafe_allow_html=True)
+
+        render_output_download(output_path, updated_name or uploaded.name)
+
+last_state = get_last_apply_state()
+if file_type != "pdf" and last_state and last_state.get("file_hash") == file_hash and os.path.exists(last_state.get("output_path") or ""):
+    with st.expander("Compression benchmark", expanded=False):
+        st.caption("Repacks the last output under every preset and compares time against size.")
+        if st.button("Run benchmark"):
+            st.table(zip_benchmark_policies(last_state["output_path"]))
+    if file_type == "pptx":
+        with st.expander("Before/after slide preview", expanded=False):
+            render_slide_comparison(extracted, last_state["output_path"])
+
+apply_diag = st.session_state.get("apply_telemetry")
+with st.expander("Diagnostics", expanded=False):
+    st.caption("Elements each pass visited, matched and rewritten, and those skipped because reading or writing them raised.")
+    render_telemetry("Extraction", extracted.get("telemetry"))
+    if apply_diag and apply_diag.get("file_hash") == file_hash:
+        render_telemetry("Last apply", apply_diag["snapshot"])
 
 st.markdown("</div>", unsafe_allow_html=True)
 
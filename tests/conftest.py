@@ -0,0 +1,34 @@
+import os
+import types
+
+import pytest
+import streamlit as st
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _StopScript(Exception):
+    pass
+
+
+@pytest.fixture(scope="session")
+def app():
+    """Rebranding.py run in bare mode up to the upload prompt, where st.stop() ends the script"""
+    module = types.ModuleType("Rebranding")
+    module.__file__ = os.path.join(ROOT, "Rebranding.py")
+    original_stop, cwd = st.stop, os.getcwd()
+
+    def stop():
+        raise _StopScript()
+
+    st.stop = stop
+    os.chdir(ROOT)
+    try:
+        with open(module.__file__, "rb") as f:
+            exec(compile(f.read(), module.__file__, "exec"), module.__dict__)
+    except _StopScript:
+        pass
+    finally:
+        st.stop = original_stop
+        os.chdir(cwd)
+    return module
@@ -0,0 +1,44 @@
+import io
+
+import docx
+import openpyxl
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from openpyxl.styles import Color, Font, PatternFill
+
+
+def test_indexed_excel_colors_are_extracted_and_rewritten(app):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws["A1"] = "Brand"
+    # Index 10 is FF0000 in Excel's default palette
+    ws["A1"].font = Font(color=Color(indexed=10))
+    ws["A2"].fill = PatternFill(fill_type="solid", fgColor=Color(indexed=10))
+    buf = io.BytesIO()
+    wb.save(buf)
+    data = buf.getvalue()
+
+    extracted = app.xlsx_extract(data)
+    assert "#FF0000" in extracted["text_colors"]
+    output = app.xlsx_apply_updates(app.reparse_for_apply("xlsx", data, extracted), {"#FF0000": "#0000FF"}, {}, {})
+    ws = openpyxl.load_workbook(io.BytesIO(output)).active
+    assert ws["A1"].font.color.rgb == "FF0000FF"
+    assert ws["A2"].fill.fgColor.rgb == "FF0000FF"
+
+
+def test_table_cell_shading_is_extracted_and_rewritten(app):
+    document = docx.Document()
+    cell = document.add_table(rows=1, cols=1).cell(0, 0)
+    shd = OxmlElement("w:shd")
+    shd.set(qn("w:val"), "clear")
+    shd.set(qn("w:fill"), "ff0000")
+    cell._tc.get_or_add_tcPr().append(shd)
+    buf = io.BytesIO()
+    document.save(buf)
+    data = buf.getvalue()
+
+    extracted = app.docx_extract(data)
+    assert "#FF0000" in extracted["shape_colors"]
+    output = app.docx_apply_updates(app.reparse_for_apply("docx", data, extracted), {"#FF0000": "#0000FF"}, {}, {})
+    fills = [s.get(qn("w:fill")) for s in docx.Document(io.BytesIO(output)).tables[0].cell(0, 0)._tc.xpath(".//w:shd")]
+    assert fills == ["0000FF"]
@@ -0,0 +1,29 @@
+import io
+import zipfile
+
+import docx
+from docx.shared import RGBColor
+
+
+def red_docx() -> bytes:
+    document = docx.Document()
+    document.add_paragraph().add_run("Brand").font.color.rgb = RGBColor(0xFF, 0x00, 0x00)
+    buf = io.BytesIO()
+    document.save(buf)
+    return buf.getvalue()
+
+
+def test_dry_run_counts_svg_media_and_embedded_packages(app):
+    inner = red_docx()
+    buf = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(inner)) as src, zipfile.ZipFile(buf, "w") as out:
+        for info in src.infolist():
+            out.writestr(info, src.read(info))
+        out.writestr("word/media/logo.svg", b'<svg xmlns="http://www.w3.org/2000/svg"><rect fill="#FF0000"/></svg>')
+        out.writestr("word/media/plain.svg", b'<svg xmlns="http://www.w3.org/2000/svg"><rect fill="#00FF00"/></svg>')
+        out.writestr("word/embeddings/inner.docx", inner)
+    outer = buf.getvalue()
+
+    report = app.dry_run_report("docx", outer, app.docx_extract(outer), {"#FF0000": "#0000FF"}, {}, {}, {})
+    assert report.counts["SVG media"] == {"SVG images": 1}
+    assert report.counts["inner.docx: Body"] == report.counts["Body"] == {"text colors": 1}
@@ -0,0 +1,82 @@
+import io
+import zipfile
+
+import docx
+from docx.shared import RGBColor as DocxRGBColor
+from pptx import Presentation
+from pptx.dml.color import RGBColor
+from pptx.util import Inches
+
+
+def members(data: bytes):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        return {name: zf.read(name) for name in zf.namelist()}
+
+
+def deck() -> bytes:
+    prs = Presentation()
+    for idx in range(4):
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        for col, color in enumerate(("FF0000", "00FF00")):
+            shape = slide.shapes.add_shape(1, Inches(1 + 2 * col), Inches(1 + idx * 0.2), Inches(1), Inches(1))
+            shape.fill.solid()
+            shape.fill.fore_color.rgb = RGBColor.from_string(color if idx % 2 or col == 0 else "112233")
+    buf = io.BytesIO()
+    prs.save(buf)
+    return buf.getvalue()
+
+
+def document() -> bytes:
+    doc = docx.Document()
+    for color in ("FF0000", "00FF00", "112233"):
+        doc.add_paragraph().add_run(color).font.color.rgb = DocxRGBColor.from_string(color)
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def full_apply(app, file_type, data, color_map):
+    parsed = app.reparse_for_apply(file_type, data, {"images": []})
+    if file_type == "pptx":
+        return app.pptx_apply_updates(parsed, color_map, {}, {}, {})
+    return app.docx_apply_updates(parsed, color_map, {}, {})
+
+
+def check_incremental_matches_full(app, tmp_path, file_type, data, extracted):
+    first_map = {"#FF0000": "#0000FF"}
+    second_map = {"#FF0000": "#0000FF", "#00FF00": "#FFFF00"}
+    first_path = tmp_path / f"first.{file_type}"
+    first_path.write_bytes(full_apply(app, file_type, data, first_map))
+    file_hash = app.content_hash(data)
+    state = app.build_apply_state(file_hash, file_type, first_map, {}, {}, {}, str(first_path))
+
+    result = app.incremental_apply_updates(file_type, data, file_hash, extracted, state, second_map, {}, {}, {})
+    assert result is not None
+    output, rewritten = result
+    assert rewritten
+    assert members(output) == members(full_apply(app, file_type, data, second_map))
+
+
+def test_pptx_incremental_output_matches_a_full_apply(app, tmp_path):
+    data = deck()
+    check_incremental_matches_full(app, tmp_path, "pptx", data, app.pptx_extract(data))
+
+
+def test_docx_incremental_output_matches_a_full_apply(app, tmp_path):
+    data = document()
+    check_incremental_matches_full(app, tmp_path, "docx", data, app.docx_extract(data))
+
+
+def test_unchanged_mappings_reuse_the_previous_output(app, tmp_path):
+    data = document()
+    color_map = {"#FF0000": "#0000FF"}
+    previous = full_apply(app, "docx", data, color_map)
+    path = tmp_path / "previous.docx"
+    path.write_bytes(previous)
+    file_hash = app.content_hash(data)
+    state = app.build_apply_state(file_hash, "docx", color_map, {}, {}, {}, str(path))
+    assert app.incremental_apply_updates("docx", data, file_hash, app.docx_extract(data), state, color_map, {}, {}, {}) == (previous, [])
+    # Another document or a text replacement needs a full apply
+    assert app.incremental_apply_updates("docx", data, "other", app.docx_extract(data), state, color_map, {}, {}, {}) is None
+    state["text_map"] = {"Acme": "Beta"}
+    assert app.incremental_apply_updates("docx", data, file_hash, app.docx_extract(data), state, color_map, {}, {}, {}) is None
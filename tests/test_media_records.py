@@ -0,0 +1,34 @@
+import io
+import zipfile
+
+
+def package(members) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+def records(app, members, crc=None):
+    source = app.PackageSource(package(members))
+    images = []
+    for name in members:
+        handle = source.handle(name)
+        if crc is not None:
+            # Same CRC and size as every other member: only the bytes tell them apart
+            handle = app.MediaHandle(source, name, handle.size, crc)
+        images.append(app.ImageRecord(name, name, "Document", media_path=name, handle=handle))
+    return images
+
+
+def test_duplicates_are_confirmed_by_content_hash(app):
+    images = records(app, {"word/media/a.png": b"AAAA", "word/media/b.png": b"BBBB", "word/media/c.png": b"AAAA"}, crc=0x1234)
+    assert len({img.prefilter_key for img in images}) == 1
+    assert images[0].digest == images[2].digest != images[1].digest
+    assert app.filter_image_items(images, "All", "All", 0, True) == [images[0], images[2]]
+
+
+def test_unrelated_media_with_equal_crc_and_size_is_not_a_duplicate(app):
+    images = records(app, {"word/media/a.png": b"AAAA", "word/media/b.png": b"BBBB"}, crc=0x1234)
+    assert app.filter_image_items(images, "All", "All", 0, True) == []
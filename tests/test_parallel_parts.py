@@ -0,0 +1,80 @@
+import io
+import warnings
+import zipfile
+
+import pytest
+from pptx import Presentation
+from pptx.dml.color import RGBColor
+from pptx.util import Inches, Pt
+
+COLORS = ("FF0000", "00FF00", "0000FF", "112233")
+
+
+def deck(slides: int) -> bytes:
+    prs = Presentation()
+    for idx in range(slides):
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        shape = slide.shapes.add_shape(1, Inches(1), Inches(1), Inches(2), Inches(1))
+        shape.fill.solid()
+        shape.fill.fore_color.rgb = RGBColor.from_string(COLORS[idx % len(COLORS)])
+        run = shape.text_frame.paragraphs[0].add_run()
+        run.text = f"Slide {idx}"
+        run.font.name = "Arial" if idx % 3 else "Georgia"
+        run.font.size = Pt(12 + idx % 5)
+        run.font.color.rgb = RGBColor.from_string(COLORS[(idx + 1) % len(COLORS)])
+    buf = io.BytesIO()
+    prs.save(buf)
+    return buf.getvalue()
+
+
+def members(data: bytes):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        return {name: zf.read(name) for name in zf.namelist()}
+
+
+def run_both(app, monkeypatch, func):
+    serial = func()
+    forks = []
+    fork_map = app.fork_map
+
+    def counting_fork_map(*args):
+        result = fork_map(*args)
+        forks.append(result is not None)
+        return result
+
+    monkeypatch.setattr(app, "PART_WORKERS", 2)
+    monkeypatch.setattr(app, "JOB_MAX_WORKERS", 1)
+    monkeypatch.setattr(app, "fork_map", counting_fork_map)
+    with warnings.catch_warnings():
+        # Forking with other threads alive warns on 3.12+; the opt-in accepts that
+        warnings.simplefilter("ignore", DeprecationWarning)
+        forked = func()
+    assert forks == [True]
+    return serial, forked
+
+
+@pytest.fixture
+def data(app):
+    if not app.PART_FORK_AVAILABLE:
+        pytest.skip("fork start method not available")
+    return deck(app.PPTX_PARALLEL_MIN_SLIDES)
+
+
+def test_forked_extraction_matches_serial(app, monkeypatch, data):
+    def extract():
+        extracted = app.pptx_extract(data)
+        return {key: extracted[key] for key in ("text_colors", "shape_colors", "background_colors", "fonts")}, [img.uid for img in extracted["images"]]
+
+    serial, forked = run_both(app, monkeypatch, extract)
+    assert forked == serial
+    assert "#FF0000" in serial[0]["shape_colors"]
+
+
+def test_forked_apply_matches_serial(app, monkeypatch, data):
+    color_map = {"#FF0000": "#ABCDEF", "#00FF00": "#123456"}
+
+    def apply():
+        return members(app.pptx_apply_updates(app.reparse_for_apply("pptx", data, {"images": []}), color_map, {"Arial": "Verdana"}, {}, {}))
+
+    serial, forked = run_both(app, monkeypatch, apply)
+    assert forked == serial
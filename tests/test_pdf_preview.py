@@ -0,0 +1,16 @@
+import os
+
+
+def test_local_copies_are_written_atomically_and_swept_with_outputs(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "OUTPUT_DIR", str(tmp_path))
+    path = app.pdf_local_copy("abc", b"%PDF-1.4 first")
+    assert os.path.dirname(path) == str(tmp_path)
+    assert open(path, "rb").read() == b"%PDF-1.4 first"
+    assert app.pdf_local_copy("abc", b"%PDF-1.4 first") == path
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+    os.utime(path, (0, 0))
+    app.cleanup_output_files()
+    assert not os.path.exists(path)
+    assert app.pdf_local_copy("abc", b"%PDF-1.4 first") == path
+    assert os.path.exists(path)
@@ -0,0 +1,53 @@
+import io
+import struct
+
+import pytest
+from pypdf import PdfReader
+
+CONTENT = b"1 0 0 rg 0 0 100 100 re f 0 0 1 RG 10 10 m 50 50 l S"
+
+
+def build_pdf(xref_stream: bool) -> bytes:
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 200] /Contents 4 0 R /Resources << >> >>",
+        b"<< /Length %d >>\nstream\n" % len(CONTENT) + CONTENT + b"\nendstream",
+    ]
+    out = io.BytesIO()
+    out.write(b"%PDF-1.5\n")
+    offsets = []
+    for idnum, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % idnum + body + b"\nendobj\n")
+    xref_pos = out.tell()
+    if xref_stream:
+        offsets.append(xref_pos)
+        rows = struct.pack(">BIH", 0, 0, 65535) + b"".join(struct.pack(">BIH", 1, offset, 0) for offset in offsets)
+        out.write(b"5 0 obj\n<< /Type /XRef /Size 6 /W [1 4 2] /Root 1 0 R /Length %d >>\nstream\n" % len(rows) + rows + b"\nendstream\nendobj\n")
+    else:
+        out.write(b"xref\n0 5\n0000000000 65535 f\r\n" + b"".join(b"%010d 00000 n\r\n" % offset for offset in offsets))
+        out.write(b"trailer\n<< /Size 5 /Root 1 0 R >>\n")
+    out.write(b"startxref\n%d\n%%%%EOF\n" % xref_pos)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("xref_stream", [False, True], ids=["xref-table", "xref-stream"])
+def test_incremental_update_round_trips_through_pypdf(app, xref_stream):
+    original = build_pdf(xref_stream)
+    assert app.pdf_extract(original)["shape_colors"] == ["#0000FF", "#FF0000"]
+
+    updated = app.pdf_apply_updates(original, {"#FF0000": "#00FF00"}, {}, {})
+    # An incremental update leaves the original bytes in place and appends after them
+    assert updated.startswith(original) and len(updated) > len(original)
+    assert updated[len(original):].count(b"startxref") == 1
+    if xref_stream:
+        assert b"/XRef" in updated[len(original):]
+    else:
+        assert b"\nxref\n" in updated[len(original):]
+
+    reader = PdfReader(io.BytesIO(updated), strict=True)
+    assert len(reader.pages) == 1
+    content = reader.pages[0].get_contents().get_data()
+    assert b"1 0 0 rg" not in content and b"0 0 1 RG" in content
+    assert app.pdf_extract(updated)["shape_colors"] == ["#0000FF", "#00FF00"]
@@ -0,0 +1,18 @@
+def cache_key(app):
+    return app.result_cache_key("xlsx", "abc123", {"#FF0000": "#0000FF"}, {}, {}, {}, app.DEFAULT_COMPRESSION_POLICY, None, None)
+
+
+def test_entries_from_an_older_version_are_not_served(app, monkeypatch, tmp_path):
+    cache = app.ResultCache(str(tmp_path / "cache"), 1 << 20)
+    output = tmp_path / "output.xlsx"
+    output.write_bytes(b"formulas saved as values")
+
+    monkeypatch.setattr(app, "RESULT_CACHE_VERSION", app.RESULT_CACHE_VERSION - 1)
+    old_key = cache_key(app)
+    cache.put(old_key, str(output), ["old note"])
+    monkeypatch.undo()
+
+    dest = tmp_path / "dest.xlsx"
+    assert cache.get(old_key, str(dest)) == ["old note"]
+    assert cache_key(app) != old_key
+    assert cache.get(cache_key(app), str(dest)) is None
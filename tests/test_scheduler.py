@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+MB = 1024 * 1024
+
+
+def test_oversized_jobs_are_rejected(app):
+    scheduler = app.JobScheduler(2, 100 * MB, 10 * MB)
+    with pytest.raises(app.JobRejected):
+        scheduler.submit(lambda: None, input_size=11 * MB, estimate=MB)
+    with pytest.raises(app.JobRejected):
+        scheduler.submit(lambda: None, input_size=MB, estimate=101 * MB)
+
+
+def test_jobs_start_in_order_within_the_budget(app):
+    scheduler = app.JobScheduler(2, 100 * MB, 100 * MB)
+    release = threading.Event()
+    started = []
+
+    def job(name):
+        started.append(name)
+        release.wait(5)
+        return name
+
+    first = scheduler.submit(job, "first", input_size=MB, estimate=60 * MB)
+    # Would overrun the budget next to the first job, so it waits even though a worker is free
+    second = scheduler.submit(job, "second", input_size=MB, estimate=60 * MB)
+    # Small enough to fit, but strict FIFO keeps it behind the head of the queue
+    third = scheduler.submit(job, "third", input_size=MB, estimate=10 * MB)
+    assert scheduler.position(first) == 0
+    assert (scheduler.position(second), scheduler.position(third)) == (1, 2)
+
+    scheduler.cancel(third)
+    assert third.future.cancelled()
+    release.set()
+    assert first.future.result(5) == "first"
+    assert second.future.result(5) == "second"
+    assert started == ["first", "second"]
+
+
+def test_a_job_larger_than_the_free_budget_runs_alone(app):
+    scheduler = app.JobScheduler(2, 100 * MB, 100 * MB)
+    job = scheduler.submit(lambda: "done", input_size=MB, estimate=100 * MB)
+    assert job.future.result(5) == "done"
+
+
+def test_memory_estimate_scales_with_format_and_recolor(app):
+    assert app.job_memory_estimate("xlsx", MB) > app.job_memory_estimate("pdf", MB)
+    assert app.job_memory_estimate("pptx", MB, 50 * MB) == app.job_memory_estimate("pptx", MB) + 50 * MB
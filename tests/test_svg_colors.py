@@ -0,0 +1,25 @@
+def test_fragment_ids_that_look_like_colors_are_kept(app):
+    svg = (
+        b'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">'
+        b'<style>#abc { fill: #abc; } .x { stroke: #a1b2c3 }</style>'
+        b'<linearGradient id="abc"><stop stop-color="#a1b2c3"/></linearGradient>'
+        b'<rect fill="url(#abc)" stroke="#abc" style="fill:url(#a1b2c3);stroke:#fed"/>'
+        b'<use href="#fed" xlink:href="#fed" fill="#fed"/>'
+        b'</svg>'
+    )
+    found, rewritten = app.svg_rewrite_colors(svg, {"#AABBCC": "#112233", "#A1B2C3": "#445566", "#FFEEDD": "#778899"})
+    assert found == {"#AABBCC", "#A1B2C3", "#FFEEDD"}
+    assert rewritten == (
+        b'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">'
+        b'<style>#abc { fill: #112233; } .x { stroke: #445566 }</style>'
+        b'<linearGradient id="abc"><stop stop-color="#445566"/></linearGradient>'
+        b'<rect fill="url(#abc)" stroke="#112233" style="fill:url(#a1b2c3);stroke:#778899"/>'
+        b'<use href="#fed" xlink:href="#fed" fill="#778899"/>'
+        b'</svg>'
+    )
+
+
+def test_rgb_colors_are_rewritten(app):
+    found, rewritten = app.svg_rewrite_colors(b'<svg><rect fill="rgb(232, 119, 34)"/></svg>', {"#E87722": "#0055AA"})
+    assert found == {"#E87722"}
+    assert rewritten == b'<svg><rect fill="#0055AA"/></svg>'
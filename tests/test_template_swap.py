@@ -0,0 +1,46 @@
+import io
+import zipfile
+
+from pptx import Presentation
+
+
+def deck() -> bytes:
+    prs = Presentation()
+    title = prs.slides.add_slide(prs.slide_layouts[0])
+    title.shapes.title.text = "Quarterly review"
+    content = prs.slides.add_slide(prs.slide_layouts[1])
+    content.shapes.title.text = "Agenda"
+    content.placeholders[1].text = "Results"
+    prs.slides.add_slide(prs.slide_layouts[6])
+    buf = io.BytesIO()
+    prs.save(buf)
+    return buf.getvalue()
+
+
+def template() -> bytes:
+    prs = Presentation()
+    for layout in prs.slide_layouts:
+        layout.name = f"Brand {layout.name}"
+    buf = io.BytesIO()
+    prs.save(buf)
+    return buf.getvalue()
+
+
+def test_swapped_deck_reopens_on_the_template_layouts(app):
+    data = deck()
+    output, notes = app.pptx_template_swap(app.reparse_for_apply("pptx", data, {"images": []}), template(), {}, {}, {})
+
+    with zipfile.ZipFile(io.BytesIO(output)) as zf:
+        names = zf.namelist()
+    assert len(names) == len(set(names))
+
+    prs = Presentation(io.BytesIO(output))
+    assert len(prs.slide_masters) == 1
+    assert all(layout.name.startswith("Brand ") for layout in prs.slide_layouts)
+    # The deck's own masters and layouts are gone; the template's were renamed around the deck's part names
+    layout_parts = [n for n in names if n.startswith("ppt/slideLayouts/") and n.endswith(".xml")]
+    assert len(layout_parts) == len(prs.slide_layouts)
+    assert [slide.slide_layout.name for slide in prs.slides] == ["Brand Title Slide", "Brand Title and Content", "Brand Blank"]
+    assert prs.slides[0].shapes.title.text == "Quarterly review"
+    assert prs.slides[1].placeholders[1].text == "Results"
+    assert "Title Slide → Brand Title Slide" in notes[0]
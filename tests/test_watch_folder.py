@@ -0,0 +1,66 @@
+import io
+import json
+import time
+
+import docx
+from docx.shared import RGBColor
+
+PROFILE = {"color_map": {"#FF0000": "#0000FF"}, "font_map": {}, "text_map": {}, "compression": "Balanced", "recolor": None}
+
+
+def write_docx(path):
+    document = docx.Document()
+    document.add_paragraph().add_run("Brand").font.color.rgb = RGBColor(0xFF, 0x00, 0x00)
+    buf = io.BytesIO()
+    document.save(buf)
+    path.write_bytes(buf.getvalue())
+
+
+def poll_until(service, done, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        service.poll()
+        if done():
+            return
+        time.sleep(0.05)
+    raise AssertionError(f"watch folder did not settle: {service.metrics()}")
+
+
+def make_service(app, tmp_path):
+    scheduler = app.JobScheduler(1, 1 << 30, 1 << 30)
+    service = app.WatchFolderService([str(tmp_path / "in")], str(tmp_path / "out"), PROFILE, scheduler, poll_seconds=0)
+    (tmp_path / "out").mkdir(exist_ok=True)
+    return service
+
+
+def test_manifest_skips_unchanged_files_after_a_restart(app, tmp_path):
+    (tmp_path / "in").mkdir()
+    write_docx(tmp_path / "in" / "deck.docx")
+    first = make_service(app, tmp_path)
+    poll_until(first, lambda: first.counts["rebranded"] == 1)
+    mirrored = tmp_path / "out" / "in" / "deck.docx"
+    assert mirrored.exists()
+    assert "in/deck.docx" in json.loads((tmp_path / "out" / app.WATCH_MANIFEST_NAME).read_text())
+
+    restarted = make_service(app, tmp_path)
+    poll_until(restarted, lambda: restarted.counts["skipped"] == 1)
+    poll_until(restarted, lambda: True)
+    assert restarted.counts == {"rebranded": 0, "skipped": 1, "failed": 0}
+
+
+def test_failed_files_are_retried_on_the_next_poll(app, tmp_path, monkeypatch):
+    (tmp_path / "in").mkdir()
+    write_docx(tmp_path / "in" / "deck.docx")
+    run_watch_job = app.run_watch_job
+
+    def broken(*args, **kwargs):
+        raise OSError("share went away")
+
+    monkeypatch.setattr(app, "run_watch_job", broken)
+    service = make_service(app, tmp_path)
+    poll_until(service, lambda: service.counts["failed"] == 1)
+    assert not (tmp_path / "out" / "in" / "deck.docx").exists()
+
+    monkeypatch.setattr(app, "run_watch_job", run_watch_job)
+    poll_until(service, lambda: service.counts["rebranded"] == 1)
+    assert (tmp_path / "out" / "in" / "deck.docx").exists()
@@ -0,0 +1,20 @@
+import io
+
+import openpyxl
+
+
+def test_text_replacement_keeps_formulas(app):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws["A1"] = "Acme Corp"
+    ws["A2"] = '="Acme Corp "&A1'
+    ws["A3"] = "=LEN(A1)"
+    buf = io.BytesIO()
+    wb.save(buf)
+    data = buf.getvalue()
+
+    output = app.xlsx_apply_updates(app.reparse_for_apply("xlsx", data, {"images": []}), {}, {}, {}, text_map={"Acme Corp": "Beta Ltd"})
+    ws = openpyxl.load_workbook(io.BytesIO(output)).active
+    assert ws["A1"].value == "Beta Ltd"
+    assert ws["A2"].value == '="Acme Corp "&A1'
+    assert ws["A3"].value == "=LEN(A1)"
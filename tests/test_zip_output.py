@@ -0,0 +1,30 @@
+import io
+
+import docx
+import pytest
+
+
+def test_failed_rewrite_raises_and_leaves_the_sink_empty(app):
+    sink = io.BytesIO()
+    with pytest.raises(Exception):
+        app.zip_replace_media(b"not a package", {"word/media/image1.png": b"new"}, sink)
+    assert sink.getvalue() == b""
+
+
+def test_failed_apply_is_not_cached(app, monkeypatch, tmp_path):
+    document = docx.Document()
+    document.add_paragraph("Brand")
+    buf = io.BytesIO()
+    document.save(buf)
+    data = buf.getvalue()
+    cache = app.ResultCache(str(tmp_path / "cache"), 1 << 20)
+
+    def broken(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(app, "result_cache", lambda: cache)
+    monkeypatch.setattr(app, "zip_replace_media", broken)
+    output = tmp_path / "out.docx"
+    with pytest.raises(OSError):
+        app.run_cached_apply("docx", data, app.content_hash(data), app.docx_extract(data), None, {"#FF0000": "#0000FF"}, {}, {}, {}, str(output), app.DEFAULT_COMPRESSION_POLICY)
+    assert not (tmp_path / "cache").exists() or not list((tmp_path / "cache").iterdir())